@@ -0,0 +1,101 @@
+"""
+    Benchmark - dictionary cursor + fetchall() vs the typed batch fetch helper (src/db_fetch.py).
+
+    Measures wall time and peak Python memory (tracemalloc) of building the same DataFrame both ways.
+
+    Against the database configured in src/config.py (clean data table by default):
+        python benchmarks/bench_fetch.py
+        python benchmarks/bench_fetch.py --query "SELECT wind_speed, wind_direction, power_output FROM wind_turbine_raw_data"
+
+    Without a database, rows are generated by an in-process cursor so only the Python side
+    (row objects and conversion) is measured:
+        python benchmarks/bench_fetch.py --synthetic-rows 2000000
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+
+import config as conf
+from db_fetch import fetch_dataframe
+
+COLUMNS = ["wind_speed", "wind_direction", "power_output"]
+DTYPES = {column: "float64" for column in COLUMNS}
+
+
+class SyntheticCursor:
+    # Minimal DB-API cursor returning generated rows, as tuples or dicts like mysql.connector does.
+    def __init__(self, rows, dictionary=False):
+        self.rows = rows
+        self.dictionary = dictionary
+        self.position = 0
+        self.description = [(column,) for column in COLUMNS]
+
+    def execute(self, query, params=None):
+        self.position = 0
+
+    def _make_row(self, index):
+        row = (5.0 + index % 20 * 0.5, float(index % 360), None if index % 97 == 0 else 1.5 + index % 30 * 0.1)
+        return dict(zip(COLUMNS, row)) if self.dictionary else row
+
+    def fetchmany(self, size):
+        end = min(self.position + size, self.rows)
+        batch = [self._make_row(index) for index in range(self.position, end)]
+        self.position = end
+        return batch
+
+    def fetchall(self):
+        return self.fetchmany(self.rows)
+
+
+def measure(name, func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    df = func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<22} rows={len(df):>10}  time={elapsed:8.3f}s  peak_memory={peak / 1024 / 1024:9.1f} MB")
+    return elapsed, peak
+
+
+def dict_cursor_path(cursor, query):
+    cursor.execute(query)
+    return pd.DataFrame(cursor.fetchall())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--query", default=f"SELECT {', '.join(COLUMNS)} FROM {conf.CLEAN_DATA_TABLE}")
+    parser.add_argument("--synthetic-rows", type=int, default=0, help="use generated rows instead of the database")
+    args = parser.parse_args()
+
+    if args.synthetic_rows:
+        dict_cursor = SyntheticCursor(args.synthetic_rows, dictionary=True)
+        typed_cursor = SyntheticCursor(args.synthetic_rows)
+        connection = None
+    else:
+        connection = conf.get_db_connection()
+        if connection is None:
+            sys.exit("DB connection failed - check src/config.py or use --synthetic-rows")
+        dict_cursor = connection.cursor(dictionary=True)
+        typed_cursor = connection.cursor()
+
+    try:
+        dict_time, dict_peak = measure("dict cursor + fetchall", lambda: dict_cursor_path(dict_cursor, args.query))
+        typed_time, typed_peak = measure("typed batch fetch", lambda: fetch_dataframe(typed_cursor, args.query, dtypes=DTYPES))
+        print(f"speed-up: {dict_time / typed_time:.1f}x, peak memory: {typed_peak / max(dict_peak, 1):.0%} of dict cursor path")
+    finally:
+        if connection:
+            connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+    Load test of the HTTP service (src/http_service.py) - concurrent keep-alive clients requesting the
+    same dashboard query, reports requests/sec, latency percentiles and the response statuses.
+
+    Against an in-process service on the database configured in src/config.py:
+        python benchmarks/bench_http.py --path "/summary?start=2022-03-01&end=2022-04-01"
+    Against a running service:
+        python benchmarks/bench_http.py --url http://127.0.0.1:8080
+    Without a database, the in-process service reads generated rows (the HTTP, cache and
+    serialization side only):
+        python benchmarks/bench_http.py --synthetic-rows 100000 --requests 500
+    With --revalidate the clients send the ETag of their previous response (dashboards polling an
+    unchanged table get 304 Not Modified).
+"""
+
+import argparse
+import http.client
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+
+import config as conf
+from http_service import PipelineHTTPServer
+
+
+class SyntheticCursor:
+    # Minimal DB-API cursor: a fixed ledger version for the version check, generated summary rows otherwise.
+    def __init__(self, rows):
+        self.rows = rows
+        self.description = []
+        self.result = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, query, params=None):
+        if conf.RUN_LEDGER_TABLE in query:
+            self.result = [(resource, 1) for resource in params]
+            return
+        self.description = [("day",), ("turbine_id",), ("min_power_output",), ("max_power_output",), ("avg_power_output",)]
+        first_day = datetime(2022, 3, 1).date()
+        self.result = [(first_day + timedelta(days=index // 100), index % 100, 0.5, 4.5, 2.5) for index in range(self.rows)]
+
+    def fetchall(self):
+        return self.result
+
+
+class SyntheticConnection:
+    def __init__(self, rows):
+        self.rows = rows
+        self.autocommit = True
+
+    def cursor(self):
+        return SyntheticCursor(self.rows)
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def run_client(host, port, path, requests, revalidate):
+    # one keep-alive client, returns [(status, seconds, body bytes)]
+    client = http.client.HTTPConnection(host, port, timeout=60)
+    results = []
+    etag = None
+    for _ in range(requests):
+        headers = {"If-None-Match": etag} if revalidate and etag else {}
+        start = time.perf_counter()
+        client.request("GET", path, headers=headers)
+        response = client.getresponse()
+        body = response.read()
+        results.append((response.status, time.perf_counter() - start, len(body)))
+        etag = response.getheader("ETag") or etag
+    client.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="running service (default: start one in this process)")
+    parser.add_argument("--path", default="/summary?start=2022-03-01&end=2022-04-01")
+    parser.add_argument("--requests", type=int, default=2000, help="requests in total")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--revalidate", action="store_true", help="send If-None-Match with the previous ETag")
+    parser.add_argument("--synthetic-rows", type=int, default=0, help="in-process service reads generated rows instead of the database")
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        url = urlparse(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        connection_factory = (lambda: SyntheticConnection(args.synthetic_rows)) if args.synthetic_rows else None
+        server = PipelineHTTPServer(("127.0.0.1", 0), connection_factory)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = "127.0.0.1", server.server_port
+
+    try:
+        per_client = max(args.requests // args.concurrency, 1)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as clients:
+            runs = list(clients.map(lambda _: run_client(host, port, args.path, per_client, args.revalidate), range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    results = [result for run in runs for result in run]
+    latencies = sorted(seconds * 1000 for _, seconds, _ in results)
+    percentile = lambda share: latencies[min(int(len(latencies) * share), len(latencies) - 1)]
+    statuses = Counter(status for status, _, _ in results)
+    print(f"{len(results)} requests, {args.concurrency} clients, {elapsed:.2f}s: {len(results) / elapsed:.0f} requests/sec")
+    print(f"latency ms: median {statistics.median(latencies):.1f}, p95 {percentile(0.95):.1f}, p99 {percentile(0.99):.1f}, max {latencies[-1]:.1f}")
+    print(f"statuses: {dict(statuses)}, {sum(size for _, _, size in results) / 1024 / 1024:.1f} MB of response bodies")
+
+
+if __name__ == "__main__":
+    main()
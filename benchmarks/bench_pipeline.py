@@ -0,0 +1,195 @@
+"""
+    End-to-end benchmark - runs every pipeline step on generated fleets of increasing size against a
+    local MySQL benchmark database and reports per step wall time, rows/sec and the peak RSS sampled
+    while the step ran (metrics.step_metrics).
+
+    Each scale (<turbines>x<days>) runs in its own process (so the steps of a scale don't start with
+    the memory of the previous scale) on a freshly
+    created database (WIND_TURBINE_DB_NAME, default wind_turbine_bench - it is dropped and re-created,
+    so it must not be the production database). The fleet CSVs are generated once into
+    benchmarks/data/ and copied for every run, as ingestion archives them.
+
+    Results are saved to benchmarks/results/bench_pipeline_<timestamp>.json and compared with the
+    previous results file:
+        python benchmarks/bench_pipeline.py
+        python benchmarks/bench_pipeline.py --scales 5x31 50x90 500x1095 --interval-minutes 10
+        WIND_TURBINE_IN_MEMORY=1 python benchmarks/bench_pipeline.py   # in-memory pipeline mode
+        WIND_TURBINE_PIPELINED_INGESTION=1 python benchmarks/bench_pipeline.py   # pipelined ingestion
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+sys.path.insert(0, os.path.join(ROOT_DIR, "data_pipeline"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_DB_NAME = "wind_turbine_bench"
+DATA_DIR = os.path.join(ROOT_DIR, "benchmarks", "data")
+RESULTS_DIR = os.path.join(ROOT_DIR, "benchmarks", "results")
+
+
+def get_data_dir(scale, interval_minutes):
+    return os.path.join(DATA_DIR, f"fleet_{scale}_{interval_minutes}min")
+
+
+def generate_data(scale, interval_minutes):
+    # generate the fleet CSVs of a scale unless they are there from a previous benchmark
+    from generate_fleet_data import build_parser, generate_fleet
+
+    data_dir = get_data_dir(scale, interval_minutes)
+    if glob.glob(os.path.join(data_dir, "data_group_*.csv")):
+        return data_dir
+
+    turbines, days = scale.split("x")
+    print(f"generating {scale} fleet data into {data_dir} ...")
+    generate_fleet(build_parser().parse_args([
+        "--turbines", turbines, "--days", days, "--interval-minutes", str(interval_minutes), "--output-dir", data_dir,
+    ]))
+    return data_dir
+
+
+def count_rows(data_dir):
+    rows = 0
+    for file_path in glob.glob(os.path.join(data_dir, "data_group_*.csv")):
+        with open(file_path, "rb") as file:
+            rows += sum(1 for _ in file) - 1
+    return rows
+
+
+def reset_database():
+    import config as conf
+
+    if "bench" not in conf.DB_NAME:
+        sys.exit(f"refusing to drop {conf.DB_NAME} - use a benchmark database (name containing 'bench')")
+    connection = conf.get_mysql_connection()
+    if connection is None:
+        sys.exit("MySQL connection failed - check src/config.py")
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP DATABASE IF EXISTS {conf.DB_NAME}")
+    connection.close()
+
+
+def run_scale(scale, data_dir):
+    """ Run all pipeline steps once (in the current process) on a copy of the scale's data.
+        Returns the per step results.
+    """
+    import config as conf
+    import metrics
+    from wind_turbine_data_pipeline import get_pipeline_steps, run_step
+
+    conf.initialize()
+    input_rows = count_rows(data_dir)
+    reset_database()
+
+    with tempfile.TemporaryDirectory(prefix="wind_turbine_bench_") as work_dir:
+        conf.RAW_DATA_FOLDER = os.path.join(work_dir, "raw_data")
+        conf.ARCHIVE_FOLDER = os.path.join(work_dir, "archive")
+        shutil.copytree(data_dir, conf.RAW_DATA_FOLDER)
+        os.makedirs(conf.ARCHIVE_FOLDER)
+
+        metrics.reset()
+        steps = []
+        for step in get_pipeline_steps():
+            start = time.perf_counter()
+            result = run_step(step)
+            seconds = time.perf_counter() - start
+            steps.append({"step": step.name, "status": result.status, "seconds": seconds})
+            if result.failed:
+                break
+
+    run_metrics = metrics.build_run_metrics(scale)
+    for step in steps:
+        step_metrics = run_metrics["steps"].get(step["step"], {})
+        step.update({
+            "rows_read": step_metrics.get("rows_read", 0),
+            "rows_written": step_metrics.get("rows_written", 0),
+            "peak_rss_mb": step_metrics.get("peak_rss_mb"),
+            "peak_rss_growth_mb": step_metrics.get("peak_rss_growth_mb"),
+            # throughput in input readings, comparable between steps and scales
+            "readings_per_second": input_rows / step["seconds"] if step["seconds"] else 0.0,
+        })
+        step_queries = [query for query in run_metrics["queries"] if query["step"] == step["step"]]
+        if step_queries:
+            step["slowest_query"] = {key: step_queries[0][key] for key in ("name", "count", "total_seconds", "max_seconds")}
+
+    return {"scale": scale, "input_rows": input_rows, "total_seconds": sum(step["seconds"] for step in steps), "steps": steps}
+
+
+def get_previous_results():
+    results_files = sorted(glob.glob(os.path.join(RESULTS_DIR, "bench_pipeline_*.json")))
+    if not results_files:
+        return None
+    with open(results_files[-1]) as file:
+        return json.load(file)
+
+
+def print_results(results, previous):
+    previous_steps = {}
+    for scale_result in (previous or {}).get("scales", []):
+        for step in scale_result["steps"]:
+            previous_steps[(scale_result["scale"], step["step"])] = step
+
+    print(f"\n{'scale':<12}{'step':<32}{'status':<9}{'seconds':>10}{'readings/s':>14}{'peak RSS MB':>13}{'vs previous':>13}")
+    for scale_result in results["scales"]:
+        for step in scale_result["steps"]:
+            previous_step = previous_steps.get((scale_result["scale"], step["step"]))
+            change = f"{step['seconds'] / previous_step['seconds']:.2f}x" if previous_step and previous_step["seconds"] else "-"
+            print(f"{scale_result['scale']:<12}{step['step']:<32}{step['status']:<9}{step['seconds']:>10.2f}"
+                  f"{step['readings_per_second']:>14.0f}{step['peak_rss_mb'] or 0:>13.1f}{change:>13}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", nargs="+", default=["5x31", "50x90", "500x365"], help="<turbines>x<days>")
+    parser.add_argument("--interval-minutes", type=int, default=60,
+                        help="minutes between generated readings, passed to the pipeline as WIND_TURBINE_READING_INTERVAL_MINUTES")
+    parser.add_argument("--db-name", default=os.environ.get("WIND_TURBINE_DB_NAME", DEFAULT_DB_NAME))
+    # internal - run one scale in this process and write its results to --output
+    parser.add_argument("--run-scale", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scale:
+        with open(args.output, "w") as file:
+            json.dump(run_scale(args.run_scale, get_data_dir(args.run_scale, args.interval_minutes)), file)
+        return
+
+    results = {"started": datetime.now().isoformat(timespec="seconds"), "interval_minutes": args.interval_minutes,
+               "db_name": args.db_name, "scales": []}
+    # the pipeline's energy and completeness calculations must use the interval of the generated readings
+    env = dict(os.environ, WIND_TURBINE_DB_NAME=args.db_name, WIND_TURBINE_READING_INTERVAL_MINUTES=str(args.interval_minutes))
+    for scale in args.scales:
+        generate_data(scale, args.interval_minutes)
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as output:
+            output_path = output.name
+        try:
+            print(f"running the pipeline on {scale} ...")
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--run-scale", scale, "--output", output_path,
+                            "--interval-minutes", str(args.interval_minutes)], env=env, cwd=ROOT_DIR, check=True)
+            with open(output_path) as file:
+                results["scales"].append(json.load(file))
+        finally:
+            os.remove(output_path)
+
+    previous = get_previous_results()
+    print_results(results, previous)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    results_path = os.path.join(RESULTS_DIR, f"bench_pipeline_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(results_path, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"\nresults saved to {results_path}")
+
+
+if __name__ == "__main__":
+    main()
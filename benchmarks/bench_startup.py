@@ -0,0 +1,81 @@
+"""
+    Startup benchmark - import time of every entry point, measured with python -X importtime in a fresh
+    interpreter per run (like a daemon worker or a process pool child starting up).
+
+    For each entry point it reports the median cumulative import time, the heaviest imports and any
+    file or folder the import created (importing must have no side effects, see config.initialize).
+    Runs in an empty temporary folder so the relative data / logs folders would show up there.
+        python benchmarks/bench_startup.py
+        python benchmarks/bench_startup.py --runs 10 --top 5 worker clean_data
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# module of every entry point, all on the PYTHONPATH set below
+ENTRY_POINTS = [
+    "config", "setup_database", "ingest_data", "clean_data", "calculate_summary_stats",
+    "in_memory_pipeline", "worker", "wind_turbine_data_pipeline",
+]
+
+
+def parse_importtime(stderr):
+    # {module: (self us, cumulative us)} from the "import time: self | cumulative | module" lines
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        imports[module.strip()] = (int(self_us), int(cumulative_us))
+    return imports
+
+
+def measure_import(module, work_dir):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(ROOT_DIR, "src"), os.path.join(ROOT_DIR, "data_pipeline")]))
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                               cwd=work_dir, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        sys.exit(f"import {module} failed:\n{completed.stderr[-2000:]}")
+    return parse_importtime(completed.stderr)
+
+
+def bench_entry_point(module, runs, top):
+    with tempfile.TemporaryDirectory(prefix="wind_turbine_startup_") as work_dir:
+        timings = [measure_import(module, work_dir) for _ in range(runs)]
+        side_effects = sorted(os.listdir(work_dir))
+
+    # the heaviest imports of the last run, excluding the entry point itself
+    last_run = timings[-1]
+    heaviest = sorted(((cumulative, name) for name, (_, cumulative) in last_run.items() if name != module), reverse=True)[:top]
+    return {
+        "module": module,
+        "median_ms": statistics.median(timing[module][1] for timing in timings) / 1000,
+        "heaviest": [(name, cumulative / 1000) for cumulative, name in heaviest],
+        "side_effects": side_effects,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=ENTRY_POINTS, help="entry point modules (default: all)")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=3, help="heaviest imports listed per entry point")
+    args = parser.parse_args()
+
+    print(f"{'entry point':<30}{'import ms':>10}  heaviest imports (cumulative ms)")
+    for module in args.modules:
+        result = bench_entry_point(module, args.runs, args.top)
+        heaviest = ", ".join(f"{name} {ms:.0f}" for name, ms in result["heaviest"])
+        print(f"{module:<30}{result['median_ms']:>10.1f}  {heaviest}")
+        if result["side_effects"]:
+            print(f"{'':<30}{'':>10}  side effects - import created: {result['side_effects']}")
+
+
+if __name__ == "__main__":
+    main()
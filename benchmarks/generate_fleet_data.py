@@ -0,0 +1,171 @@
+"""
+    Synthetic fleet data generator - data_group_<n>.csv files in the format of the sample CSVs
+    (timestamp, turbine_id, wind_speed, wind_direction, power_output), 5 turbines per file.
+
+    - wind speed: Weibull distributed, autocorrelated over time, with a daily cycle and a per turbine site factor
+    - wind direction: slowly veering around a prevailing direction
+    - power output: power curve of the wind speed (cut-in, rated, cut-out) plus noise
+    - injected NULLs, outliers (spikes / negative power) and gaps (missing readings and turbine outages)
+    - optional daily appended snapshots: snapshot_<day>/ folders with the CSVs as they were after each day
+
+    Examples:
+        python benchmarks/generate_fleet_data.py --turbines 15 --days 31 --interval-minutes 60 --output-dir data/raw_data
+        python benchmarks/generate_fleet_data.py --turbines 500 --days 1095 --output-dir benchmarks/data/fleet_500x1095
+        python benchmarks/generate_fleet_data.py --turbines 10 --days 7 --snapshots --output-dir benchmarks/data/snapshots
+"""
+
+import argparse
+import os
+import shutil
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+CSV_PREFIX = "data_group_"
+COLUMNS = ["timestamp", "turbine_id", "wind_speed", "wind_direction", "power_output"]
+
+# power curve (m/s, MW)
+CUT_IN_SPEED = 3.0
+RATED_SPEED = 13.0
+CUT_OUT_SPEED = 25.0
+RATED_POWER = 4.5
+
+# days of the fleet generated at once, bounds the memory of the generator
+DAYS_PER_CHUNK = 31
+
+
+def power_curve(wind_speed):
+    # cubic between cut-in and rated speed, rated power up to cut-out, 0 outside
+    ramp = np.clip((wind_speed - CUT_IN_SPEED) / (RATED_SPEED - CUT_IN_SPEED), 0.0, 1.0) ** 3
+    power = RATED_POWER * ramp
+    power[(wind_speed < CUT_IN_SPEED) | (wind_speed >= CUT_OUT_SPEED)] = 0.0
+    return power
+
+
+def generate_chunk(rng, turbine_ids, start, periods, interval_minutes, state, args):
+    """ Readings of the whole fleet for `periods` intervals from start, as a DataFrame sorted by timestamp.
+        state carries the per turbine wind / direction between chunks so the series stay continuous.
+    """
+    turbines = len(turbine_ids)
+    timestamps = pd.date_range(start, periods=periods, freq=f"{interval_minutes}min")
+    hours = timestamps.hour.to_numpy() + timestamps.minute.to_numpy() / 60
+
+    # two AR(1) gaussian components (correlation decays over ~6 hours), their magnitude is Rayleigh
+    # i.e. Weibull k=2 distributed like measured wind speeds
+    phi = np.exp(-interval_minutes / 360)
+    noise = rng.normal(0.0, np.sqrt(1 - phi ** 2), size=(periods, 2, turbines))
+    components = np.empty((periods, 2, turbines))
+    previous = state.get("components", rng.normal(size=(2, turbines)))
+    for index in range(periods):
+        previous = phi * previous + noise[index]
+        components[index] = previous
+    state["components"] = previous
+
+    rayleigh = np.sqrt((components ** 2).sum(axis=1)) / np.sqrt(np.pi / 2)
+    diurnal = 1 + 0.15 * np.sin((hours - 9) / 24 * 2 * np.pi)
+    wind_speed = args.mean_wind_speed * rayleigh * diurnal[:, None] * state["site_factor"][None, :]
+
+    direction_steps = rng.normal(0.0, 4.0 * np.sqrt(interval_minutes / 60), size=(periods, turbines))
+    direction = state.get("direction", rng.normal(args.prevailing_direction, 30.0, size=turbines)) + np.cumsum(direction_steps, axis=0)
+    # pull towards the prevailing direction so the walk doesn't drift away
+    direction += (args.prevailing_direction - direction) * 0.01
+    state["direction"] = direction[-1]
+    wind_direction = np.mod(direction, 360.0)
+
+    power_output = power_curve(wind_speed) * rng.normal(1.0, 0.03, size=wind_speed.shape)
+
+    frame = pd.DataFrame({
+        # formatted once per interval instead of once per reading by to_csv
+        "timestamp": np.repeat(timestamps.strftime("%Y-%m-%d %H:%M:%S").to_numpy(), turbines),
+        "turbine_id": np.tile(turbine_ids, periods),
+        "wind_speed": np.round(wind_speed.ravel(), 1),
+        "wind_direction": np.round(wind_direction.ravel()),
+        "power_output": np.round(np.clip(power_output.ravel(), 0.0, None), 1),
+    })
+    rows = len(frame)
+
+    # outliers: spikes of several times the rated power and negative readings
+    outliers = rng.random(rows) < args.outlier_rate
+    frame.loc[outliers, "power_output"] = np.round(rng.choice([-1.0, 1.0], size=outliers.sum()) * rng.uniform(2, 10, size=outliers.sum()) * RATED_POWER, 1)
+
+    # NULLs in any of the measurement columns
+    for column in ["wind_speed", "wind_direction", "power_output"]:
+        frame.loc[rng.random(rows) < args.null_rate, column] = np.nan
+    # whole degrees like the sample CSVs
+    frame["wind_direction"] = frame["wind_direction"].astype("Int64")
+
+    # gaps: single missing readings and outages of a turbine for a few hours
+    keep = rng.random(rows) >= args.gap_rate
+    outage_starts = np.flatnonzero(rng.random(rows) < args.outage_rate)
+    outage_length = max(int(args.outage_hours * 60 / interval_minutes), 1) * turbines
+    for outage_start in outage_starts:
+        # every turbines-th row from the start is the same turbine
+        keep[outage_start:outage_start + outage_length:turbines] = False
+    return frame[keep]
+
+
+def generate_fleet(args):
+    """ Write the CSVs (appending DAYS_PER_CHUNK days at a time), returns the list of files written. """
+    rng = np.random.default_rng(args.seed)
+    os.makedirs(args.output_dir, exist_ok=True)
+    periods_per_day = 24 * 60 // args.interval_minutes
+    start = datetime.strptime(args.start, "%Y-%m-%d")
+    chunk_days = 1 if args.snapshots else DAYS_PER_CHUNK
+
+    turbine_ids = np.arange(1, args.turbines + 1)
+    state = {"site_factor": rng.uniform(0.85, 1.15, size=args.turbines)}
+    files = [os.path.join(args.output_dir, f"{CSV_PREFIX}{number}.csv")
+             for number in range(1, (args.turbines - 1) // args.turbines_per_file + 2)]
+    for file_path in files:
+        pd.DataFrame(columns=COLUMNS).to_csv(file_path, index=False)
+
+    for day in range(0, args.days, chunk_days):
+        days = min(chunk_days, args.days - day)
+        frame = generate_chunk(rng, turbine_ids, start + timedelta(days=day), days * periods_per_day,
+                               args.interval_minutes, state, args)
+        # data_group_1 has turbines 1-5, data_group_2 turbines 6-10, ...
+        file_numbers = (frame["turbine_id"].to_numpy() - 1) // args.turbines_per_file
+        for file_number, file_path in enumerate(files):
+            frame[file_numbers == file_number].to_csv(file_path, mode="a", header=False, index=False)
+
+        if args.snapshots:
+            # the CSVs as delivered at the end of this day (each day appends to the same files)
+            snapshot_dir = os.path.join(args.output_dir, f"snapshot_{day + 1:04d}")
+            os.makedirs(snapshot_dir, exist_ok=True)
+            for file_path in files:
+                shutil.copy(file_path, snapshot_dir)
+    return files
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turbines", type=int, default=15)
+    parser.add_argument("--days", type=int, default=31)
+    parser.add_argument("--interval-minutes", type=int, default=60,
+                        help="minutes between readings, the pipeline expects WIND_TURBINE_READING_INTERVAL_MINUTES (60)")
+    parser.add_argument("--turbines-per-file", type=int, default=5)
+    parser.add_argument("--start", default="2022-03-01", help="first day, YYYY-MM-DD")
+    parser.add_argument("--output-dir", default=os.path.join("benchmarks", "data", "fleet"))
+    parser.add_argument("--mean-wind-speed", type=float, default=8.0)
+    parser.add_argument("--prevailing-direction", type=float, default=225.0)
+    parser.add_argument("--null-rate", type=float, default=0.005, help="share of NULL values per column")
+    parser.add_argument("--outlier-rate", type=float, default=0.002, help="share of outlier power readings")
+    parser.add_argument("--gap-rate", type=float, default=0.002, help="share of missing readings")
+    parser.add_argument("--outage-rate", type=float, default=0.0002, help="outage starts per reading")
+    parser.add_argument("--outage-hours", type=float, default=6.0)
+    parser.add_argument("--snapshots", action="store_true", help="also write snapshot_<day>/ folders of the daily appended CSVs")
+    parser.add_argument("--seed", type=int, default=42)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    started = datetime.now()
+    files = generate_fleet(args)
+    print(f"{len(files)} CSVs for {args.turbines} turbines x {args.days} days written to {args.output_dir} "
+          f"in {(datetime.now() - started).total_seconds():.1f}s")
+
+
+if __name__ == "__main__":
+    main()
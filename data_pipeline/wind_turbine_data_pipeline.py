@@ -14,6 +14,7 @@
     run "install_packages.py" script   
 """
 
+import argparse
 import sys
 import logging
 import os
@@ -26,41 +27,122 @@ sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
 from setup_database import main as setup_database
 from ingest_data import main as ingest_data
 from clean_data import main as clean_data
-from calculate_summary_stats import main as calculate_summary_stats
+from calculate_summary_stats import daily_summary_main, anomalies_summary_main
+from in_memory_pipeline import main as ingest_and_clean_in_memory
+from parquet_export import main as export_parquet
 import config as conf
+from dag import Step, StepResult, run_dag, as_step_result, SUCCESS, FAILED
+import metrics
+import profiling
+import run_ledger
 
-def run_step(step_func, step_name):
-    """Run a pipeline step and handle errors."""
+""" Pipeline DAG - every step declares the tables (and raw data folder) it reads and writes.
+    Steps whose inputs didn't change since their last run are skipped, the daily summary and the
+    anomaly summary only depend on data cleaning and run in parallel.
+"""
+PIPELINE_STEPS = [
+    Step("Database Setup", setup_database),
+    Step("Data Ingestion", ingest_data,
+         inputs=[f"files:{conf.RAW_DATA_FOLDER}"],
+         outputs=[f"table:{conf.RAW_DATA_TABLE}"],
+         depends_on=["Database Setup"]),
+    Step("Data Cleaning", clean_data,
+         inputs=[f"table:{conf.RAW_DATA_TABLE}"],
+         outputs=[f"table:{conf.CLEAN_DATA_TABLE}", f"table:{conf.ANOMALIES_TABLE}"]),
+    Step("Daily Summary Statistics", daily_summary_main,
+         inputs=[f"table:{conf.CLEAN_DATA_TABLE}"],
+         outputs=[f"table:{conf.SUMMARY_STATS_TABLE}", f"table:{conf.ROLLUPS_TABLE}", f"table:{conf.WIND_ROSE_TABLE}",
+                  f"table:{conf.DAILY_DISTRIBUTION_STATS_TABLE}"]),
+    Step("Anomalies Summary Statistics", anomalies_summary_main,
+         inputs=[f"table:{conf.ANOMALIES_TABLE}"],
+         outputs=[f"table:{conf.SUMMARY_ANOMALIES_STATS_TABLE}"]),
+]
+
+""" In-memory mode (WIND_TURBINE_IN_MEMORY=1) - ingestion and cleaning are one step, the ingested rows
+    are cleaned from memory instead of being read back from the raw table.
+"""
+IN_MEMORY_PIPELINE_STEPS = [
+    PIPELINE_STEPS[0],
+    Step("In-Memory Ingestion and Cleaning", ingest_and_clean_in_memory,
+         inputs=[f"files:{conf.RAW_DATA_FOLDER}"],
+         outputs=[f"table:{conf.RAW_DATA_TABLE}", f"table:{conf.CLEAN_DATA_TABLE}", f"table:{conf.ANOMALIES_TABLE}"],
+         depends_on=["Database Setup"]),
+] + PIPELINE_STEPS[3:]
+
+# Parquet export (WIND_TURBINE_PARQUET_EXPORT=1) - the clean data and daily summary partitions changed by the run
+EXPORT_STEP = Step("Parquet Export", export_parquet,
+                   inputs=[f"table:{conf.CLEAN_DATA_TABLE}", f"table:{conf.SUMMARY_STATS_TABLE}"],
+                   outputs=[f"files:{conf.PARQUET_EXPORT_FOLDER}"])
+
+def get_pipeline_steps():
+    steps = IN_MEMORY_PIPELINE_STEPS if conf.IN_MEMORY_PIPELINE else PIPELINE_STEPS
+    return steps + [EXPORT_STEP] if conf.PARQUET_EXPORT else steps
+
+def run_step(step):
+    """Run a pipeline step and handle errors, returns the step's StepResult."""
     try:
-        logging.info(f"Starting: {step_name}")
-        status = step_func()
+        logging.info(f"Starting: {step.name}")
+        # wall time, rows, bytes and the statements run by the step go to the run metrics
+        with metrics.step_metrics(step.name) as step_metrics:
+            result = as_step_result(profiling.wrap_step(step.name, step.func)())
+            step_metrics["status"] = result.status
         
-        if status is None:
-            logging.error(f"Failed: {step_name} returned None")
-            return False 
+        if result.failed:
+            logging.error(f"Failed: {step.name} - {result.status} {result.message}")
+            return result
         
-        logging.info(f"Completed: {step_name}\n")
-        return True
+        # sampled while the step ran, to size the workers (see metrics.step_metrics)
+        logging.info(f"Peak RSS of {step.name}: {step_metrics['peak_rss_mb']} MB "
+                     f"({step_metrics['peak_rss_growth_mb']} MB above its start)")
+        logging.info(f"Completed: {step.name} - {result.status} {result.message} "
+                     f"({step_metrics['wall_time_seconds']:.2f}s, {step_metrics['rows_read']} rows read, "
+                     f"{step_metrics['rows_written']} rows written)\n")
+        return result
     except Exception as e:
-        logging.error(f"Failed: {step_name} - {e}")
-        return False
+        logging.error(f"Failed: {step.name} - {e}")
+        return StepResult(FAILED, str(e))
     
-def main():
-    logging.info("****Starting Wind Turbine Data Pipeline...****\n")
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Wind Turbine Data Pipeline")
+    parser.add_argument("--profile", nargs="+", metavar="STEP",
+                        help='profile these steps, e.g. data_cleaning "Data Ingestion" or all '
+                             '(default: WIND_TURBINE_PROFILE_STEPS)')
+    parser.add_argument("--profiler", choices=profiling.PROFILERS,
+                        help="profiler for the --profile steps (default: WIND_TURBINE_PROFILER or cprofile)")
+    return parser.parse_args(argv)
 
-    if not run_step(setup_database, "Database Setup"):
-        return  # Stop execution if setup fails
+def update_run_ledger(ledger_func, *args):
+    # start / finish the run in the ledger with a connection of its own
+    connection = conf.get_db_connection()
+    try:
+        return ledger_func(connection, *args)
+    finally:
+        if connection:
+            connection.close()
+
+def main(argv=None):
+    args = parse_args(argv)
+    conf.initialize()
+    logging.info("****Starting Wind Turbine Data Pipeline...****\n")
 
-    if not run_step(ingest_data, "Data Ingestion"):
-        return  # Stop execution if ingestion fails
+    profiling.configure(args.profile, args.profiler)
 
-    if not run_step(clean_data, "Data Cleaning"):
-        return  # Stop execution if cleaning fails
+    metrics.reset()
+    # a run interrupted before it finished is resumed, every step continues after its committed work
+    update_run_ledger(run_ledger.start_run)
+    results = run_dag(get_pipeline_steps(), run_step)
+    for step_name, result in results.items():
+        logging.info(f"{step_name}: {result.status} {result.message}")
+        metrics.set_step_status(step_name, result.status)
+    metrics.write_run_metrics()
+    update_run_ledger(run_ledger.finish_run, FAILED if any(result.failed for result in results.values()) else SUCCESS)
 
-    if not run_step(calculate_summary_stats, "Summary Statistics Calculation"):
-        return  # Stop execution if summary stats fail
+    if any(result.failed for result in results.values()):
+        logging.error("****Wind Turbine Data Pipeline failed...****")
+        return results
 
     logging.info("****Wind Turbine Data Pipeline ran successfully...****")
+    return results
 
 if __name__ == "__main__":
     main()
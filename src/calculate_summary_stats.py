@@ -1,9 +1,18 @@
 from mysql.connector import Error
-from numpy import empty
-import pandas as pd
 from datetime import datetime, timedelta
 import logging
 import config as conf
+from change_log import get_pending_change_range, get_changed_days, mark_changes_consumed, purge_consumed_changes
+from watermarks import get_watermark, set_watermark
+from rollups import update_rollups
+from wind_rose import update_wind_rose
+from daily_distribution import update_daily_distribution
+from dag import StepResult, SUCCESS, FAILED
+from run_ledger import record_commit, table_resource
+from turbine_registry import get_turbine_ids
+
+# last clean insertion_date included in the daily summary
+SUMMARY_WATERMARK = "summary_stats:clean_insertion_date"
 
 
 def drop_and_create_summary_table(connection, cursor, turbine_ids):
@@ -78,14 +87,21 @@ def get_anomalies_summary_stats(connection):
     logging.info(f"get_anomalies_summary_stats function called...\n")
     try:
         with connection.cursor() as cursor:
-            # Get distinct turbine IDs
-            cursor.execute(f"SELECT DISTINCT turbine_id FROM {conf.ANOMALIES_TABLE}")
-            turbine_ids = [row[0] for row in cursor.fetchall()]
+            # a column per registered turbine (turbines without anomalies get 0s), no scan of the anomalies table
+            cursor.execute(f"SELECT 1 FROM {conf.ANOMALIES_TABLE} LIMIT 1")
+            if not cursor.fetchall():
+               #print("No anomaly data found. Skipping summary update.")
+                logging.info("No anomaly data found. Skipping summary update.")
+                return True
+
+            # the registry follows its ledger version, turbines just registered by ingestion (any process) are in
+            turbine_ids = get_turbine_ids(connection)
             ##print(f"turbine_ids: {turbine_ids}")
-            
             if not turbine_ids:
-               #print("No anomaly data found. Skipping summary update.")
-                return
+                # registry not filled yet (see backfill_turbine_registry), the turbines of the anomalies instead
+                logging.warning(f"Turbine registry is empty, reading the turbine ids from {conf.ANOMALIES_TABLE}")
+                cursor.execute(f"SELECT DISTINCT turbine_id FROM {conf.ANOMALIES_TABLE} ORDER BY turbine_id")
+                turbine_ids = [row[0] for row in cursor.fetchall()]
 
             """
                 drop existint table and create new.
@@ -95,7 +111,7 @@ def get_anomalies_summary_stats(connection):
             if not drop_and_create_summary_table(connection,cursor, turbine_ids):
                #print(f"drop_and_create_summary_table function failed")
                 logging.error(f"drop_and_create_summary_table function failed")
-                return
+                return False
             
             # Generate dynamic SQL query
             query = generate_summary_stats_query(turbine_ids)
@@ -103,6 +119,7 @@ def get_anomalies_summary_stats(connection):
 
             if query.strip():
                 cursor.execute(query)
+                record_commit(cursor, table_resource(conf.SUMMARY_ANOMALIES_STATS_TABLE), row_count=cursor.rowcount)
                 connection.commit()
                 #print("Anomaly summary inserted successfully.")
                 logging.info("Anomaly summary insertion successful.")
@@ -117,120 +134,213 @@ def get_anomalies_summary_stats(connection):
         logging.error(f"get_anomalies_summary_stats function failed: {e}")
         return False
 
-def calculate_summary_stats(connection):
+def get_day_ranges(days):
+    """ Collapse a list of days into [start, end) datetime ranges of consecutive days,
+        so a set of days can be filtered with a few index range scans on timestamp.
+    """
+    ranges = []
+    for day in sorted(set(days)):
+        day_start = datetime.combine(day, datetime.min.time())
+        if ranges and ranges[-1][1] == day_start:
+            ranges[-1][1] = day_start + timedelta(days=1)
+        else:
+            ranges.append([day_start, day_start + timedelta(days=1)])
+    return [tuple(day_range) for day_range in ranges]
+
+def get_dirty_days(connection):
+    logging.info(f"get_dirty_days function called...\n")
+
+    """ Find the days whose clean data changed since the previous summary run.
+        - clean records inserted (or re-cleaned by late corrections) since the insertion_date watermark
+        - days touched by the change log, a corrected record may have been removed from the clean table
+
+        Returns (days, clean_watermark, change_range), days is None when the summary was never
+        calculated i.e. the whole clean table has to be aggregated once.
+    """
+    prev_watermark = get_watermark(connection, SUMMARY_WATERMARK)
+    change_range = get_pending_change_range(connection, "summary_stats")
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT MAX(insertion_date) FROM {conf.CLEAN_DATA_TABLE}")
+        clean_watermark = cursor.fetchone()[0]
+
+        if prev_watermark is None:
+            logging.info(f"No summary watermark found, aggregating the full {conf.CLEAN_DATA_TABLE} table")
+            return None, clean_watermark, change_range
+
+        """ '>=' as insertion_date has a precision of a second, records inserted in the same second
+            as the watermark are picked up again which is harmless, re-aggregating a day is idempotent.
+        """
+        query = f"""
+            SELECT DISTINCT DATE(timestamp) FROM {conf.CLEAN_DATA_TABLE}
+            WHERE insertion_date >= %s
+        """
+        cursor.execute(query, (prev_watermark,))
+        days = {row[0] for row in cursor.fetchall()}
+
+    if change_range is not None:
+        changed_days = get_changed_days(connection, change_range)
+        if changed_days is None:
+            raise Error("Failed to fetch days from the change log")
+        days.update(changed_days)
+
+    logging.info(f"{len(days)} days to aggregate since watermark {prev_watermark}")
+    return sorted(days), clean_watermark, change_range
+
+def update_summary_stats(connection):
+    logging.info(f"update_summary_stats function called...\n")
+
+    """ Incremental daily summary: only the dirty days are deleted and re-aggregated (daily summary and
+        rollups, wind rose, distribution stats), and the watermark and change log offset are moved in the
+        same transaction. Daily runtime therefore depends on the new data only, not on the years of
+        history kept in the clean table.
+    """
+    try:
+        days, clean_watermark, change_range = get_dirty_days(connection)
+
+        if days is not None and not days and change_range is None:
+            logging.info("No new clean data since the previous summary run.")
+            return True
+
+        with connection.cursor() as cursor:
+            if days is not None:
+                # delete first, so a (day, turbine) without clean records left doesn't keep a stale summary
+                for day_start, day_end in get_day_ranges(days):
+                    cursor.execute(
+                        f"DELETE FROM {conf.SUMMARY_STATS_TABLE} WHERE day >= %s AND day < %s",
+                        (day_start.date(), day_end.date())
+                    )
+
+            if not calculate_summary_stats(connection, days, commit=False):
+                connection.rollback()
+                return False
+
+            # hourly / daily / weekly / monthly rollups, wind rose histogram and distribution stats of the same days
+            day_ranges = None if days is None else get_day_ranges(days)
+            update_rollups(cursor, day_ranges)
+            update_wind_rose(cursor, day_ranges)
+            update_daily_distribution(cursor, day_ranges)
+
+            if clean_watermark is not None:
+                set_watermark(cursor, SUMMARY_WATERMARK, clean_watermark)
+            if change_range is not None:
+                mark_changes_consumed(cursor, "summary_stats", change_range[1])
+            for table_name in (conf.SUMMARY_STATS_TABLE, conf.ROLLUPS_TABLE, conf.WIND_ROSE_TABLE,
+                               conf.DAILY_DISTRIBUTION_STATS_TABLE):
+                record_commit(cursor, table_resource(table_name), clean_watermark)
+            connection.commit()
+            logging.info(f"Summary statistics updated up to clean insertion_date {clean_watermark}")
+
+        return purge_consumed_changes(connection)
+
+    except Error as e:
+        connection.rollback()
+        logging.error(f"update_summary_stats failed: {e}")
+        return False
+
+    except Exception as e:
+        # rollups, wind rose and distribution stats are computed with pandas inside the transaction
+        connection.rollback()
+        logging.error(f"General Error in update_summary_stats: {e}")
+        return False
+
+def calculate_summary_stats(connection, days=None, commit=True):
     logging.info(f"calculate_summary_stats function called...\n")
     try:
-        with connection.cursor(dictionary=True) as cursor:
+        with connection.cursor() as cursor:
 
             """ Calculates summary statistics: For each turbine, calculate the minimum, maximum, and average 
                 power output over a given time period (e.g., 24 hours) 
                 this is calculate per day. 
+
+                Aggregation is done by MySQL (GROUP BY) and written with INSERT ... SELECT, so no clean
+                records are transferred to Python. With days given only those days are aggregated, each
+                range of consecutive days is an index range scan on timestamp.
             """
             
-            query = f"""
-                    SELECT DATE(timestamp) AS day, turbine_id, power_output FROM {conf.CLEAN_DATA_TABLE}
-                """
-            cursor.execute(query)
-            clean_data = cursor.fetchall()
-
-            if not clean_data:
-               #print("No data available in the {conf.CLEAN_DATA_TABLE} table.")
-                return
-            
-            # Convert to DataFrame
-            df = pd.DataFrame(clean_data)
-
-            # Aggregate statistics (Min, Max, Avg Power Output)
-            summary_df = df.groupby(["day", "turbine_id"])["power_output"].agg(
-                min_power_output="min",
-                max_power_output="max",
-                avg_power_output="mean"
-            ).reset_index()
-            
-            # Insert summary stats into the database
             insert_query = f"""
                 INSERT INTO {conf.SUMMARY_STATS_TABLE} (day, turbine_id, min_power_output, max_power_output, avg_power_output)
-                VALUES (%s, %s, %s, %s, %s)
+                SELECT DATE(timestamp) AS day, turbine_id, 
+                    MIN(power_output), MAX(power_output), AVG(power_output)
+                FROM {conf.CLEAN_DATA_TABLE}
+                {{where_clause}}
+                GROUP BY DATE(timestamp), turbine_id
                 ON DUPLICATE KEY UPDATE
                 min_power_output = VALUES(min_power_output),
                 max_power_output = VALUES(max_power_output),
                 avg_power_output = VALUES(avg_power_output)
             """
-            
-            ##print(insert_query)
 
-            summary_records = [
-                (row["day"], row["turbine_id"], row["min_power_output"], row["max_power_output"], row["avg_power_output"])
-                for _, row in summary_df.iterrows()
-            ]
-            
-            # Execute batch insert
-            if summary_records: 
-                cursor.executemany(insert_query, summary_records)
-                connection.commit()
-                logging.info("Summary statistics updated successfully.")
-                return True
+            if days is None:
+                cursor.execute(insert_query.format(where_clause=""))
+                rows_written = cursor.rowcount
             else:
-                logging.warning("No summary records to insert.")
-                return False
-            
-        #print("Summary statistics updated successfully.")
-        return True        
+                rows_written = 0
+                for day_start, day_end in get_day_ranges(days):
+                    cursor.execute(
+                        insert_query.format(where_clause="WHERE timestamp >= %s AND timestamp < %s"),
+                        (day_start, day_end)
+                    )
+                    rows_written += cursor.rowcount
+
+            if commit:
+                connection.commit()
+            logging.info(f"Summary statistics updated successfully ({rows_written} rows affected).")
+            return True
     
     except Exception as e:
        #print(f"calculate_summary_stats failed with Unexpected error: {e}")
         logging.error(f"calculate_summary_stats failed with Unexpected error: {e}")
         return False 
 
-def main():
+def run_summary_step(step_name, step_func):
+    logging.info(f"run_summary_step function called...\n")
 
+    """ Runs one summary step (step_func(connection) -> True / False) with its own DB connection,
+        the daily and anomaly summaries are separate pipeline steps and may run in parallel.
+    """
+    connection = None
     try: 
         # connectint to the db and get db connection handle
-        logging.info(f"Wind Turbine - calculate summary stats starts \n")
-        
-        # get DB connection
-       #print(f"Step 1 - get DB connection\n")
-        logging.info(f"Step 1 - get DB connection")
+        logging.info(f"Wind Turbine - {step_name} starts \n")
         connection = conf.get_db_connection()
 
         if connection is None:
            #print(f"MySQL DB connection failed. \n")     
             logging.error(f"DB Connection failed - check get_db_connection function in config.py")
-            return False
-        else:
-           #print(f"MySQL DB connection is successful. \n")     
-            logging.info(f"MySQL DB connection is successful.")
+            return StepResult(FAILED, "DB connection failed")
 
-       #print(f"Step 2 - calculate summary stats\n")
-        logging.info(f"Step 2 - calculate summary stats")
-        
-        if not calculate_summary_stats(connection):
-           #print("Failed to calculate_summary_stats, aborting...")
-            logging.error("Failed to calculate_summary_stats, aborting...")
-            return False  
-        else:
-           #print(f"calculate_summary_stats is successful \n")
-            logging.info(f"calculate_summary_stats is successful")
+        if not step_func(connection):
+            logging.error(f"Failed to {step_name}, aborting...")
+            return StepResult(FAILED, f"failed to {step_name}")
 
-        if not get_anomalies_summary_stats(connection):
-           #print("Failed to get_anomalies_summary_stats, aborting...")
-            logging.error("Failed to get_anomalies_summary_stats, aborting...")
-            return False  
-        else:
-           #print(f"get_anomalies_summary_stats is successful \n")
-            logging.info(f"get_anomalies_summary_stats is successful")
-
-        return False
+        logging.info(f"{step_name} is successful")
+        return StepResult(SUCCESS)
     except Exception as e:  
-        logging.error(f"calculate_summary_stats - Unexpected error occurred: {e}\n")
-       #print(f"calculate_summary_stats - Unexpected error occurred: {e}")
-        return False
+        logging.error(f"{step_name} - Unexpected error occurred: {e}\n")
+        return StepResult(FAILED, str(e))
     finally:
         if connection:
             connection.close()
             logging.info("DB Connection closed.") 
+
+def daily_summary_main():
+    # daily summary, rollups and wind rose of the dirty days
+    return run_summary_step("calculate summary stats", update_summary_stats)
+
+def anomalies_summary_main():
+    # per turbine anomaly summary table
+    return run_summary_step("get anomalies summary stats", get_anomalies_summary_stats)
+
+def main():
+    # both summaries, one after the other (the pipeline runs them as separate steps)
+    for result in (daily_summary_main(), anomalies_summary_main()):
+        if result.failed:
+            return result
+    return StepResult(SUCCESS)
     
 if __name__ == "__main__":
+    conf.initialize()
     result = main() 
     logging.info(f"Summary Calculation- completed \n")
     
\ No newline at end of file
@@ -0,0 +1,106 @@
+""" Change log of corrected raw records.
+
+    CSVs are re-delivered daily, and a re-delivered row can carry a different value for an already
+    loaded (timestamp, turbine_id). Ingestion records such keys in the change log table and every
+    downstream step (see conf.CHANGE_LOG_CONSUMERS) reads the entries after its own offset, so a
+    correction only costs the changed rows instead of a full rebuild.
+"""
+
+import logging
+from mysql.connector import Error
+import config as conf
+from watermarks import get_watermark, set_watermark
+
+
+def consumer_watermark_name(consumer):
+    return f"change_log:{consumer}"
+
+
+def record_changed_keys(cursor, changed_keys):
+    logging.debug("record_changed_keys function called....")
+
+    """ Store (timestamp, turbine_id) of corrected raw rows.
+        Note - no commit here, keys are saved in the same transaction as the raw data.
+    """
+    if not changed_keys:
+        return
+
+    insert_query = f"""
+        INSERT INTO {conf.CHANGE_LOG_TABLE} (timestamp, turbine_id)
+        VALUES (%s, %s)
+    """
+    cursor.executemany(insert_query, changed_keys)
+    logging.info(f"{len(changed_keys)} corrected records added to {conf.CHANGE_LOG_TABLE}")
+
+
+def get_pending_change_range(connection, consumer):
+    logging.info(f"get_pending_change_range function called....\n")
+
+    """ Returns (last_consumed_id, last_change_id) for the given consumer, i.e. the change log entries
+        with last_consumed_id < id <= last_change_id are still to be processed.
+        Returns None when there is nothing new for the consumer.
+    """
+    try:
+        last_consumed_id = int(get_watermark(connection, consumer_watermark_name(consumer)) or 0)
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT MAX(id) FROM {conf.CHANGE_LOG_TABLE}")
+            last_change_id = cursor.fetchone()[0]
+
+        if last_change_id is None or last_change_id <= last_consumed_id:
+            logging.info(f"No pending changes for {consumer}")
+            return None
+
+        return last_consumed_id, last_change_id
+
+    except Error as e:
+        logging.error(f"Error fetching pending changes for {consumer}: {e}")
+        return None
+
+
+def get_changed_days(connection, change_range):
+    logging.info(f"get_changed_days function called....\n")
+
+    # Days touched by the given range of change log entries.
+    try:
+        with connection.cursor() as cursor:
+            query = f"""
+                SELECT DISTINCT DATE(timestamp) FROM {conf.CHANGE_LOG_TABLE}
+                WHERE id > %s AND id <= %s
+            """
+            cursor.execute(query, change_range)
+            return sorted(row[0] for row in cursor.fetchall())
+
+    except Error as e:
+        logging.error(f"Error fetching changed days: {e}")
+        return None
+
+
+def mark_changes_consumed(cursor, consumer, last_change_id):
+    # no commit, the offset moves in the same transaction as the consumer's output.
+    set_watermark(cursor, consumer_watermark_name(consumer), last_change_id)
+
+
+def purge_consumed_changes(connection):
+    logging.info(f"purge_consumed_changes function called....\n")
+
+    """ Delete change log entries which every consumer has already processed,
+        this keeps the change log table as small as the backlog of corrections.
+    """
+    try:
+        offsets = [int(get_watermark(connection, consumer_watermark_name(consumer)) or 0)
+                   for consumer in conf.CHANGE_LOG_CONSUMERS]
+        min_offset = min(offsets)
+
+        if min_offset == 0:
+            return True
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {conf.CHANGE_LOG_TABLE} WHERE id <= %s", (min_offset,))
+            connection.commit()
+            logging.info(f"Purged {cursor.rowcount} consumed records from {conf.CHANGE_LOG_TABLE}")
+        return True
+
+    except Error as e:
+        logging.error(f"Error purging consumed changes: {e}")
+        return False
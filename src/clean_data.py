@@ -1,17 +1,34 @@
-import pandas as pd
 import mysql.connector
 from mysql.connector import Error
 from datetime import datetime, timedelta
 import logging
 
-# for mode calculation
-from scipy import stats
-from sqlalchemy import false
 import config as conf
+from change_log import get_pending_change_range, mark_changes_consumed
+from db_fetch import fetch_dataframe
+from hot_window import get_window, get_period_data, window_covers
+from log_setup import log_sql
+from memory_mode import get_dtypes
+from run_ledger import record_commit, table_resource
+from stats_kernel import STATS_COLUMNS, frame_stats
+from turbine_state import get_latest_timestamp, update_cleaned_state, update_scored_state
+from watermarks import get_watermark, set_watermark
+
+# last raw table id the clean table was updated up to, moved in the same transaction as the clean rows
+CLEAN_RAW_ID_WATERMARK = "clean_data:raw_id"
+
+# detect_and_store_anomalies result when no anomaly bounds could be computed (no power output or no spread yet),
+# the raw rows are left unscored and must not be cleaned, the clean raw id watermark stays where it is
+NOT_SCORED = "not_scored"
 
 def get_max_timestamp_prev_run(connection, table_name):
     logging.info(f"get_max_timestamp_prev_run function called....\n")
     # Fetch the maximum (latest) timestamp from the clean data table.
+    # latest raw reading from the turbine state table (a row per turbine) instead of scanning the raw table
+    if table_name == conf.RAW_DATA_TABLE:
+        max_timestamp = get_latest_timestamp(connection)
+        if max_timestamp is not None:
+            return max_timestamp
     try:
         with connection.cursor() as cursor:
             query = f"SELECT MAX(timestamp) FROM {table_name};"
@@ -24,98 +41,159 @@ def get_max_timestamp_prev_run(connection, table_name):
         logging.error(f"Error fetching max timestamp: {e}")
         return None  
 
-def detect_and_store_anomalies(connection):
-    logging.info(f"detect_and_store_anomalies function called....\n")
+def get_anomaly_bounds(cursor):
+    logging.info(f"get_anomaly_bounds function called....\n")
 
-    """ Identify and store anomalies and store them in the anomalies table.
-        anomalies : turbines whose output is outside of 2 standard deviations from the mean
+    """ The mean would represent the central value of the data, providing a measure of the typical 
+        power output for all turbines in the dataset.
+        The standard deviation would measure how spread out the values are from the above mean.
+             
+        Also, Check if clean data table exists; if yes, calculate mean and std based on clean data. 
+        If not, fall back to raw data table.
     """
-    try:
+    check_clean_data_query = f"SHOW TABLES LIKE '{conf.CLEAN_DATA_TABLE}'"
+    cursor.execute(check_clean_data_query)
+    clean_data_exists = cursor.fetchone()  
+    #print(f"clean data table exist: {clean_data_exists}\n")
+    if clean_data_exists: 
+        # Check whether clean table has data
+        check_empty_query = f"SELECT COUNT(*) FROM {conf.CLEAN_DATA_TABLE};"
+        cursor.execute(check_empty_query)
+        row_count = cursor.fetchone()[0]
+        #print(f"clean data table row count: {row_count}\n")
+
+    if clean_data_exists and row_count > 0 :
+        query_stats = f"""
+            SELECT AVG(power_output), STD(power_output) FROM {conf.CLEAN_DATA_TABLE};
+        """    
+        logging.info(f"Using {conf.CLEAN_DATA_TABLE} to calculate AVG and STD values")
+    else:    
+        """
+            if the first load of the historical data is out of propotion then we may have to use default values
+            for mean_power and std_power
+            and in that case we may need to modify below code with default standard values.
+        """
+        query_stats = f"""
+            SELECT AVG(power_output), STD(power_output) FROM {conf.RAW_DATA_TABLE};
+        """
+        logging.info(f"Using {conf.RAW_DATA_TABLE} to calculate AVG and STD values")
 
-        # get the max timestamp from the clean data table of previous run.
-        max_timestamp_prev_run = get_max_timestamp_prev_run(connection,conf.CLEAN_DATA_TABLE)
 
-        with connection.cursor() as cursor:
-            
-            """ The mean would represent the central value of the data, providing a measure of the typical 
-                power output for all turbines in the dataset.
-                The standard deviation would measure how spread out the values are from the above mean.
-                     
-                Also, Check if clean data table exists; if yes, calculate mean and std based on clean data. 
-                If not, fall back to raw data table.
-            """
-            check_clean_data_query = f"SHOW TABLES LIKE '{conf.CLEAN_DATA_TABLE}'"
-            cursor.execute(check_clean_data_query)
-            clean_data_exists = cursor.fetchone()  
-            #print(f"clean data table exist: {clean_data_exists}\n")
-            if clean_data_exists: 
-                # Check whether clean table has data
-                check_empty_query = f"SELECT COUNT(*) FROM {conf.CLEAN_DATA_TABLE};"
-                cursor.execute(check_empty_query)
-                row_count = cursor.fetchone()[0]
-                #print(f"clean data table row count: {row_count}\n")
-
-            if clean_data_exists and row_count > 0 :
-                query_stats = f"""
-                    SELECT AVG(power_output), STD(power_output) FROM {conf.CLEAN_DATA_TABLE};
-                """    
-                logging.info(f"Using {conf.CLEAN_DATA_TABLE} to calculate AVG and STD values")
-            else:    
-                """
-                    if the first load of the historical data is out of propotion then we may have to use default values
-                    for mean_power and std_power
-                    and in that case we may need to modify below code with default standard values.
-                """
-                query_stats = f"""
-                    SELECT AVG(power_output), STD(power_output) FROM {conf.RAW_DATA_TABLE};
-                """
-                logging.info(f"Using {conf.RAW_DATA_TABLE} to calculate AVG and STD values")
+    cursor.execute(query_stats)
+    mean_power, std_power = cursor.fetchone()
 
+    #print(f"mean_power: {mean_power} \n")
+    #print(f"std_power: {std_power} \n")
+    logging.info(f"mean_power: {mean_power}")
+    logging.info(f"mean_power: {std_power}")
 
-            cursor.execute(query_stats)
-            mean_power, std_power = cursor.fetchone()
+    if mean_power is None or std_power is None or std_power == 0:
+        #print(f"No data available to compute anomalies or can not calculate it")
+        logging.warning(f"No data available to compute anomalies or can not calculate it")
+        return None
 
-            #print(f"mean_power: {mean_power} \n")
-            #print(f"std_power: {std_power} \n")
-            logging.info(f"mean_power: {mean_power}")
-            logging.info(f"mean_power: {std_power}")
+    """ The below logic is based on the empirical rule (also called the 68-95-99.7 rule) 
+        which states that for a normal distribution:
+            68% of the data lies within 1 standard deviation of the mean.
+            95% of the data lies within 2 standard deviations of the mean.
+            99.7% of the data lies within 3 standard deviations of the mean.
+        Here, as per instructions, we are considering 2 standard deviations
+    """
+    
+    lower_bound = mean_power - 2 * std_power
+    upper_bound = mean_power + 2 * std_power    
 
-            if mean_power is None or std_power is None or std_power == 0:
-                #print(f"No data available to compute anomalies or can not calculate it")
-                logging.warning(f"No data available to compute anomalies or can not calculate it")
-                return
+    #print(f"lower_bound: {lower_bound} \n")
+    #print(f"upper_bound: {upper_bound} \n")
+    logging.info(f"lower_bound: {lower_bound}")
+    logging.info(f"upper_bound: {upper_bound}")
 
-            """ The below logic is based on the empirical rule (also called the 68-95-99.7 rule) 
-                which states that for a normal distribution:
-                    68% of the data lies within 1 standard deviation of the mean.
-                    95% of the data lies within 2 standard deviations of the mean.
-                    99.7% of the data lies within 3 standard deviations of the mean.
-                Here, as per instructions, we are considering 2 standard deviations
-            """
-            
-            lower_bound = mean_power - 2 * std_power
-            upper_bound = mean_power + 2 * std_power    
+    return lower_bound, upper_bound
+
+def get_new_raw_id_range(connection):
+    logging.info(f"get_new_raw_id_range function called....\n")
+
+    """ Returns (last cleaned raw id, max raw id) i.e. the raw rows loaded since the clean table was
+        last updated, None if there are none. A run that died before its clean rows were committed
+        left the watermark where it was, so the next run picks up the same rows again.
+    """
+    last_cleaned_id = int(get_watermark(connection, CLEAN_RAW_ID_WATERMARK) or 0)
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT MAX(id) FROM {conf.RAW_DATA_TABLE}")
+        max_raw_id = cursor.fetchone()[0]
+
+    if max_raw_id is None or max_raw_id <= last_cleaned_id:
+        return None
+    return last_cleaned_id, max_raw_id
 
-            #print(f"lower_bound: {lower_bound} \n")
-            #print(f"upper_bound: {upper_bound} \n")
-            logging.info(f"lower_bound: {lower_bound}")
-            logging.info(f"upper_bound: {upper_bound}")
+def get_range_watermark(raw_id_range, shard=None):
+    # run ledger watermark of a cleaned raw id range, e.g. "raw_id:52000" or "raw_id:52000:shard:1/4"
+    watermark = f"raw_id:{raw_id_range[1]}"
+    return watermark if shard is None else f"{watermark}:shard:{shard[0]}/{shard[1]}"
 
+def get_shard_filter(alias, shard):
+    # SQL condition and params limiting a query to a turbine id shard (index, count), e.g. (1, 4)
+    if shard is None:
+        return "", ()
+    shard_index, shard_count = shard
+    return f" AND {alias}turbine_id MOD %s = %s", (shard_count, shard_index)
+
+def get_row_count(cursor, table_name):
+    cursor.execute(f"SELECT COUNT(*) FROM {table_name};")
+    return cursor.fetchone()[0]
+
+def detect_and_store_anomalies(connection, raw_id_range=None, shard=None, bounds=None):
+    logging.info(f"detect_and_store_anomalies function called....\n")
+
+    """ Identify and store anomalies and store them in the anomalies table.
+        anomalies : turbines whose output is outside of 2 standard deviations from the mean
+        With raw_id_range (see get_new_raw_id_range) only the raw rows of the range are scored,
+        re-scoring a range after a crash is harmless (ON DUPLICATE KEY UPDATE).
+        shard - (index, count) of the turbine id shard to score, see worker.py
+        bounds - (lower, upper) computed once by the caller for all shards of a range, computed here when None
+        Returns True, False on failure or NOT_SCORED when no anomaly bounds could be computed.
+    """
+    try:
+
+        with connection.cursor() as cursor:
+            
+            if bounds is None:
+                bounds = get_anomaly_bounds(cursor)
+            if bounds is None:
+                logging.warning(f"No anomaly bounds, raw rows {raw_id_range} left unscored")
+                return NOT_SCORED
+            lower_bound, upper_bound = bounds
 
             """ Note - 'ON DUPLICATE KEY UPDATE' used to attempt an INSERT operation, 
                 so that if a record already exists with the same unique key, it will update 
                 the existing record instead of inserting a new one
             """
 
-            # Check whether the ANOMALIES_TABLE has records
-            check_anomalies_table_query = f"SELECT COUNT(*) FROM {conf.ANOMALIES_TABLE};"
-            cursor.execute(check_anomalies_table_query)
-            anomalies_table_row_count = cursor.fetchone()[0]
-            logging.info(f"anomalies_table_row_count: {anomalies_table_row_count}")
-            logging.info(f"max_timestamp of previous clean data run: {max_timestamp_prev_run}")
+            if raw_id_range is not None:
+                logging.info(f"Using raw id filter for anomalies data insertion: {raw_id_range} shard {shard}")
+                shard_sql, shard_params = get_shard_filter("", shard)
+                insert_anomalies_query = f"""
+                    INSERT INTO {conf.ANOMALIES_TABLE} (timestamp, turbine_id, wind_speed, wind_direction, power_output)
+                    SELECT timestamp, turbine_id, wind_speed, wind_direction, power_output
+                        FROM {conf.RAW_DATA_TABLE}
+                        WHERE id > %s AND id <= %s AND (power_output < %s OR power_output > %s){shard_sql}
+                        ON DUPLICATE KEY UPDATE 
+                            wind_speed = VALUES(wind_speed),
+                            wind_direction = VALUES(wind_direction),
+                            power_output = VALUES(power_output),
+                            insertion_date = CURRENT_TIMESTAMP;
+                    """
+                cursor.execute(insert_anomalies_query, (raw_id_range[0], raw_id_range[1], lower_bound, upper_bound) + shard_params)
+                record_commit(cursor, table_resource(conf.ANOMALIES_TABLE), get_range_watermark(raw_id_range, shard), cursor.rowcount)
+                update_scored_state(cursor, raw_id_range, bounds, shard)
+                record_commit(cursor, table_resource(conf.TURBINE_STATE_TABLE), get_range_watermark(raw_id_range, shard))
 
-            if anomalies_table_row_count > 0:
+            # Check whether the ANOMALIES_TABLE has records (only needed without a raw id range)
+            elif get_row_count(cursor, conf.ANOMALIES_TABLE) > 0:
                 #Check only latest data in the raw data table. 
+                # get the max timestamp from the clean data table of previous run.
+                max_timestamp_prev_run = get_max_timestamp_prev_run(connection,conf.CLEAN_DATA_TABLE)
+                logging.info(f"max_timestamp of previous clean data run: {max_timestamp_prev_run}")
                 logging.info(f"Using timestamp filter for anomalies data insertion: timestamp > max_timestamp")    
                 insert_anomalies_query = f"""
                     INSERT INTO {conf.ANOMALIES_TABLE} (timestamp, turbine_id, wind_speed, wind_direction, power_output)
@@ -128,7 +206,7 @@ def detect_and_store_anomalies(connection):
                             power_output = VALUES(power_output),
                             insertion_date = CURRENT_TIMESTAMP;
                     """
-                logging.info(f"insert_anomalies_query: {insert_anomalies_query}")
+                log_sql("insert_anomalies_query", insert_anomalies_query, (lower_bound, upper_bound, max_timestamp_prev_run))
                 cursor.execute(insert_anomalies_query, (lower_bound, upper_bound,max_timestamp_prev_run))
 
             else:
@@ -145,7 +223,7 @@ def detect_and_store_anomalies(connection):
                             power_output = VALUES(power_output),
                             insertion_date = CURRENT_TIMESTAMP;
                     """
-                logging.info(f"insert_anomalies_query: {insert_anomalies_query}")
+                log_sql("insert_anomalies_query", insert_anomalies_query, (lower_bound, upper_bound))
                 cursor.execute(insert_anomalies_query, (lower_bound, upper_bound))
             
             connection.commit()
@@ -163,9 +241,11 @@ def get_filtered_data(connection, period_start):
     logging.info(f"get_filtered_data function called....\n")
     
     """FUnction to fetch data from the raw table filtered by the given time period."""
+    import pandas as pd
+
     try:
         
-        with connection.cursor(dictionary=True) as cursor:
+        with connection.cursor() as cursor:
             
             """ Pandas .mean() and .median() handle NaN / Nulls by default, but mode might return an unexpected result.
                 hence filtering NULLs on the raw data
@@ -186,17 +266,15 @@ def get_filtered_data(connection, period_start):
             #print(f"period_start: {period_start} \n")
             logging.info(f"period_start: {period_start}")
 
+            # rows are streamed in batches straight into typed columns (float32 / int32 in memory efficient mode), no dict per row.
+            dtypes = get_dtypes()
+
             if period_start:
                 # data set as per given period
-                cursor.execute(query + " AND r.timestamp >= %s", (period_start,))
+                return fetch_dataframe(cursor, query + " AND r.timestamp >= %s", (period_start,), dtypes)
             else:
                 # full data set
-                cursor.execute(query)
-            
-            filtered_data = cursor.fetchall()
-            
-            # return the dataframe
-            return pd.DataFrame(filtered_data)
+                return fetch_dataframe(cursor, query, dtypes=dtypes)
         
     except Error as e:
         #print(f"Error fetching filtered data from the raw data table: {e}")
@@ -213,30 +291,16 @@ def get_filtered_data(connection, period_start):
 def calculate_statistics(df):
     logging.info(f"calculate_statistics function called....\n")
     
-    # function to calculate stats.
+    """ function to calculate stats.
+        mean, median and mode of wind_speed, wind_direction and power_output by the vectorized kernel
+        in stats_kernel.py (wind_direction mean is the circular mean).
+    """
     try:
-        # Calculate mean, median, and mode for wind_speed, wind_direction, and power_output.
-        stats_dict = {}
         # empty df won't be sent however this is for future reference
         if df.empty:
-            return {
-                "wind_speed": {"mean": None, "median": None, "mode": None},
-                "wind_direction": {"mean": None, "median": None, "mode": None},
-                "power_output": {"mean": None, "median": None, "mode": None}
-            }
-
-        for col in ["wind_speed", "wind_direction", "power_output"]:
-            # check whether mode value is valid
-            mode_result = stats.mode(df[col].dropna(), keepdims=True)
-            mode_value = mode_result.mode.tolist()[0] if mode_result.count[0] > 0 else None
-            
-            stats_dict[col] = {
-                "mean": df[col].mean(),
-                "median": df[col].median(),
-                "mode": mode_value
-            }
+            return {col: {"mean": None, "median": None, "mode": None} for col in STATS_COLUMNS}
 
-        return stats_dict
+        return frame_stats(df)
     
     except Exception as e:
         #print(f"calculate_statistics failed with Unexpected error: {e}")
@@ -244,7 +308,6 @@ def calculate_statistics(df):
         # returning empty dict
         return None
 
-
 def store_statistics(connection, period_name, stats_dict):
     
     logging.info(f"store_statistics function called....\n")
@@ -285,11 +348,14 @@ def store_statistics(connection, period_name, stats_dict):
         logging.error(f"Error inserting statistics: {e}")
         return False
 
-def process_statistics(connection):
+def process_statistics(connection, raw_id_range=None):
     
     logging.info(f"process_stat function called....\n")
 
-    """Function to calculate and store statistics for different periods."""
+    """ Function to calculate and store statistics for different periods.
+        raw_id_range - the raw rows just scored for anomalies, with the hot window cache enabled
+        (hot_window.py) the recent periods are read from the cache, brought up to the end of the range.
+    """
     try:
         # get the max timestamp from the raw data table.
         max_timestamp = get_max_timestamp_prev_run(connection,conf.RAW_DATA_TABLE)
@@ -311,13 +377,20 @@ def process_statistics(connection):
             "last_1_day": max_timestamp - timedelta(days=1)
         }
 
+        window = None
+        if conf.HOT_WINDOW_CACHE and raw_id_range is not None:
+            window = get_window(connection, max_timestamp, raw_id_range[1])
+
         for period_name, period_start in periods.items():
             #print(f"Processing statistics for: {period_name}")
             
             # get the filtered data for the given period 
             #print(f"Getting the filtered data for : {period_name}")
             
-            df = get_filtered_data(connection, period_start)
+            if window is not None and window_covers(max_timestamp, period_start):
+                df = get_period_data(window, period_start)
+            else:
+                df = get_filtered_data(connection, period_start)
 
             if not df.empty:
                 stats_dict = calculate_statistics(df)
@@ -333,61 +406,83 @@ def process_statistics(connection):
         #print(f"Error processing statistics: {e}")
         return False
 
-def update_clean_table(connection):
-    
-    logging.info(f"update_clean_table function called....\n")
+def get_imputed_columns_sql(alias):
+    """ SQL for the cleaned wind_speed, wind_direction and power_output columns of the raw table 
+        (with the given alias) i.e. missing values replaced by the stats of conf.PERIOD_FOR_STATS.
 
-    """Create a clean data table by imputing missing values and removing outliers"""
-    try:
-        with connection.cursor() as cursor:
-            
-            """
-                using INSERT IGNORE, to ensure no duplicates are inserted and only new records
-                will be applied.
-
-                Using median for wind_speed 
-                Using median for wind_direction
-                Using mean for power_output 
-
-                Also, assumption is anomalies table would be smaller in size hence used 'WHERE NOT EXISTS'
-                else Left Join can be used.
-            """
-
-            query = f"""
-            INSERT IGNORE INTO {conf.CLEAN_DATA_TABLE} (timestamp, turbine_id, wind_speed, wind_direction, power_output)
-            SELECT 
-                timestamp, turbine_id, 
-                COALESCE(wind_speed, (
+        Using median for wind_speed 
+        Using median for wind_direction
+        Using mean for power_output 
+    """
+    return f"""COALESCE({alias}.wind_speed, (
                     SELECT wind_speed_median 
                     FROM {conf.MMM_TABLE} 
                     WHERE period= '{conf.PERIOD_FOR_STATS}'
                     ORDER BY calculation_timestamp DESC 
                     LIMIT 1
                     )),  
-                COALESCE(wind_direction, (
+                COALESCE({alias}.wind_direction, (
                     SELECT wind_direction_median 
                     FROM {conf.MMM_TABLE} 
                     WHERE period= '{conf.PERIOD_FOR_STATS}'
                     ORDER BY calculation_timestamp DESC 
                     LIMIT 1
                     )),  
-                COALESCE(power_output, (
+                COALESCE({alias}.power_output, (
                     SELECT power_output_mean 
                     FROM {conf.MMM_TABLE} 
                     WHERE period= '{conf.PERIOD_FOR_STATS}'
                     ORDER BY calculation_timestamp DESC 
                     LIMIT 1
-                    ))     
+                    ))"""
+
+def update_clean_table(connection, raw_id_range=None, shard=None):
+    
+    logging.info(f"update_clean_table function called....\n")
+
+    """Create a clean data table by imputing missing values and removing outliers
+        With raw_id_range (see get_new_raw_id_range) only the raw rows of the range are cleaned and the
+        raw id watermark and run ledger row are committed together with them.
+        With a turbine id shard (index, count) only the shard's rows are cleaned and the watermark is
+        left to the caller, it can only move once every shard of the range is cleaned (see worker.py).
+    """
+    try:
+        with connection.cursor() as cursor:
+            
+            """
+                using INSERT IGNORE, to ensure no duplicates are inserted and only new records
+                will be applied. Corrections of already cleaned records are handled by 
+                apply_late_corrections.
+
+                Also, assumption is anomalies table would be smaller in size hence used 'WHERE NOT EXISTS'
+                else Left Join can be used.
+            """
+
+            shard_sql, shard_params = get_shard_filter("r.", shard if raw_id_range is not None else None)
+            query = f"""
+            INSERT IGNORE INTO {conf.CLEAN_DATA_TABLE} (timestamp, turbine_id, wind_speed, wind_direction, power_output)
+            SELECT 
+                r.timestamp, r.turbine_id, 
+                {get_imputed_columns_sql("r")}
             FROM {conf.RAW_DATA_TABLE} r
             WHERE NOT EXISTS (
                 SELECT 1 FROM {conf.ANOMALIES_TABLE} o
                 WHERE r.timestamp = o.timestamp
                 AND r.turbine_id = o.turbine_id
-            );
+            ){" AND r.id > %s AND r.id <= %s" if raw_id_range is not None else ""}{shard_sql};
             """
 
-            logging.info(f"update_clean_table query: {query}")
-            cursor.execute(query)
+            log_sql("update_clean_table query", query, raw_id_range)
+            if raw_id_range is None:
+                cursor.execute(query)
+            else:
+                cursor.execute(query, tuple(raw_id_range) + shard_params)
+                rows_cleaned = cursor.rowcount
+                if shard is None:
+                    set_watermark(cursor, CLEAN_RAW_ID_WATERMARK, raw_id_range[1])
+                record_commit(cursor, table_resource(conf.CLEAN_DATA_TABLE), get_range_watermark(raw_id_range, shard), rows_cleaned)
+                update_cleaned_state(cursor, raw_id_range, shard)
+                record_commit(cursor, table_resource(conf.TURBINE_STATE_TABLE), get_range_watermark(raw_id_range, shard))
             connection.commit()
             #print(f"Clean data updated successfully")
             logging.info(f"Clean data updated successfully")
@@ -404,6 +499,106 @@ def update_clean_table(connection):
         logging.error(f"General Error updating clean table: {e}")
         return False
 
+def refresh_hot_window(connection):
+    # the corrected rows of the window may have other values / verdicts now, rebuilt up to the cleaned raw rows
+    max_timestamp = get_max_timestamp_prev_run(connection, conf.RAW_DATA_TABLE)
+    if max_timestamp is not None:
+        get_window(connection, max_timestamp, int(get_watermark(connection, CLEAN_RAW_ID_WATERMARK) or 0))
+
+def apply_late_corrections(connection):
+
+    logging.info(f"apply_late_corrections function called....\n")
+
+    """ Re-score and re-clean raw records corrected by a re-delivered CSV.
+        update_clean_table only inserts new records (INSERT IGNORE), hence the keys recorded in the
+        change log since the previous run are processed here:
+            - previous anomaly verdict for the key is dropped and the corrected value re-scored
+            - clean record is removed if the corrected value is an anomaly now
+            - otherwise clean record is re-imputed and overwritten
+        Every statement joins on the pending change log range, so cost is O(changed rows).
+        Returns True, False on failure or NOT_SCORED when no anomaly bounds could be computed - the
+        corrections are then left pending (nothing deleted, the offset not moved) for a later run.
+    """
+    try:
+        change_range = get_pending_change_range(connection, "clean_data")
+        if change_range is None:
+            return True
+        first_change_id, last_change_id = change_range
+
+        with connection.cursor() as cursor:
+            bounds = get_anomaly_bounds(cursor)
+        if bounds is None:
+            # as detect_and_store_anomalies - an unscored correction isn't cleaned
+            logging.warning(f"No anomaly bounds, corrections (change log ids {first_change_id + 1} to {last_change_id}) left pending")
+            return NOT_SCORED
+        lower_bound, upper_bound = bounds
+
+        # distinct keys of the pending corrections, a key can be corrected more than once.
+        changed_keys_sql = f"""
+            (SELECT DISTINCT timestamp, turbine_id FROM {conf.CHANGE_LOG_TABLE}
+                WHERE id > %s AND id <= %s)
+        """
+
+        with connection.cursor() as cursor:
+            delete_anomalies_query = f"""
+                DELETE a FROM {conf.ANOMALIES_TABLE} a
+                JOIN {changed_keys_sql} c ON a.timestamp = c.timestamp AND a.turbine_id = c.turbine_id
+            """
+            cursor.execute(delete_anomalies_query, change_range)
+
+            insert_anomalies_query = f"""
+                INSERT INTO {conf.ANOMALIES_TABLE} (timestamp, turbine_id, wind_speed, wind_direction, power_output)
+                SELECT r.timestamp, r.turbine_id, r.wind_speed, r.wind_direction, r.power_output
+                    FROM {conf.RAW_DATA_TABLE} r
+                    JOIN {changed_keys_sql} c ON r.timestamp = c.timestamp AND r.turbine_id = c.turbine_id
+                    WHERE r.power_output < %s OR r.power_output > %s
+            """
+            cursor.execute(insert_anomalies_query, (first_change_id, last_change_id, lower_bound, upper_bound))
+
+            delete_clean_query = f"""
+                DELETE cl FROM {conf.CLEAN_DATA_TABLE} cl
+                JOIN {changed_keys_sql} c ON cl.timestamp = c.timestamp AND cl.turbine_id = c.turbine_id
+                JOIN {conf.ANOMALIES_TABLE} a ON cl.timestamp = a.timestamp AND cl.turbine_id = a.turbine_id
+            """
+            cursor.execute(delete_clean_query, change_range)
+
+            # insertion_date is refreshed so the corrected records look like newly cleaned ones.
+            upsert_clean_query = f"""
+                INSERT INTO {conf.CLEAN_DATA_TABLE} (timestamp, turbine_id, wind_speed, wind_direction, power_output)
+                SELECT 
+                    r.timestamp, r.turbine_id, 
+                    {get_imputed_columns_sql("r")}
+                FROM {conf.RAW_DATA_TABLE} r
+                JOIN {changed_keys_sql} c ON r.timestamp = c.timestamp AND r.turbine_id = c.turbine_id
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {conf.ANOMALIES_TABLE} o
+                    WHERE r.timestamp = o.timestamp
+                    AND r.turbine_id = o.turbine_id
+                )
+                ON DUPLICATE KEY UPDATE 
+                    wind_speed = VALUES(wind_speed),
+                    wind_direction = VALUES(wind_direction),
+                    power_output = VALUES(power_output),
+                    insertion_date = CURRENT_TIMESTAMP;
+            """
+            cursor.execute(upsert_clean_query, change_range)
+
+            mark_changes_consumed(cursor, "clean_data", last_change_id)
+            for table_name in (conf.ANOMALIES_TABLE, conf.CLEAN_DATA_TABLE):
+                record_commit(cursor, table_resource(table_name), f"change_log:{last_change_id}")
+            connection.commit()
+            logging.info(f"Late corrections (change log ids {first_change_id + 1} to {last_change_id}) applied")
+
+        if conf.HOT_WINDOW_CACHE:
+            refresh_hot_window(connection)
+
+        return True
+
+    except Error as e:
+        connection.rollback()
+        logging.error(f"Error applying late corrections: {e}")
+        return False
+
 def main():
     try:
         # connectint to the db and get db connection handle
@@ -422,6 +617,11 @@ def main():
             #print(f"MySQL DB connection is successful. \n")     
             logging.info(f"MySQL DB connection is successful.")
             
+        # raw rows loaded since the previous (or interrupted) cleaning run
+        raw_id_range = get_new_raw_id_range(connection)
+        if raw_id_range is None:
+            logging.info(f"No new raw rows since the previous cleaning run, skipping steps 2 to 4")
+
         """ 
             Start data cleaning process.....
             First, identify and store outliers / anomalies: turbines whose output is outside of 2 
@@ -430,10 +630,15 @@ def main():
 
         #print(f"Step 2 - Detect & Store anomalies \n")
         logging.info(f"Step 2 - Detect & Store anomalies")
-        if not detect_and_store_anomalies(connection):
+        scored = detect_and_store_anomalies(connection, raw_id_range) if raw_id_range is not None else None
+        if scored is False:
             #print("Failed to identify and store anomalies, aborting...")
             logging.error("Failed to identify and store anomalies, aborting...")
             return False  
+        if scored == NOT_SCORED:
+            # unscored rows aren't cleaned, they are scored and cleaned by a run that can compute the bounds
+            logging.warning(f"Raw rows {raw_id_range} not scored, skipping steps 3 and 4")
+            raw_id_range = None
         
         """
             It is not clear which period should we use to fix the missing or outlier data, i.e. 
@@ -443,7 +648,7 @@ def main():
         """
         #print(f"Step 3 - Process Statistics i.e. process and store stats for different period \n")
         logging.info(f"Step 3 - Process Statistics i.e. process and store stats for different period")
-        if not process_statistics(connection):
+        if raw_id_range is not None and not process_statistics(connection, raw_id_range):
             #print("Failed to process statistic, aborting...")
             logging.error("Failed to process statistic, aborting...")
             return False  
@@ -451,10 +656,16 @@ def main():
         # update clean table
         #print(f"Step 4 - Update clean data table for missing values and removing outliers")
         logging.info(f"Step 4 - Update clean data table for missing values")
-        if not update_clean_table(connection):
+        if raw_id_range is not None and not update_clean_table(connection, raw_id_range):
             #print("Failed to update clean data, aborting...")
             logging.error("Failed to update clean data, aborting...")
             return False  
+
+        # re-clean records corrected since the previous run
+        logging.info(f"Step 5 - Apply late corrections from the change log")
+        if not apply_late_corrections(connection):
+            logging.error("Failed to apply late corrections, aborting...")
+            return False  
         
         # we will call from Data Pipeline hence included return here.
         return True
@@ -469,5 +680,6 @@ def main():
             logging.info("DB Connection closed.") 
 
 if __name__ == "__main__":
+    conf.initialize()
     result = main() 
     logging.info(f"Data Cleansing - completed \n")
\ No newline at end of file
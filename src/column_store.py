@@ -0,0 +1,297 @@
+""" Column store (conf.COLUMN_STORE) - a local, export-only copy of the ingested readings for fast range
+    scans by analysis code (notebooks, ad hoc scripts). No pipeline step reads it, the pipeline's
+    aggregations run in MySQL.
+
+    Every turbine has a folder of append-only column files, one fixed width NumPy array per column in
+    timestamp order, plus a sparse time index (every conf.COLUMN_STORE_INDEX_STRIDE-th timestamp):
+
+        <conf.COLUMN_STORE_FOLDER>/turbine_1/timestamp.bin        datetime64[us]
+        <conf.COLUMN_STORE_FOLDER>/turbine_1/wind_speed.bin       float32 (NaN for a missing value)
+        <conf.COLUMN_STORE_FOLDER>/turbine_1/wind_direction.bin   float32
+        <conf.COLUMN_STORE_FOLDER>/turbine_1/power_output.bin     float32
+        <conf.COLUMN_STORE_FOLDER>/turbine_1/timestamp.idx        datetime64[us], sparse index
+
+    The files are memory-mapped: a time range is found with a binary search of the sparse index and
+    then of one index block, and read_range returns views of the mapped files - no copy, no driver,
+    only the pages of the range are read.
+
+    The store is synced from the raw table after ingestion has committed (sync_from_database): the raw
+    rows not cleaned yet and the corrected records not yet consumed by clean_data, so a batch that was
+    rolled back never reaches the store and in work-queue mode the coordinator's store gets the files
+    every worker ingested. The value columns are written before the timestamp column, whose length is
+    the row count, so a reader or an append interrupted half way never sees a partial row. A re-delivered reading overwrites
+    its row in place and a reading older than the turbine's latest one (rare) rewrites the turbine's
+    files, so a retried batch leaves the store as it was. The store is a derived copy of the raw table,
+    python src/column_store.py --rebuild recreates it (e.g. when it is enabled on an existing database).
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import threading
+
+import numpy as np
+import config as conf
+
+TIMESTAMP_DTYPE = np.dtype("datetime64[us]")
+VALUE_COLUMNS = ("wind_speed", "wind_direction", "power_output")
+VALUE_DTYPE = np.dtype("float32")
+INDEX_FILE = "timestamp.idx"
+TURBINE_FOLDER_PREFIX = "turbine_"
+
+
+class ColumnStore:
+
+    def __init__(self, folder):
+        self.folder = folder
+        # appends and rewrites of a process are serialized, readers don't lock
+        self.lock = threading.Lock()
+
+    def get_turbine_folder(self, turbine_id):
+        return os.path.join(self.folder, f"{TURBINE_FOLDER_PREFIX}{turbine_id}")
+
+    def get_path(self, turbine_id, column):
+        return os.path.join(self.get_turbine_folder(turbine_id), f"{column}.bin")
+
+    def turbine_ids(self):
+        if not os.path.isdir(self.folder):
+            return []
+        turbine_ids = [name[len(TURBINE_FOLDER_PREFIX):] for name in os.listdir(self.folder) if name.startswith(TURBINE_FOLDER_PREFIX)]
+        return sorted(int(turbine_id) for turbine_id in turbine_ids if turbine_id.isdigit())
+
+    def get_row_count(self, turbine_id):
+        path = self.get_path(turbine_id, "timestamp")
+        return os.path.getsize(path) // TIMESTAMP_DTYPE.itemsize if os.path.exists(path) else 0
+
+    def map_column(self, turbine_id, column, rows, mode="r"):
+        # the first rows of a column file, memory-mapped (an empty file can't be mapped)
+        dtype = TIMESTAMP_DTYPE if column == "timestamp" else VALUE_DTYPE
+        if rows == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self.get_path(turbine_id, column), dtype=dtype, mode=mode, shape=(rows,))
+
+    def open_columns(self, turbine_id, mode="r"):
+        rows = self.get_row_count(turbine_id)
+        return {column: self.map_column(turbine_id, column, rows, mode) for column in ("timestamp",) + VALUE_COLUMNS}
+
+    def get_index(self, turbine_id):
+        path = os.path.join(self.get_turbine_folder(turbine_id), INDEX_FILE)
+        return np.fromfile(path, dtype=TIMESTAMP_DTYPE) if os.path.exists(path) else np.empty(0, dtype=TIMESTAMP_DTYPE)
+
+    def search(self, turbine_id, timestamps, value, side="left"):
+        # position of value in the turbine's timestamps: the sparse index narrows it to one block
+        stride = conf.COLUMN_STORE_INDEX_STRIDE
+        index = self.get_index(turbine_id)
+        block = int(np.searchsorted(index, value, side))
+        low = max(block - 1, 0) * stride
+        high = len(timestamps) if block >= len(index) else min(block * stride, len(timestamps))
+        return low + int(np.searchsorted(timestamps[low:high], value, side))
+
+    def read_range(self, turbine_id, start=None, end=None):
+        """ Readings of a turbine in [start, end) as a dict of column name -> array, views of the
+            memory-mapped files (valid while the store isn't rewritten, copy them to keep them).
+        """
+        columns = self.open_columns(turbine_id)
+        timestamps = columns["timestamp"]
+        first = 0 if start is None else self.search(turbine_id, timestamps, np.datetime64(start, "us"))
+        last = len(timestamps) if end is None else self.search(turbine_id, timestamps, np.datetime64(end, "us"))
+        return {column: values[first:last] for column, values in columns.items()}
+
+    def repair(self, turbine_id):
+        # drop the values of a partial row and complete the index of rows left by an interrupted append
+        rows = self.get_row_count(turbine_id)
+        for column in VALUE_COLUMNS:
+            path = self.get_path(turbine_id, column)
+            if os.path.exists(path) and os.path.getsize(path) > rows * VALUE_DTYPE.itemsize:
+                os.truncate(path, rows * VALUE_DTYPE.itemsize)
+
+        # a short index only widens the last search block, but later entries have to line up
+        stride = conf.COLUMN_STORE_INDEX_STRIDE
+        index_entries = len(self.get_index(turbine_id))
+        if index_entries * stride < rows:
+            timestamps = self.map_column(turbine_id, "timestamp", rows)
+            self.write_index(turbine_id, timestamps[index_entries * stride:], index_entries * stride)
+        return rows
+
+    def write_index(self, turbine_id, timestamps, first_row):
+        # sparse index entries (rows at multiples of the stride) of timestamps appended at first_row
+        stride = conf.COLUMN_STORE_INDEX_STRIDE
+        with open(os.path.join(self.get_turbine_folder(turbine_id), INDEX_FILE), "ab") as index_file:
+            index_file.write(np.ascontiguousarray(timestamps[-first_row % stride::stride]).tobytes())
+
+    def append_rows(self, turbine_id, values, first_row):
+        # values first, the timestamps last - they make the rows visible
+        for column in VALUE_COLUMNS:
+            with open(self.get_path(turbine_id, column), "ab") as column_file:
+                column_file.write(values[column].tobytes())
+        with open(self.get_path(turbine_id, "timestamp"), "ab") as column_file:
+            column_file.write(values["timestamp"].tobytes())
+        self.write_index(turbine_id, values["timestamp"], first_row)
+
+    def rewrite(self, turbine_id, values):
+        # the turbine's files from sorted values, written aside and swapped in
+        folder = self.get_turbine_folder(turbine_id)
+        new_store = ColumnStore(f"{self.folder}.rewrite")
+        shutil.rmtree(new_store.get_turbine_folder(turbine_id), ignore_errors=True)
+        os.makedirs(new_store.get_turbine_folder(turbine_id))
+        new_store.append_rows(turbine_id, values, 0)
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(new_store.get_turbine_folder(turbine_id), folder)
+        shutil.rmtree(new_store.folder, ignore_errors=True)
+
+    def append_turbine(self, turbine_id, values):
+        # values - sorted by timestamp, one row per timestamp
+        os.makedirs(self.get_turbine_folder(turbine_id), exist_ok=True)
+        rows = self.repair(turbine_id)
+        stored = self.open_columns(turbine_id, "r+")
+        new_rows = values["timestamp"] > stored["timestamp"][-1] if rows else np.ones(len(values["timestamp"]), dtype=bool)
+
+        if not new_rows.all():
+            timestamps = values["timestamp"][~new_rows]
+            positions = np.searchsorted(stored["timestamp"], timestamps)
+            if (stored["timestamp"][positions] == timestamps).all():
+                # re-delivered readings, overwritten in place
+                for column in VALUE_COLUMNS:
+                    stored[column][positions] = values[column][~new_rows]
+                    stored[column].flush()
+            else:
+                # readings older than the latest one, merged into a rewrite of the turbine's files
+                merged = {column: np.concatenate([np.asarray(stored[column]), values[column]]) for column in stored}
+                order = np.argsort(merged["timestamp"], kind="stable")
+                merged = {column: array[order] for column, array in merged.items()}
+                keep = np.append(merged["timestamp"][1:] != merged["timestamp"][:-1], True)
+                del stored
+                self.rewrite(turbine_id, {column: array[keep] for column, array in merged.items()})
+                return
+        del stored
+        self.append_rows(turbine_id, {column: array[new_rows] for column, array in values.items()}, rows)
+
+    def append(self, frame):
+        """ Add a batch of readings (DataFrame with timestamp, turbine_id and the value columns),
+            rows without a timestamp or turbine id are skipped. Returns the number of rows added / updated.
+        """
+        valid = frame.dropna(subset=["timestamp", "turbine_id"]).sort_values("timestamp", kind="stable")
+        # the last reading of a repeated key wins, as in the raw table's upsert
+        valid = valid.drop_duplicates(subset=["timestamp", "turbine_id"], keep="last")
+        with self.lock:
+            for turbine_id, rows in valid.groupby("turbine_id"):
+                values = {"timestamp": rows["timestamp"].to_numpy(dtype=TIMESTAMP_DTYPE)}
+                values.update({column: rows[column].to_numpy(dtype=VALUE_DTYPE, na_value=np.nan) for column in VALUE_COLUMNS})
+                self.append_turbine(int(turbine_id), values)
+        return len(valid)
+
+
+_store = {"store": None}
+_store_lock = threading.Lock()
+
+
+def get_store():
+    # the process' store of conf.COLUMN_STORE_FOLDER
+    with _store_lock:
+        if _store["store"] is None or _store["store"].folder != conf.COLUMN_STORE_FOLDER:
+            _store["store"] = ColumnStore(conf.COLUMN_STORE_FOLDER)
+        return _store["store"]
+
+
+def sync_from_database(connection):
+    logging.info(f"sync_from_database function called....\n")
+
+    """ Append the committed raw rows after the clean raw id watermark and the raw rows of the change
+        log entries clean_data hasn't consumed yet, i.e. what the ingestion of this run (or of an
+        interrupted one) loaded or corrected. Called after ingestion, callers import this module only
+        when conf.COLUMN_STORE is on (numpy stays unloaded otherwise). Appending a row again overwrites
+        it in place, so syncing the same rows twice is harmless. Returns the number of rows written.
+    """
+    import pandas as pd
+    from change_log import consumer_watermark_name
+    from clean_data import CLEAN_RAW_ID_WATERMARK
+    from db_fetch import fetch_batches
+    from watermarks import get_watermark
+
+    last_cleaned_id = int(get_watermark(connection, CLEAN_RAW_ID_WATERMARK) or 0)
+    last_consumed_id = int(get_watermark(connection, consumer_watermark_name("clean_data")) or 0)
+    queries = [
+        (f"""
+            SELECT timestamp, turbine_id, wind_speed, wind_direction, power_output
+            FROM {conf.RAW_DATA_TABLE}
+            WHERE id > %s
+        """, (last_cleaned_id,)),
+        (f"""
+            SELECT r.timestamp, r.turbine_id, r.wind_speed, r.wind_direction, r.power_output
+            FROM {conf.RAW_DATA_TABLE} r
+            JOIN (SELECT DISTINCT timestamp, turbine_id FROM {conf.CHANGE_LOG_TABLE} WHERE id > %s) c
+                ON r.timestamp = c.timestamp AND r.turbine_id = c.turbine_id
+            WHERE r.id <= %s
+        """, (last_consumed_id, last_cleaned_id)),
+    ]
+    dtypes = {"timestamp": TIMESTAMP_DTYPE, "turbine_id": np.int64,
+              "wind_speed": VALUE_DTYPE, "wind_direction": VALUE_DTYPE, "power_output": VALUE_DTYPE}
+    store = get_store()
+    rows = 0
+    with connection.cursor() as cursor:
+        for query, params in queries:
+            for batch in fetch_batches(cursor, query, params, dtypes=dtypes):
+                rows += store.append(pd.DataFrame(batch, copy=False))
+
+    logging.info(f"Column store synced from {conf.RAW_DATA_TABLE}: {rows} rows")
+    return rows
+
+
+def rebuild_from_database(connection):
+    logging.info(f"rebuild_from_database function called....\n")
+
+    """ Recreate the store from the raw table, streamed turbine by turbine in timestamp order.
+        Returns the number of rows written.
+    """
+    import pandas as pd
+    from db_fetch import fetch_batches
+
+    store = ColumnStore(f"{conf.COLUMN_STORE_FOLDER}.rebuild")
+    shutil.rmtree(store.folder, ignore_errors=True)
+    query = f"""
+        SELECT timestamp, turbine_id, wind_speed, wind_direction, power_output
+        FROM {conf.RAW_DATA_TABLE}
+        ORDER BY turbine_id, timestamp
+    """
+    dtypes = {"timestamp": TIMESTAMP_DTYPE, "turbine_id": np.int64,
+              "wind_speed": VALUE_DTYPE, "wind_direction": VALUE_DTYPE, "power_output": VALUE_DTYPE}
+    rows = 0
+    with connection.cursor() as cursor:
+        for batch in fetch_batches(cursor, query, dtypes=dtypes):
+            rows += store.append(pd.DataFrame(batch, copy=False))
+
+    shutil.rmtree(conf.COLUMN_STORE_FOLDER, ignore_errors=True)
+    os.makedirs(store.folder, exist_ok=True)
+    os.replace(store.folder, conf.COLUMN_STORE_FOLDER)
+    logging.info(f"Column store rebuilt from {conf.RAW_DATA_TABLE}: {rows} rows")
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rebuild", action="store_true", help=f"recreate the store from {conf.RAW_DATA_TABLE}")
+    args = parser.parse_args(argv)
+    conf.initialize()
+
+    store = get_store()
+    if args.rebuild:
+        connection = conf.get_db_connection()
+        if connection is None:
+            logging.error(f"DB Connection failed - check get_db_connection function in config.py")
+            return False
+        try:
+            rebuild_from_database(connection)
+        finally:
+            connection.close()
+
+    for turbine_id in store.turbine_ids():
+        columns = store.read_range(turbine_id)
+        timestamps = columns["timestamp"]
+        print(f"turbine {turbine_id}: {len(timestamps)} readings"
+              + (f" from {timestamps[0]} to {timestamps[-1]}" if len(timestamps) else ""))
+    return True
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,12 @@ from datetime import datetime
 import logging
 import os
 
-import mysql
-
 # Database Credentials
 DB_HOST = "localhost"
 DB_PORT = 3306
 DB_USER = "milind"  # Replace with your MySQL username
 DB_PASSWORD = "Arnav@123"  # Replace with your MySQL password
-DB_NAME = "wind_turbine_db"
+DB_NAME = os.environ.get("WIND_TURBINE_DB_NAME", "wind_turbine_db")  # e.g. a separate database for benchmarks
 
 # Source Data CSV Prefix
 SOURCE_DATA_CSV_PREFIX = "data_group_"
@@ -22,6 +20,115 @@ MMM_TABLE = "wind_turbine_mean_median_mode_stats"
 CLEAN_DATA_TABLE = "wind_turbine_clean_data"
 SUMMARY_STATS_TABLE = "wind_turbine_summary_stats"
 SUMMARY_ANOMALIES_STATS_TABLE = "wind_turbine_anomalies_summary_stats"
+CHANGE_LOG_TABLE = "wind_turbine_change_log"
+WATERMARKS_TABLE = "wind_turbine_watermarks"
+ROLLUPS_TABLE = "wind_turbine_power_rollups"
+WIND_ROSE_TABLE = "wind_turbine_wind_rose"
+DAILY_DISTRIBUTION_STATS_TABLE = "wind_turbine_daily_distribution_stats"
+RUN_LEDGER_TABLE = "wind_turbine_run_ledger"
+WORK_QUEUE_TABLE = "wind_turbine_work_queue"
+TURBINE_STATE_TABLE = "wind_turbine_turbine_state"
+TURBINES_TABLE = "wind_turbine_turbines"
+
+
+# Parquet export (parquet_export.py) - after the summaries, the (day, turbine_id) partitions of the clean data and daily
+# summary changed since the previous export are rewritten under PARQUET_EXPORT_FOLDER, reading up to
+# PARQUET_EXPORT_BATCH_DAYS days per query. Off by default, needs the optional pyarrow package.
+PARQUET_EXPORT = os.environ.get("WIND_TURBINE_PARQUET_EXPORT", "0") == "1"
+PARQUET_EXPORT_FOLDER = os.environ.get("WIND_TURBINE_PARQUET_EXPORT_FOLDER", os.path.join("data", "parquet"))
+PARQUET_EXPORT_BATCH_DAYS = 7
+PARQUET_COMPRESSION = "zstd"
+
+# Steps reading the change log, each one keeps its own offset in the watermarks table
+CHANGE_LOG_CONSUMERS = ["clean_data", "summary_stats"] + (["parquet_export"] if PARQUET_EXPORT else [])
+
+
+# turbine_id used for the whole fleet rows of the rollups table
+FLEET_TURBINE_ID = 0
+
+# Time between two readings of a turbine in hours, used to convert power (MW) to energy (MWh) and for the readings
+# expected per day. WIND_TURBINE_READING_INTERVAL_MINUTES for data at another interval (e.g. generated benchmark fleets)
+READING_INTERVAL_HOURS = int(os.environ.get("WIND_TURBINE_READING_INTERVAL_MINUTES", "60")) / 60
+
+# Wind rose histogram - direction sectors (sector 0 is centred on North) and wind speed bins (m/s),
+# speeds above the last bin are counted in the last bin
+WIND_ROSE_SECTORS = 16
+WIND_SPEED_BIN_WIDTH = 1.0
+WIND_SPEED_BINS = 30
+
+
+# Resolution the values are rounded to for the mode calculation (stats_kernel.py)
+STATS_MODE_RESOLUTION = {"wind_speed": 0.1, "wind_direction": 1.0, "power_output": 0.1}
+
+# Memory efficient mode (memory_mode.py) - float32 measurements, int16 turbine ids, datetime64 days and
+# categorical periods. Inputs larger than the memory budget (MB) are processed in chunks.
+MEMORY_EFFICIENT_MODE = os.environ.get("WIND_TURBINE_MEMORY_EFFICIENT", "0") == "1"
+MEMORY_BUDGET_MB = int(os.environ.get("WIND_TURBINE_MEMORY_BUDGET_MB", "512"))
+
+# Number of rows converted at a time by the typed fetch helpers (db_fetch.py)
+FETCH_BATCH_SIZE = 50000
+
+# In-memory pipeline mode (in_memory_pipeline.py) - ingested rows are cleaned straight from memory instead of
+# being read back from the raw table, rows are written BULK_WRITE_BATCH_SIZE at a time
+IN_MEMORY_PIPELINE = os.environ.get("WIND_TURBINE_IN_MEMORY", "0") == "1"
+BULK_WRITE_BATCH_SIZE = 10000
+
+# Pipelined ingestion (pipelined_ingest.py) - a CSV is parsed in chunks of PIPELINED_CHUNK_ROWS rows while the
+# previous chunks are written, at most PIPELINED_QUEUE_CHUNKS parsed chunks wait for the writer
+PIPELINED_INGESTION = os.environ.get("WIND_TURBINE_PIPELINED_INGESTION", "0") == "1"
+PIPELINED_CHUNK_ROWS = 20000
+PIPELINED_QUEUE_CHUNKS = 4
+
+# Column store (column_store.py) - optional, export-only local copy of the ingested readings, memory-mapped append-only
+# column files per turbine with a sparse index of every COLUMN_STORE_INDEX_STRIDE-th timestamp. Synced from the raw
+# table after ingestion has committed when enabled.
+COLUMN_STORE = os.environ.get("WIND_TURBINE_COLUMN_STORE", "0") == "1"
+COLUMN_STORE_FOLDER = os.environ.get("WIND_TURBINE_COLUMN_STORE_FOLDER", os.path.join("data", "column_store"))
+COLUMN_STORE_INDEX_STRIDE = 4096
+
+# Hot window cache (hot_window.py) - the statistics input of the last HOT_WINDOW_WEEKS weeks kept in a Feather file,
+# the recent look-back periods are computed from it. Off by default, needs the optional pyarrow package.
+HOT_WINDOW_CACHE = os.environ.get("WIND_TURBINE_HOT_WINDOW", "0") == "1"
+HOT_WINDOW_FOLDER = os.environ.get("WIND_TURBINE_HOT_WINDOW_FOLDER", os.path.join("data", "hot_window"))
+HOT_WINDOW_WEEKS = 4
+
+# Read API (query_api.py) - results cached in memory (least recently used beyond QUERY_CACHE_MAX_ENTRIES,
+# at most QUERY_CACHE_TTL_SECONDS), the tables' run ledger versions are checked every
+# QUERY_CACHE_VERSION_CHECK_SECONDS, a new version of a table invalidates the results read from it
+QUERY_CACHE_MAX_ENTRIES = 256
+QUERY_CACHE_TTL_SECONDS = 300
+QUERY_CACHE_VERSION_CHECK_SECONDS = 5
+
+# HTTP service (http_service.py) - serves the read API, at most HTTP_POOL_SIZE DB connections, large
+# results are sent HTTP_CHUNK_ROWS rows per chunk
+HTTP_HOST = os.environ.get("WIND_TURBINE_HTTP_HOST", "127.0.0.1")
+HTTP_PORT = int(os.environ.get("WIND_TURBINE_HTTP_PORT", "8080"))
+HTTP_POOL_SIZE = 8
+HTTP_CHUNK_ROWS = 5000
+# encoded (JSON / Arrow) responses kept in memory, by ETag
+HTTP_ENCODED_CACHE_ENTRIES = 64
+
+# Run metrics (metrics.py) - per step / per statement timings written to logs/metrics_<run>.json and a
+# Prometheus textfile-collector file (point the node exporter's --collector.textfile.directory at its folder)
+METRICS_ENABLED = os.environ.get("WIND_TURBINE_METRICS", "1") == "1"
+METRICS_PROM_FILE = os.environ.get("WIND_TURBINE_METRICS_PROM_FILE", os.path.join("logs", "wind_turbine_pipeline.prom"))
+# interval of the RSS sampling thread measuring the peak memory of every step
+METRICS_RSS_SAMPLE_SECONDS = 0.05
+
+# Profiling (profiling.py) - comma separated step names / slugs (e.g. "data_cleaning" or "all") and the profiler:
+# cprofile, tracemalloc or sampling. Output goes to the logs folder. Off when no steps are given.
+PROFILE_STEPS = [step for step in os.environ.get("WIND_TURBINE_PROFILE_STEPS", "").split(",") if step.strip()]
+PROFILER = os.environ.get("WIND_TURBINE_PROFILER", "cprofile")
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("WIND_TURBINE_PROFILE_SAMPLE_INTERVAL", "0.005"))
+
+# Work queue (work_queue.py / worker.py) - workers on several hosts claim tasks under a lease of WORK_QUEUE_LEASE_SECONDS
+# (renewed while the task runs), expired leases are reclaimed and a task is retried up to WORK_QUEUE_MAX_ATTEMPTS times.
+# Cleaning is split into WORK_QUEUE_SHARDS turbine id shards. The raw data folder has to be shared by the workers.
+WORK_QUEUE_LEASE_SECONDS = int(os.environ.get("WIND_TURBINE_LEASE_SECONDS", "300"))
+WORK_QUEUE_MAX_ATTEMPTS = 3
+WORK_QUEUE_POLL_SECONDS = 1.0
+WORK_QUEUE_SHARDS = int(os.environ.get("WIND_TURBINE_WORK_QUEUE_SHARDS", "4"))
+WORK_QUEUE_RETENTION_DAYS = 7
 
 
 # Folder Names
@@ -29,10 +136,6 @@ RAW_DATA_FOLDER = 'data/raw_data'
 ARCHIVE_FOLDER = 'data/archive'
 LOGS_DIR = "logs"
 
-os.makedirs(RAW_DATA_FOLDER, exist_ok=True)
-os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
-os.makedirs(LOGS_DIR, exist_ok=True)
-
 # choose appropriate Period for stats
 PERIOD_FOR_STATS = "full_dataset"
 # PERIOD_FOR_STATS = "last_4_weeks"
@@ -41,26 +144,37 @@ PERIOD_FOR_STATS = "full_dataset"
 # PERIOD_FOR_STATS = "last_1_day"
 
 
-# Logging Configuration
-# LOG_FILE = f"script{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.log"
-LOG_FILE = f"script_{datetime.now().strftime('%Y-%m-%d T %H-%M-%S')}.log"
+# Logging Configuration - set up by initialize(), log file of the current process
+LOG_FILE = None
+# "json" - one JSON record per line, "text" - the plain "time - level - message" lines
+LOG_FORMAT = os.environ.get("WIND_TURBINE_LOG_FORMAT", "json")
+# log the SQL text of the pipeline's queries (verbose, for troubleshooting)
+LOG_SQL = os.environ.get("WIND_TURBINE_LOG_SQL", "0") == "1"
+# records logged per call site every LOG_RATE_INTERVAL seconds, the rest are counted and dropped
+LOG_RATE_LIMIT = 20
+LOG_RATE_INTERVAL = 10.0
 
-if not os.path.exists(LOGS_DIR):
-    os.makedirs(LOGS_DIR)  # Create logs folder if not exists
+def initialize():
+    """ Create the data / logs folders and start logging to a new timestamped log file.
+        Called by the entry points (pipeline, worker, scripts run on their own) - importing config
+        has no side effects, so tests, benchmarks and subprocesses don't create folders or log files.
+    """
+    global LOG_FILE
+    for folder in (RAW_DATA_FOLDER, ARCHIVE_FOLDER, LOGS_DIR):
+        os.makedirs(folder, exist_ok=True)
 
-# Generate log filename with timestamp
-log_filename = os.path.join(LOGS_DIR, LOG_FILE)
-
-logging.basicConfig(
-    filename=log_filename,
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",  
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
+    if LOG_FILE is None:
+        from log_setup import start_logging
+        LOG_FILE = os.path.join(LOGS_DIR, f"script_{datetime.now().strftime('%Y-%m-%d T %H-%M-%S')}.log")
+        start_logging(LOG_FILE)
+    return LOG_FILE
 
 # Other Constants (if needed later)
 def get_db_connection():
     """Establish and return a MySQL database connection."""
+    # imported here so importing config stays cheap
+    import mysql.connector
+
     try:
         connection = mysql.connector.connect(
             host=DB_HOST,
@@ -70,7 +184,9 @@ def get_db_connection():
             database=DB_NAME
         )
         # print(connection)
-        return connection
+        # statements run on this connection are timed for the run metrics
+        from metrics import instrument_connection
+        return instrument_connection(connection)
     except mysql.connector.Error as e:
         print(f"Error connecting to MySQL DB: {e}")
         logging.error("Error connecting to MySQL DB: {e}")
@@ -78,6 +194,8 @@ def get_db_connection():
     
 def get_mysql_connection():
     """Establish and return a MySQL connection without DB"""
+    import mysql.connector
+
     try:
         mysql_connection = mysql.connector.connect(
             host=DB_HOST,
@@ -0,0 +1,223 @@
+""" Small DAG executor for the pipeline steps.
+
+    Every step declares the resources it reads (inputs) and writes (outputs), e.g. "table:<name>" or
+    "files:<folder>". A step runs after the producers of its inputs (and its explicit depends_on);
+    steps whose dependencies are done run concurrently in a thread pool.
+
+    Every resource has a version in the watermarks table ("version:<resource>"), bumped when a step
+    writing it succeeds. A step whose input versions are the same as at its last successful run is
+    skipped. Folder resources ("files:<folder>") are versioned by a fingerprint of their CSV files.
+    Table versions also include the table's latest run ledger id (see run_ledger), which is committed
+    with the data, so work committed by a step that died before its version was bumped isn't skipped.
+
+    Steps return a StepResult instead of a truthy value, see as_step_result for the legacy values.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, List
+
+from mysql.connector import Error
+import config as conf
+
+# step statuses
+SUCCESS = "success"     # ran and (possibly) changed its outputs
+NO_DATA = "no_data"     # ran but there was nothing to do, outputs unchanged
+SKIPPED = "skipped"     # not run, inputs unchanged since its last run
+FAILED = "failed"       # ran and failed
+BLOCKED = "blocked"     # not run, a step it depends on failed or was blocked
+
+
+@dataclass
+class StepResult:
+    status: str
+    message: str = ""
+    rows: int = 0
+
+    @property
+    def failed(self):
+        return self.status in (FAILED, BLOCKED)
+
+
+@dataclass
+class Step:
+    name: str
+    func: Callable
+    inputs: List[str] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+    depends_on: List[str] = field(default_factory=list)
+
+
+def as_step_result(value):
+    # map legacy step return values: True -> success, False / None -> failed
+    if isinstance(value, StepResult):
+        return value
+    if value is True:
+        return StepResult(SUCCESS)
+    return StepResult(FAILED, f"step returned {value}")
+
+
+def get_folder_fingerprint(folder):
+    # fingerprint of the source CSVs waiting in the folder (name, size, modification time)
+    if not os.path.isdir(folder):
+        return "missing"
+    files = sorted(
+        (name, os.path.getsize(os.path.join(folder, name)), int(os.path.getmtime(os.path.join(folder, name))))
+        for name in os.listdir(folder)
+        if name.startswith(conf.SOURCE_DATA_CSV_PREFIX) and name.endswith(".csv")
+    )
+    return hashlib.sha1(json.dumps(files).encode()).hexdigest()
+
+
+class DagState:
+    """ Resource versions and the input versions of each step's last run, kept in the watermarks table.
+        Used from the scheduler thread only, opens its DB connection on first use.
+    """
+
+    def __init__(self):
+        self.connection = None
+
+    def _get_connection(self):
+        if self.connection is None or not self.connection.is_connected():
+            self.connection = conf.get_db_connection()
+        return self.connection
+
+    def _get(self, name):
+        from watermarks import get_watermark
+
+        connection = self._get_connection()
+        if connection is None:
+            return None
+        try:
+            return get_watermark(connection, name)
+        except Error as e:
+            # unknown state only makes the step run instead of being skipped
+            logging.error(f"Error reading DAG state {name}: {e}")
+            return None
+
+    def _set(self, values):
+        from watermarks import set_watermark
+
+        connection = self._get_connection()
+        if connection is None:
+            logging.warning("DAG state not saved - no DB connection")
+            return
+        with connection.cursor() as cursor:
+            for name, value in values.items():
+                set_watermark(cursor, name, value)
+        connection.commit()
+
+    def get_version(self, resource):
+        if resource.startswith("files:"):
+            return get_folder_fingerprint(resource[len("files:"):])
+        version = self._get(f"version:{resource}")
+        if resource.startswith("table:"):
+            from run_ledger import get_resource_version
+
+            connection = self._get_connection()
+            ledger_version = get_resource_version(connection, resource) if connection else None
+            return f"{version}/ledger:{ledger_version}"
+        return version
+
+    def bump_versions(self, resources, version):
+        self._set({f"version:{resource}": version for resource in resources if not resource.startswith("files:")})
+
+    def get_inputs_hash(self, step_name):
+        return self._get(f"dag_inputs:{step_name}")
+
+    def set_inputs_hash(self, step_name, inputs_hash):
+        self._set({f"dag_inputs:{step_name}": inputs_hash})
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+
+
+def get_dependencies(steps):
+    # step name -> names of the steps it has to wait for
+    producers = {}
+    for step in steps:
+        for resource in step.outputs:
+            producers.setdefault(resource, []).append(step.name)
+
+    return {
+        step.name: sorted({producer for resource in step.inputs for producer in producers.get(resource, [])
+                           if producer != step.name} | set(step.depends_on))
+        for step in steps
+    }
+
+
+def get_inputs_hash(state, step):
+    versions = {resource: state.get_version(resource) for resource in sorted(step.inputs)}
+    return hashlib.sha1(json.dumps(versions, default=str).encode()).hexdigest()
+
+
+def run_dag(steps, run_step, state=None, max_workers=4):
+    logging.info(f"run_dag function called....\n")
+
+    """ Run the steps in dependency order, independent ones in parallel.
+        run_step(step) runs one step and returns its StepResult.
+        Returns {step name: StepResult}.
+    """
+    state = state or DagState()
+    dependencies = get_dependencies(steps)
+    unknown = {name for deps in dependencies.values() for name in deps} - set(dependencies)
+    if unknown:
+        raise ValueError(f"Unknown pipeline steps in depends_on: {sorted(unknown)}")
+
+    run_version = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    pending = {step.name: step for step in steps}
+    results = {}
+    running = {}
+    inputs_hashes = {}
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                for name, step in list(pending.items()):
+                    if not all(dependency in results for dependency in dependencies[name]):
+                        continue
+                    del pending[name]
+
+                    failed_dependencies = [dependency for dependency in dependencies[name] if results[dependency].failed]
+                    if failed_dependencies:
+                        results[name] = StepResult(BLOCKED, f"{', '.join(failed_dependencies)} did not complete")
+                        logging.warning(f"Blocked: {name} - {results[name].message}")
+                        continue
+
+                    if step.inputs:
+                        inputs_hashes[name] = get_inputs_hash(state, step)
+                        if inputs_hashes[name] == state.get_inputs_hash(name):
+                            results[name] = StepResult(SKIPPED, "inputs unchanged since the previous run")
+                            logging.info(f"Skipped: {name} - {results[name].message}")
+                            continue
+
+                    running[executor.submit(run_step, step)] = step
+
+                if not running:
+                    if pending:
+                        raise ValueError(f"Pipeline steps with circular dependencies: {sorted(pending)}")
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    try:
+                        result = as_step_result(future.result())
+                    except Exception as e:
+                        result = StepResult(FAILED, str(e))
+                    results[step.name] = result
+
+                    if result.status == SUCCESS:
+                        state.bump_versions(step.outputs, run_version)
+                    if result.status in (SUCCESS, NO_DATA) and step.name in inputs_hashes:
+                        state.set_inputs_hash(step.name, inputs_hashes[step.name])
+    finally:
+        state.close()
+
+    return results
@@ -0,0 +1,132 @@
+""" Daily distribution and completeness stats per turbine.
+
+    Health reports need more than the min / max / avg of the daily summary: the spread of the power
+    output, how many hourly readings arrived compared with the number expected, missing values,
+    anomalies and imputed values. All of them are calculated in one grouped pass over the raw readings
+    of the dirty days (joined with the anomalies) and stored in one wide row per (day, turbine_id).
+
+    Power output count / sum / std (population) / p5 / p50 / p95 are of the measured clean values, i.e.
+    without anomalies and before imputation, the imputed values are counted in imputed_value_count.
+"""
+
+import logging
+from datetime import datetime, timedelta
+import numpy as np
+import config as conf
+from db_fetch import fetch_dataframe
+from memory_mode import MEASUREMENT_COLUMNS, get_dtypes
+
+# days fetched from the raw data table at once when the whole table is rebuilt
+REBUILD_CHUNK_DAYS = 31
+
+PERCENTILES = {"power_output_p5": 0.05, "power_output_p50": 0.5, "power_output_p95": 0.95}
+
+DISTRIBUTION_COLUMNS = ["readings_received", "readings_expected", "completeness", "null_value_count", "null_rate",
+                        "anomaly_count", "imputed_value_count", "power_output_count", "power_output_sum",
+                        "power_output_std"] + list(PERCENTILES)
+
+
+def get_readings_expected():
+    # hourly readings a turbine sends per day
+    return int(round(24 / conf.READING_INTERVAL_HOURS))
+
+
+def calculate_distribution_stats(frame):
+    """ Stats of a batch of readings (day_offset, turbine_id, the measurement columns and is_anomaly),
+        one row per (day_offset, turbine_id) with the DISTRIBUTION_COLUMNS.
+    """
+    import pandas as pd
+
+    missing_values = frame[MEASUREMENT_COLUMNS].isna().sum(axis=1)
+    is_anomaly = frame["is_anomaly"].astype(bool)
+    readings = pd.DataFrame({
+        "day_offset": frame["day_offset"],
+        "turbine_id": frame["turbine_id"],
+        "is_anomaly": is_anomaly.astype(np.int64),
+        "missing_values": missing_values,
+        # missing values of the clean (non anomaly) readings are the ones imputed in the clean table
+        "imputed_values": missing_values.where(~is_anomaly, 0),
+        "clean_power_output": frame["power_output"].astype(np.float64).where(~is_anomaly),
+    })
+
+    grouped = readings.groupby(["day_offset", "turbine_id"], sort=True)
+    stats = grouped.agg(
+        readings_received=("turbine_id", "size"),
+        null_value_count=("missing_values", "sum"),
+        anomaly_count=("is_anomaly", "sum"),
+        imputed_value_count=("imputed_values", "sum"),
+        power_output_count=("clean_power_output", "count"),
+        power_output_sum=("clean_power_output", "sum"),
+    )
+    stats["power_output_std"] = grouped["clean_power_output"].std(ddof=0)
+    percentiles = grouped["clean_power_output"].quantile(list(PERCENTILES.values())).unstack()
+    for column, quantile in PERCENTILES.items():
+        stats[column] = percentiles[quantile]
+
+    stats["readings_expected"] = get_readings_expected()
+    stats["completeness"] = stats["readings_received"] / stats["readings_expected"]
+    stats["null_rate"] = stats["null_value_count"] / (stats["readings_received"] * len(MEASUREMENT_COLUMNS))
+    return stats[DISTRIBUTION_COLUMNS].reset_index()
+
+
+def update_distribution_range(cursor, range_start, range_end):
+    # recalculate the rows of the [range_start, range_end) days from the raw readings.
+    query = f"""
+        SELECT DATEDIFF(r.timestamp, %s) AS day_offset, r.turbine_id, r.wind_speed, r.wind_direction, r.power_output,
+            a.timestamp IS NOT NULL AS is_anomaly
+        FROM {conf.RAW_DATA_TABLE} r
+        LEFT JOIN {conf.ANOMALIES_TABLE} a ON r.timestamp = a.timestamp AND r.turbine_id = a.turbine_id
+        WHERE r.timestamp >= %s AND r.timestamp < %s
+    """
+    frame = fetch_dataframe(cursor, query, (range_start, range_start, range_end),
+                            dtypes={"day_offset": np.int64, "is_anomaly": np.int8, **get_dtypes()})
+
+    cursor.execute(
+        f"DELETE FROM {conf.DAILY_DISTRIBUTION_STATS_TABLE} WHERE day >= %s AND day < %s",
+        (range_start.date(), range_end.date())
+    )
+    if frame.empty:
+        return 0
+
+    stats = calculate_distribution_stats(frame)
+    insert_query = f"""
+        INSERT INTO {conf.DAILY_DISTRIBUTION_STATS_TABLE} (day, turbine_id, {", ".join(DISTRIBUTION_COLUMNS)})
+        VALUES (%s, %s, {", ".join(["%s"] * len(DISTRIBUTION_COLUMNS))})
+    """
+    # NaN (e.g. the std of a day without clean power output) -> NULL
+    values = stats[DISTRIBUTION_COLUMNS].astype(object).where(stats[DISTRIBUTION_COLUMNS].notna(), None)
+    range_day = range_start.date()
+    records = [
+        (range_day + timedelta(days=int(day_offset)), int(turbine_id),
+         *(value.item() if isinstance(value, np.generic) else value for value in row))
+        for day_offset, turbine_id, row in zip(stats["day_offset"], stats["turbine_id"], values.itertuples(index=False))
+    ]
+    cursor.executemany(insert_query, records)
+    return len(records)
+
+
+def update_daily_distribution(cursor, day_ranges=None):
+    logging.info(f"update_daily_distribution function called....\n")
+
+    """ Recalculate the distribution stats of the given [start, end) day ranges, or of all days when
+        day_ranges is None (processed REBUILD_CHUNK_DAYS at a time to keep memory bounded).
+        Note - no commit here, the caller commits the stats with the daily summary.
+    """
+    if day_ranges is None:
+        cursor.execute(f"SELECT MIN(timestamp), MAX(timestamp) FROM {conf.RAW_DATA_TABLE}")
+        first_timestamp, last_timestamp = cursor.fetchone()
+        cursor.execute(f"DELETE FROM {conf.DAILY_DISTRIBUTION_STATS_TABLE}")
+        if first_timestamp is None:
+            return
+
+        day_ranges = []
+        chunk_start = datetime.combine(first_timestamp.date(), datetime.min.time())
+        while chunk_start <= last_timestamp:
+            day_ranges.append((chunk_start, chunk_start + timedelta(days=REBUILD_CHUNK_DAYS)))
+            chunk_start += timedelta(days=REBUILD_CHUNK_DAYS)
+
+    stats_rows = 0
+    for range_start, range_end in day_ranges:
+        stats_rows += update_distribution_range(cursor, range_start, range_end)
+
+    logging.info(f"{conf.DAILY_DISTRIBUTION_STATS_TABLE} updated, {stats_rows} rows written")
@@ -0,0 +1,70 @@
+""" Typed result fetch helpers.
+
+    A dictionary cursor + fetchall() builds one Python dict per row and only then a DataFrame, for
+    multi-million row results that doubles the time and holds every row as Python objects at once.
+    These helpers stream the result in batches of conf.FETCH_BATCH_SIZE rows with fetchmany() and
+    convert every batch straight into NumPy arrays of the given dtypes (NULL -> NaN / NaT), so only
+    one batch of Python tuples is alive at any time.
+"""
+
+import logging
+import numpy as np
+import config as conf
+
+
+def fetch_batches(cursor, query, params=None, dtypes=None, batch_size=None):
+    """ Execute the query and yield every batch of rows as a dict of column name -> NumPy array.
+        dtypes maps column names to NumPy dtypes, columns without a dtype are inferred by NumPy.
+        Note - integer columns must not contain NULLs, use a float dtype for those.
+    """
+    dtypes = dtypes or {}
+    batch_size = batch_size or conf.FETCH_BATCH_SIZE
+
+    cursor.execute(query, params or ())
+    columns = [description[0] for description in cursor.description]
+
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield {
+            column: np.array(values, dtype=dtypes.get(column))
+            for column, values in zip(columns, zip(*rows))
+        }
+
+
+def fetch_arrays(cursor, query, params=None, dtypes=None, batch_size=None):
+    # Whole result as a dict of column name -> NumPy array.
+    dtypes = dtypes or {}
+    columns = None
+    batches = []
+
+    for batch in fetch_batches(cursor, query, params, dtypes, batch_size):
+        columns = list(batch)
+        batches.append(batch)
+
+    if columns is None:
+        # empty result, still return the (typed) columns
+        columns = [description[0] for description in cursor.description]
+        return {column: np.array([], dtype=dtypes.get(column, np.float64)) for column in columns}
+
+    logging.info("fetch_arrays: %s rows fetched in %s batches", sum(len(batch[columns[0]]) for batch in batches), len(batches))
+    return {column: np.concatenate([batch[column] for batch in batches]) for column in columns}
+
+
+def fetch_dataframe(cursor, query, params=None, dtypes=None, batch_size=None):
+    # Whole result as a pandas DataFrame built from the typed arrays (no per row dicts).
+    import pandas as pd
+
+    return pd.DataFrame(fetch_arrays(cursor, query, params, dtypes, batch_size), copy=False)
+
+
+def fetch_record_batches(cursor, query, params=None, dtypes=None, batch_size=None):
+    # Result as Arrow record batches, needs the optional pyarrow package.
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError("pyarrow is required for fetch_record_batches, install it with 'pip install pyarrow'")
+
+    for batch in fetch_batches(cursor, query, params, dtypes, batch_size):
+        yield pa.RecordBatch.from_pydict({column: pa.array(values) for column, values in batch.items()})
@@ -0,0 +1,171 @@
+""" Hot window cache (conf.HOT_WINDOW_CACHE) - the recent weeks of the statistics input on local disk.
+
+    process_statistics computes the stats of the look-back periods (last_4_weeks down to last_1_day)
+    from the non-NULL, non-anomaly raw rows of each period, i.e. one raw table x anomalies join per
+    period and run. With the cache those rows of the last conf.HOT_WINDOW_WEEKS weeks are kept in a
+    Feather file, a run only fetches the raw rows scored since the previous run, drops the rows that
+    fell out of the window and the recent periods are filtered from the cached frame:
+
+        <conf.HOT_WINDOW_FOLDER>/hot_window.feather    id, timestamp, turbine_id, wind_speed, wind_direction, power_output
+        <conf.HOT_WINDOW_FOLDER>/hot_window.json       raw id covered, change log offset, window start, row count
+
+    The cached rows are only valid while the rows they came from are unchanged. A corrected raw row may
+    carry another value or be an anomaly now, so the meta file keeps the change log offset of clean_data
+    (the entries its late corrections consumed, it only grows - unlike MAX(id), which drops when consumed
+    entries are purged) and the raw id covered. While corrections are pending the recent periods are read
+    from the database and the cache is left alone; apply_late_corrections refreshes it once they are
+    committed. A cache behind a newer correction, ahead of the scored raw rows (restored database) or
+    whose row count doesn't match its meta (run interrupted between the two files) is rebuilt from the
+    database. Both files are written to a temporary file first and renamed, the Feather file first.
+
+    Needs the optional pyarrow package, without it (or with the cache disabled) the stats are read
+    from the database as before.
+"""
+
+import json
+import logging
+import os
+from datetime import timedelta
+
+import config as conf
+from change_log import consumer_watermark_name
+from db_fetch import fetch_dataframe
+from memory_mode import MEASUREMENT_COLUMNS, get_dtypes
+from watermarks import get_watermark
+
+CACHE_FILE = "hot_window.feather"
+META_FILE = "hot_window.json"
+# change log consumer whose late corrections re-score the corrected raw rows
+CHANGE_CONSUMER = "clean_data"
+
+
+def get_cache_paths(folder=None):
+    folder = folder or conf.HOT_WINDOW_FOLDER
+    return os.path.join(folder, CACHE_FILE), os.path.join(folder, META_FILE)
+
+
+def read_meta(folder=None):
+    # meta of the cached window, None when there is no (readable) cache
+    cache_path, meta_path = get_cache_paths(folder)
+    if not os.path.exists(cache_path) or not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path) as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Unreadable hot window meta {meta_path}, rebuilding: {e}")
+        return None
+
+
+def write_cache(frame, meta, folder=None):
+    cache_path, meta_path = get_cache_paths(folder)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    # the Feather file first, a cache whose row count doesn't match the meta is rebuilt
+    temp_path = cache_path + ".tmp"
+    frame.reset_index(drop=True).to_feather(temp_path)
+    os.replace(temp_path, cache_path)
+
+    temp_path = meta_path + ".tmp"
+    with open(temp_path, "w") as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(temp_path, meta_path)
+
+
+def get_change_offset(connection):
+    # last change log id whose correction is applied (re-scored and re-cleaned)
+    return int(get_watermark(connection, consumer_watermark_name(CHANGE_CONSUMER)) or 0)
+
+
+def has_pending_changes(cursor, change_offset):
+    # corrections after the offset - consumed entries may be purged, pending ones never are
+    cursor.execute(f"SELECT MAX(id) FROM {conf.CHANGE_LOG_TABLE}")
+    return (cursor.fetchone()[0] or 0) > change_offset
+
+
+def fetch_window_rows(cursor, after_raw_id, to_raw_id, window_start):
+    # raw rows after_raw_id < id <= to_raw_id of the window without NULLs and anomalies (as get_filtered_data)
+    import numpy as np
+
+    query = f"""
+        SELECT r.id, r.timestamp, r.turbine_id, r.wind_speed, r.wind_direction, r.power_output
+        FROM {conf.RAW_DATA_TABLE} r
+        LEFT JOIN {conf.ANOMALIES_TABLE} a ON r.timestamp = a.timestamp AND r.turbine_id = a.turbine_id
+        WHERE
+            r.id > %s AND r.id <= %s
+            AND r.timestamp >= %s
+            AND r.wind_speed IS NOT NULL
+            AND r.wind_direction IS NOT NULL
+            AND r.power_output IS NOT NULL
+            AND a.timestamp IS NULL
+    """
+    dtypes = {"id": np.int64, "timestamp": "datetime64[us]"}
+    dtypes.update(get_dtypes())
+    return fetch_dataframe(cursor, query, (after_raw_id, to_raw_id, window_start), dtypes)
+
+
+def is_valid(meta, frame_rows, change_offset, scored_raw_id, window_start):
+    # cached window usable as the base of this run's window
+    return (meta is not None
+            and meta.get("change_offset") == change_offset
+            and meta.get("raw_id", scored_raw_id + 1) <= scored_raw_id
+            and meta.get("window_start", "") <= window_start.isoformat()
+            and meta.get("rows") == frame_rows)
+
+
+def get_window(connection, max_timestamp, scored_raw_id, folder=None):
+    logging.info(f"get_window function called....\n")
+
+    """ Rows of the hot window (max_timestamp - conf.HOT_WINDOW_WEEKS onwards) up to raw id scored_raw_id,
+        the raw rows whose anomalies are stored. Updates the cache, returns the frame or None when the
+        cache can't be used (pyarrow missing, corrections pending, read / write error) and the stats are
+        read from the database.
+    """
+    import pandas as pd
+
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        logging.warning("Hot window cache needs pyarrow, reading the recent periods from the database")
+        return None
+
+    window_start = max_timestamp - timedelta(weeks=conf.HOT_WINDOW_WEEKS)
+    cache_path, _ = get_cache_paths(folder)
+    try:
+        change_offset = get_change_offset(connection)
+        with connection.cursor() as cursor:
+            if has_pending_changes(cursor, change_offset):
+                logging.info("Hot window: corrections pending, reading the recent periods from the database")
+                return None
+
+            meta = read_meta(folder)
+            frame = pd.read_feather(cache_path) if meta is not None else None
+            if frame is not None and is_valid(meta, len(frame), change_offset, scored_raw_id, window_start):
+                new_rows = fetch_window_rows(cursor, meta["raw_id"], scored_raw_id, window_start)
+                frame = pd.concat([frame[frame["timestamp"] >= window_start], new_rows], ignore_index=True)
+                logging.info(f"Hot window: {len(new_rows)} rows added up to raw id {scored_raw_id}")
+            else:
+                frame = fetch_window_rows(cursor, 0, scored_raw_id, window_start)
+                logging.info(f"Hot window rebuilt from the database: {len(frame)} rows from {window_start}")
+
+        write_cache(frame, {
+            "raw_id": int(scored_raw_id),
+            "change_offset": change_offset,
+            "window_start": window_start.isoformat(),
+            "rows": len(frame),
+        }, folder)
+        return frame
+
+    except Exception as e:
+        logging.error(f"Hot window cache failed, reading the recent periods from the database: {e}")
+        return None
+
+
+def get_period_data(window, period_start):
+    # measurement columns of the window rows from period_start on, as get_filtered_data returns them
+    return window.loc[window["timestamp"] >= period_start, MEASUREMENT_COLUMNS].reset_index(drop=True)
+
+
+def window_covers(max_timestamp, period_start):
+    # the period lies within the hot window
+    return period_start is not None and period_start >= max_timestamp - timedelta(weeks=conf.HOT_WINDOW_WEEKS)
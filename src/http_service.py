@@ -0,0 +1,312 @@
+""" HTTP service - the read API (query_api.py) for dashboards, so they don't poll the database.
+
+    GET /timeseries?turbine=1&start=2022-03-01&end=2022-03-08&resolution=hour
+    GET /summary?start=2022-03-01&end=2022-04-01&level=week&turbines=1,2
+    GET /anomalies?start=2022-03-01&end=2022-04-01&turbines=1,2
+    GET /status?turbines=1,2
+    GET /health
+
+    Responses are JSON (a list of objects), or an Arrow IPC stream with format=arrow or an
+    "Accept: application/vnd.apache.arrow.stream" header (needs the optional pyarrow package).
+    Results come from the read API's cache and are sent in chunks of conf.HTTP_CHUNK_ROWS rows
+    (chunked transfer encoding), the encoded chunks of a response with an ETag are kept in memory too.
+
+    The ETag of a response is derived from the run ledger version of the table it was read from, the
+    version the pipeline moves with every commit (and watermark) to that table. A dashboard sending
+    If-None-Match gets 304 Not Modified until the pipeline commits new data, without any query.
+
+    Standard library only (ThreadingHTTPServer), at most conf.HTTP_POOL_SIZE DB connections:
+        python src/http_service.py --port 8080
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+from mysql.connector import Error
+import config as conf
+import query_api
+from run_ledger import table_resource
+
+JSON_TYPE = "application/json"
+ARROW_TYPE = "application/vnd.apache.arrow.stream"
+
+
+class ConnectionPool:
+    """ Up to size DB connections shared by the request threads. The connections are in autocommit
+        mode so every query sees the latest committed data (no snapshot kept open between requests).
+    """
+
+    def __init__(self, connection_factory, size):
+        self.connection_factory = connection_factory
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        self.slots.acquire()
+        connection = None
+        try:
+            try:
+                connection = self.idle.get_nowait()
+                if not connection.is_connected():
+                    connection.close()
+                    raise queue.Empty
+            except queue.Empty:
+                connection = self.connection_factory()
+                if connection is None:
+                    raise Error("DB connection failed - check get_db_connection function in config.py")
+                connection.autocommit = True
+            yield connection
+        except Error:
+            # the connection may be broken, the next request opens a new one
+            if connection is not None:
+                connection.close()
+                connection = None
+            raise
+        finally:
+            if connection is not None:
+                self.idle.put(connection)
+            self.slots.release()
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+def get_range(params):
+    return datetime.fromisoformat(params["start"]), datetime.fromisoformat(params["end"])
+
+
+def get_turbine_ids(params):
+    return [int(turbine_id) for turbine_id in params["turbines"].split(",")] if params.get("turbines") else None
+
+
+def get_question(path, params):
+    """ (source table, function running the query on a connection) of a request.
+        KeyError for an unknown path or a missing parameter, ValueError for an invalid one.
+    """
+    if path == "/timeseries":
+        turbine_id = int(params["turbine"])
+        start, end = get_range(params)
+        resolution = params.get("resolution", "raw")
+        if resolution not in ("raw",) + query_api.ROLLUP_RESOLUTIONS:
+            raise ValueError(f"unknown resolution {resolution}")
+        return (query_api.get_source_table("timeseries", resolution=resolution),
+                lambda connection: query_api.get_time_series(connection, turbine_id, start, end, resolution))
+
+    if path == "/summary":
+        start, end = get_range(params)
+        level = params.get("level", "day")
+        if level not in ("day", "week", "month"):
+            raise ValueError(f"unknown level {level}")
+        turbine_ids = get_turbine_ids(params)
+        return (query_api.get_source_table("summary", level=level),
+                lambda connection: query_api.get_fleet_summary(connection, start, end, level, turbine_ids))
+
+    if path == "/anomalies":
+        start, end = get_range(params)
+        turbine_ids = get_turbine_ids(params)
+        return (query_api.get_source_table("anomalies"),
+                lambda connection: query_api.get_anomaly_counts(connection, start, end, turbine_ids))
+
+    if path == "/status":
+        turbine_ids = get_turbine_ids(params)
+        return (query_api.get_source_table("status"),
+                lambda connection: query_api.get_fleet_status(connection, turbine_ids))
+
+    raise KeyError(path)
+
+
+def get_etag(path, params, output_format, source_table, version):
+    # same request and same table version -> same ETag, None when the table has no ledger version
+    if version is None:
+        return None
+    request = f"{path}?{sorted(params.items())}|{output_format}|{source_table}|{version}"
+    return f'"{hashlib.sha1(request.encode()).hexdigest()}"'
+
+
+def is_arrow_available():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class ChunkCollector:
+    # file-like sink of pyarrow's stream writer, collects the written bytes until they are taken
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def encode_json(result):
+    # yields the rows as a JSON list of objects, conf.HTTP_CHUNK_ROWS rows per chunk
+    yield b"["
+    for offset in range(0, len(result.rows), conf.HTTP_CHUNK_ROWS):
+        objects = [dict(zip(result.columns, row)) for row in result.rows[offset:offset + conf.HTTP_CHUNK_ROWS]]
+        yield (b"," if offset else b"") + json.dumps(objects, default=str)[1:-1].encode()
+    yield b"]"
+
+
+def encode_arrow(result):
+    # yields the rows as an Arrow IPC stream, a record batch of conf.HTTP_CHUNK_ROWS rows per chunk
+    import pyarrow as pa
+
+    columns = list(zip(*result.rows)) or [[] for _ in result.columns]
+    table = pa.table({column: pa.array(values) for column, values in zip(result.columns, columns)})
+    sink = ChunkCollector()
+    with pa.ipc.new_stream(sink, table.schema) as stream:
+        for batch in table.to_batches(max_chunksize=conf.HTTP_CHUNK_ROWS):
+            stream.write_batch(batch)
+            yield b"".join(sink.take())
+    yield b"".join(sink.take())
+
+
+# encoded responses by ETag, repeated requests of an unchanged table skip the serialization too
+_encoded = query_api.QueryCache(conf.HTTP_ENCODED_CACHE_ENTRIES, conf.QUERY_CACHE_TTL_SECONDS, conf.QUERY_CACHE_VERSION_CHECK_SECONDS)
+
+
+def get_response_chunks(result, output_format, etag):
+    encode = encode_arrow if output_format == "arrow" else encode_json
+    if etag is None:
+        return encode(result)
+    chunks = _encoded.get(etag)
+    if chunks is None:
+        chunks = list(encode(result))
+        _encoded.put(etag, chunks)
+    return chunks
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 for keep-alive connections and chunked responses
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug("%s - " + format, self.address_string(), *args)
+
+    def send_empty(self, status, etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", JSON_TYPE)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def get_output_format(self, params):
+        if params.get("format") == "arrow" or ARROW_TYPE in self.headers.get("Accept", ""):
+            return "arrow"
+        return "json"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        if url.path == "/health":
+            return self.send_json(200, {"status": "ok"})
+
+        try:
+            source_table, run = get_question(url.path, params)
+        except KeyError as e:
+            if url.path in ("/timeseries", "/summary", "/anomalies", "/status"):
+                return self.send_json(400, {"error": f"missing parameter {e}"})
+            return self.send_json(404, {"error": f"unknown path {url.path}"})
+        except ValueError as e:
+            return self.send_json(400, {"error": str(e)})
+
+        output_format = self.get_output_format(params)
+        if output_format == "arrow" and not is_arrow_available():
+            return self.send_json(406, {"error": "Arrow responses need pyarrow, install it with 'pip install pyarrow'"})
+
+        try:
+            with self.server.pool.connection() as connection:
+                version = query_api.get_cache().get_versions(connection).get(table_resource(source_table))
+                etag = get_etag(url.path, params, output_format, source_table, version)
+                if etag is not None and etag in self.headers.get("If-None-Match", ""):
+                    return self.send_empty(304, etag)
+                result = run(connection)
+        except Error as e:
+            logging.error(f"HTTP service - DB error for {self.path}: {e}")
+            return self.send_json(503, {"error": "database unavailable"})
+        if result is None:
+            return self.send_json(500, {"error": "query failed"})
+
+        self.send_response(200)
+        self.send_header("Content-Type", ARROW_TYPE if output_format == "arrow" else JSON_TYPE)
+        self.send_header("Transfer-Encoding", "chunked")
+        # the result's own version, the table may have moved on while the query ran
+        etag = get_etag(url.path, params, output_format, source_table, result.version)
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        for chunk in get_response_chunks(result, output_format, etag):
+            if chunk:
+                self.wfile.write(b"%x\r\n" % len(chunk) + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class PipelineHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, connection_factory=None, pool_size=None):
+        super().__init__(address, RequestHandler)
+        self.pool = ConnectionPool(connection_factory or conf.get_db_connection, pool_size or conf.HTTP_POOL_SIZE)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=conf.HTTP_HOST)
+    parser.add_argument("--port", type=int, default=conf.HTTP_PORT)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    conf.initialize()
+    server = PipelineHTTPServer((args.host, args.port))
+    logging.info(f"HTTP service listening on {args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info("HTTP service stopped")
+
+
+if __name__ == "__main__":
+    main()
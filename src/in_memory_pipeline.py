@@ -0,0 +1,336 @@
+""" In-memory pipeline mode (conf.IN_MEMORY_PIPELINE) - ingestion and cleaning in one step.
+
+    The new CSV rows are validated, written to the raw table, scored against the anomaly bounds,
+    imputed and written to the clean / anomalies tables straight from the ingested DataFrames, with
+    bulk (multi-row) writes. A raw batch goes through a session temporary stage table, whose join with
+    the raw table on the batch's keys tells new, corrected and unchanged re-delivered records apart.
+    The raw rows this run loaded are never read back from the database; only history is: the anomaly bounds, the mean / median / mode stats of the look-back periods,
+    and the late corrections of already loaded records (apply_late_corrections).
+
+    New rows are held in memory until the stats are updated (imputation uses stats including them).
+    When they exceed conf.MEMORY_BUDGET_MB the held rows are dropped and the clean table is updated
+    from the raw table as in the DB mode.
+"""
+
+import logging
+import os
+
+from mysql.connector import Error
+
+import config as conf
+from change_log import record_changed_keys
+from clean_data import (get_anomaly_bounds, process_statistics, update_clean_table, apply_late_corrections,
+                        get_new_raw_id_range, CLEAN_RAW_ID_WATERMARK, NOT_SCORED)
+from dag import StepResult, SUCCESS, NO_DATA, FAILED
+from ingest_data import get_csv_files, get_last_processed_info, update_wind_turbine_ingestion_tracker, move_csv_to_archive, read_new_rows
+from memory_mode import get_rows_within_budget
+from metrics import add_counts, timed_batch
+from run_ledger import record_commit, table_resource
+from turbine_registry import register_turbines
+from turbine_state import update_cleaned_state_from_memory, update_ingested_state
+from watermarks import set_watermark
+
+MEASUREMENT_COLUMNS = ["wind_speed", "wind_direction", "power_output"]
+RECORD_COLUMNS = ["timestamp", "turbine_id"] + MEASUREMENT_COLUMNS
+
+# session temporary table a raw batch is written to before it is merged into the raw table
+RAW_STAGE_TABLE = f"{conf.RAW_DATA_TABLE}_stage"
+
+
+def validate_batch(batch):
+    # rows without timestamp / turbine_id can't be stored, a key repeated in the batch keeps its last reading
+    valid = batch[RECORD_COLUMNS].dropna(subset=["timestamp", "turbine_id"])
+    if len(valid) < len(batch):
+        logging.warning(f"Skipping {len(batch) - len(valid)} invalid rows (missing timestamp or turbine_id)")
+    return valid.drop_duplicates(subset=["timestamp", "turbine_id"], keep="last")
+
+
+def get_records(frame):
+    # DataFrame rows as tuples of Python values for executemany (datetime, int, float), NaN -> NULL
+    timestamps = [timestamp.to_pydatetime() for timestamp in frame["timestamp"]]
+    turbine_ids = frame["turbine_id"].astype(int).tolist()
+    measurements = [
+        [value if value == value else None for value in frame[column].astype(float).tolist()]
+        for column in MEASUREMENT_COLUMNS
+    ]
+    return list(zip(timestamps, turbine_ids, *measurements))
+
+
+def bulk_write(cursor, query, frame):
+    # executemany in conf.BULK_WRITE_BATCH_SIZE slices, the connector sends each as one multi-row INSERT
+    records = get_records(frame)
+    for start in range(0, len(records), conf.BULK_WRITE_BATCH_SIZE):
+        cursor.executemany(query, records[start:start + conf.BULK_WRITE_BATCH_SIZE])
+    return len(records)
+
+
+def stage_raw_batch(cursor, batch):
+    """ Write the batch to the (session temporary) stage table and compare it with the raw table.
+        Returns (existing, changed) boolean Series - batch rows whose key is already loaded, and those of
+        them whose values differ, i.e. what 'ON DUPLICATE KEY UPDATE' reports as 2 affected rows in the
+        DB mode. Only the batch's own keys are looked up (primary key join).
+    """
+    import pandas as pd
+
+    # temporary tables don't commit the open transaction, DELETE (not TRUNCATE) for the same reason
+    cursor.execute(f"""
+        CREATE TEMPORARY TABLE IF NOT EXISTS {RAW_STAGE_TABLE} (
+            timestamp DATETIME NOT NULL,
+            turbine_id INT NOT NULL,
+            wind_speed FLOAT,
+            wind_direction FLOAT,
+            power_output FLOAT,
+            PRIMARY KEY (timestamp, turbine_id)
+        )
+    """)
+    cursor.execute(f"DELETE FROM {RAW_STAGE_TABLE}")
+    bulk_write(cursor, f"""
+        INSERT INTO {RAW_STAGE_TABLE} (timestamp, turbine_id, wind_speed, wind_direction, power_output)
+        VALUES (%s, %s, %s, %s, %s)
+    """, batch)
+
+    # <=> is NULL safe, a re-delivered row with the same values (NULLs included) is not a correction
+    cursor.execute(f"""
+        SELECT s.timestamp, s.turbine_id,
+            NOT (r.wind_speed <=> s.wind_speed AND r.wind_direction <=> s.wind_direction
+                 AND r.power_output <=> s.power_output) AS changed
+        FROM {RAW_STAGE_TABLE} s
+        JOIN {conf.RAW_DATA_TABLE} r ON r.timestamp = s.timestamp AND r.turbine_id = s.turbine_id
+    """)
+    existing = cursor.fetchall()
+    if not existing:
+        return pd.Series(False, index=batch.index), pd.Series(False, index=batch.index)
+
+    existing_keys = pd.MultiIndex.from_arrays([pd.to_datetime([row[0] for row in existing]), [int(row[1]) for row in existing]])
+    changed_keys = existing_keys[[bool(row[2]) for row in existing]]
+    batch_keys = pd.MultiIndex.from_arrays([batch["timestamp"], batch["turbine_id"].astype(int)])
+    return (pd.Series(batch_keys.isin(existing_keys), index=batch.index),
+            pd.Series(batch_keys.isin(changed_keys), index=batch.index))
+
+
+def write_raw_batch(cursor, batch, file_name=None):
+    """ Upsert a validated batch into the raw table (through the stage table), corrected records go to
+        the change log and new turbines to the registry. Returns the rows of the batch that are new records.
+    """
+    with timed_batch("in_memory raw batch", rows=len(batch)):
+        existing, corrections = stage_raw_batch(cursor, batch)
+        cursor.execute(f"""
+            INSERT INTO {conf.RAW_DATA_TABLE} (timestamp, turbine_id, wind_speed, wind_direction, power_output)
+            SELECT timestamp, turbine_id, wind_speed, wind_direction, power_output FROM {RAW_STAGE_TABLE}
+            ON DUPLICATE KEY UPDATE wind_speed=VALUES(wind_speed), wind_direction=VALUES(wind_direction), power_output=VALUES(power_output)
+        """)
+    register_turbines(cursor, batch["turbine_id"].unique(), file_name)
+    update_ingested_state(cursor, batch)
+
+    if corrections.any():
+        record_changed_keys(cursor, [(timestamp.to_pydatetime(), int(turbine_id))
+                                     for timestamp, turbine_id in batch.loc[corrections, ["timestamp", "turbine_id"]].itertuples(index=False)])
+    return batch[~existing]
+
+
+def ingest_file(connection, file_path):
+    logging.info(f"ingest_file function called....\n")
+
+    """ Load the new rows of a CSV into the raw table (all batches in one transaction), update the
+        tracker (in the same transaction) and archive the file. Returns the list of new-record DataFrames, None on failure.
+    """
+    file_name_only = os.path.basename(file_path)
+    last_csv_processed_info = get_last_processed_info(connection, file_name_only)
+    last_record_timestamp, last_record_row_number = last_csv_processed_info or (None, 0)
+
+    new_frames = []
+    try:
+        with connection.cursor() as cursor:
+            for batch in read_new_rows(file_path, last_record_row_number):
+                if batch.empty:
+                    continue
+                last_record_timestamp = batch.iloc[-1]["timestamp"]
+                last_record_row_number += len(batch)
+                add_counts(rows_read=len(batch))
+
+                new_frames.append(write_raw_batch(cursor, validate_batch(batch), file_name_only))
+
+            add_counts(bytes_parsed=os.path.getsize(file_path))
+            # tracker and ledger rows in the same transaction as the data, as in ingest_csv
+            if new_frames:
+                if not update_wind_turbine_ingestion_tracker(connection, file_name_only, last_record_timestamp, last_record_row_number, commit=False):
+                    raise Error(f"ingestion tracker update failed for {file_name_only}")
+                record_commit(cursor, table_resource(conf.RAW_DATA_TABLE),
+                              f"{file_name_only}:{last_record_row_number}", sum(len(frame) for frame in new_frames))
+                record_commit(cursor, table_resource(conf.TURBINE_STATE_TABLE), f"{file_name_only}:{last_record_row_number}")
+            connection.commit()
+    except Error as e:
+        connection.rollback()
+        logging.error(f"Error ingesting CSV {file_path}: {e}")
+        return None
+
+    move_csv_to_archive(file_path)
+    logging.info(f"{sum(len(frame) for frame in new_frames)} new records of {file_path} loaded")
+    return new_frames
+
+
+def score_anomalies(frame, bounds):
+    # boolean Series - True for the readings outside the anomaly bounds
+    import pandas as pd
+
+    if bounds is None:
+        return pd.Series(False, index=frame.index)
+    lower_bound, upper_bound = bounds
+    return (frame["power_output"] < lower_bound) | (frame["power_output"] > upper_bound)
+
+
+def get_imputation_values(cursor):
+    # values for missing readings, the same stats update_clean_table uses (get_imputed_columns_sql)
+    cursor.execute(f"""
+        SELECT wind_speed_median, wind_direction_median, power_output_mean
+        FROM {conf.MMM_TABLE}
+        WHERE period = %s
+        ORDER BY calculation_timestamp DESC
+        LIMIT 1
+    """, (conf.PERIOD_FOR_STATS,))
+    row = cursor.fetchone()
+    if row is None:
+        return {}
+    return {column: value for column, value in zip(MEASUREMENT_COLUMNS, row) if value is not None}
+
+
+def clean_new_records(connection, new_records, bounds, raw_id_range=None):
+    logging.info(f"clean_new_records function called....\n")
+
+    """ Store the anomalies of the new records, update the stats (history, read from the database)
+        and store the rest imputed with the updated stats in the clean table.
+        raw_id_range - the raw ids of new_records, the clean raw id watermark is moved to its end
+        with the clean rows as in update_clean_table.
+    """
+    anomalies = score_anomalies(new_records, bounds)
+
+    with connection.cursor() as cursor:
+        anomalies_query = f"""
+            INSERT INTO {conf.ANOMALIES_TABLE} (timestamp, turbine_id, wind_speed, wind_direction, power_output)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                wind_speed = VALUES(wind_speed),
+                wind_direction = VALUES(wind_direction),
+                power_output = VALUES(power_output),
+                insertion_date = CURRENT_TIMESTAMP
+        """
+        with timed_batch("in_memory anomalies", rows=int(anomalies.sum())):
+            bulk_write(cursor, anomalies_query, new_records[anomalies])
+        record_commit(cursor, table_resource(conf.ANOMALIES_TABLE), row_count=int(anomalies.sum()))
+        connection.commit()
+
+    # stats of the look-back periods include the new raw records
+    if not process_statistics(connection, raw_id_range):
+        return False
+
+    with connection.cursor() as cursor:
+        clean_records = new_records[~anomalies].fillna(get_imputation_values(cursor))
+        clean_query = f"""
+            INSERT IGNORE INTO {conf.CLEAN_DATA_TABLE} (timestamp, turbine_id, wind_speed, wind_direction, power_output)
+            VALUES (%s, %s, %s, %s, %s)
+        """
+        with timed_batch("in_memory clean", rows=len(clean_records)):
+            bulk_write(cursor, clean_query, clean_records)
+        update_cleaned_state_from_memory(cursor, new_records, anomalies)
+        if raw_id_range is not None:
+            set_watermark(cursor, CLEAN_RAW_ID_WATERMARK, raw_id_range[1])
+        for table_name, row_count in ((conf.CLEAN_DATA_TABLE, len(clean_records)), (conf.TURBINE_STATE_TABLE, 0)):
+            record_commit(cursor, table_resource(table_name), None if raw_id_range is None else f"raw_id:{raw_id_range[1]}", row_count)
+        connection.commit()
+
+    logging.info(f"{int(anomalies.sum())} anomalies and {len(clean_records)} clean records stored from memory")
+    return True
+
+
+def run_in_memory(connection):
+    logging.info(f"run_in_memory function called....\n")
+
+    """ Ingest all CSVs of the raw data folder and clean the new records in memory.
+        Returns a StepResult.
+    """
+    csv_files = get_csv_files()
+    if not csv_files:
+        logging.warning(f"There are no new CSV files found in the data/raw folder")
+        return StepResult(NO_DATA, "no new rows in the raw data folder")
+
+    held_frames = []
+    held_rows = 0
+    loaded_rows = 0
+    # raw rows left uncleaned by an interrupted run aren't in memory, they are cleaned from the raw table
+    within_budget = get_new_raw_id_range(connection) is None
+    if not within_budget:
+        logging.info(f"Raw rows of an interrupted run found, cleaning from the raw table")
+    for file in csv_files:
+        new_frames = ingest_file(connection, os.path.join(conf.RAW_DATA_FOLDER, file))
+        if new_frames is None:
+            return StepResult(FAILED, f"failed to ingest {file}")
+        rows = sum(len(frame) for frame in new_frames)
+        loaded_rows += rows
+
+        held_rows += rows
+        if within_budget and held_rows > get_rows_within_budget():
+            logging.info(f"New records exceed the memory budget of {conf.MEMORY_BUDGET_MB} MB, cleaning from the raw table instead")
+            within_budget = False
+            held_frames = []
+        if within_budget:
+            held_frames.extend(new_frames)
+
+    if conf.COLUMN_STORE:
+        from column_store import sync_from_database
+        sync_from_database(connection)
+
+    # anomaly bounds as in detect_and_store_anomalies: clean data of the previous runs, raw data on the first load
+    with connection.cursor() as cursor:
+        bounds = get_anomaly_bounds(cursor)
+
+    import pandas as pd
+
+    held_frames = [frame for frame in held_frames if not frame.empty]
+    raw_id_range = get_new_raw_id_range(connection)
+    if bounds is None and raw_id_range is not None:
+        # as detect_and_store_anomalies - unscored rows aren't cleaned and the watermark isn't moved,
+        # the next run finds them in the raw table
+        logging.warning(f"No anomaly bounds, raw rows {raw_id_range} left unscored and uncleaned")
+    elif within_budget and held_frames:
+        if not clean_new_records(connection, pd.concat(held_frames, ignore_index=True), bounds, raw_id_range):
+            return StepResult(FAILED, "failed to clean the new records")
+    elif not within_budget and raw_id_range is not None:
+        from clean_data import detect_and_store_anomalies
+
+        scored = detect_and_store_anomalies(connection, raw_id_range)
+        if scored is False or (scored != NOT_SCORED and (not process_statistics(connection, raw_id_range)
+                                                        or not update_clean_table(connection, raw_id_range))):
+            return StepResult(FAILED, "failed to clean the new records from the raw table")
+
+    # corrections of already loaded records need the stored history, they are re-cleaned in the database
+    if not apply_late_corrections(connection):
+        return StepResult(FAILED, "failed to apply late corrections")
+
+    if loaded_rows == 0:
+        return StepResult(NO_DATA, "no new rows in the raw data folder")
+    return StepResult(SUCCESS, rows=loaded_rows)
+
+
+def main():
+    connection = None
+    try:
+        logging.info(f"Wind Turbine - In-memory ingestion and cleaning starts \n")
+        connection = conf.get_db_connection()
+        if connection is None:
+            logging.error(f"DB Connection failed - check get_db_connection function in config.py")
+            return StepResult(FAILED, "DB connection failed")
+        return run_in_memory(connection)
+
+    except Exception as e:
+        logging.error(f"In-memory ingestion and cleaning - Unexpected error occurred: {e}\n")
+        return StepResult(FAILED, str(e))
+    finally:
+        if connection:
+            connection.close()
+            logging.info("DB Connection closed.")
+
+
+if __name__ == "__main__":
+    conf.initialize()
+    result = main()
+    logging.info(f"In-memory ingestion and cleaning - completed \n")
@@ -2,11 +2,18 @@ import logging
 import os
 import shutil
 import traceback
-import pandas as pd
 # import mysql.connector
 from mysql.connector import Error
 from datetime import datetime
 import config as conf
+from change_log import record_changed_keys
+from memory_mode import compact_frame, get_csv_chunksize, get_dtypes
+from dag import StepResult, SUCCESS, NO_DATA, FAILED
+from log_setup import log_sql
+from metrics import add_counts, timed_batch
+from run_ledger import record_commit, table_resource
+from turbine_registry import register_turbines
+from turbine_state import update_ingested_state
 
 
 def move_csv_to_archive(file_path):
@@ -14,6 +21,7 @@ def move_csv_to_archive(file_path):
     logging.info(f"move_csv_to_archive function called....\n")
     try:
         # Move the file to archive folder
+        os.makedirs(conf.ARCHIVE_FOLDER, exist_ok=True)
         archive_file = os.path.join(conf.ARCHIVE_FOLDER, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.path.basename(file_path)}")
         shutil.move(file_path, archive_file)
         #print(f"Processed and archived: {file_path} \n")
@@ -24,6 +32,13 @@ def move_csv_to_archive(file_path):
         return False 
 
 
+def get_csv_files():
+    # source CSVs waiting in the raw data folder (by prefix and extension, other files are ignored)
+    if not os.path.isdir(conf.RAW_DATA_FOLDER):
+        return []
+    return sorted(f for f in os.listdir(conf.RAW_DATA_FOLDER) if f.startswith(conf.SOURCE_DATA_CSV_PREFIX) and f.endswith('.csv'))
+
+
 def get_last_processed_info(connection,file_name):
     
     # #print(f"get_last_processed_info function called.... \n")
@@ -47,7 +62,7 @@ def get_last_processed_info(connection,file_name):
             ORDER BY data_insertion_date DESC 
             LIMIT 1
             """
-            logging.info(f"SQL Query for get_last_processed_info - {query}")
+            log_sql("get_last_processed_info query", query, (file_name,))
 
             cursor.execute(query, (file_name,))
             result = cursor.fetchone()
@@ -64,13 +79,14 @@ def get_last_processed_info(connection,file_name):
         logging.error(f"Error fetching last processed info: {e}")
         return None
     
-def update_wind_turbine_ingestion_tracker(connection, file_name, last_record_timestamp,last_record_csv_row_number):
+def update_wind_turbine_ingestion_tracker(connection, file_name, last_record_timestamp,last_record_csv_row_number, commit=True):
     
     #print(f"update_wind_turbine_ingestion_tracker function called.... \n")
     logging.info(f"update_wind_turbine_ingestion_tracker function called....\n")
 
     """ Function to update last processed timestamp 
         This function keeps a track of every CSV load.
+        With commit=False the tracker row is committed by the caller, together with the loaded rows.
     """
     try:
         with connection.cursor() as cursor:
@@ -79,10 +95,11 @@ def update_wind_turbine_ingestion_tracker(connection, file_name, last_record_tim
             VALUES (%s, %s, %s)
             """
             
-            logging.info(f"SQL query for update_wind_turbine_ingestion_tracker: {insert_query}")
+            log_sql("update_wind_turbine_ingestion_tracker query", insert_query)
             
             cursor.execute(insert_query, (file_name, last_record_timestamp, last_record_csv_row_number))
-            connection.commit()
+            if commit:
+                connection.commit()
             logging.info(f"Table {conf.INGESTION_TRACKER_TABLE} updated")
         return True    
     except Error as e:
@@ -90,12 +107,104 @@ def update_wind_turbine_ingestion_tracker(connection, file_name, last_record_tim
         logging.error(f"Error updating ingestion tracker: {e}")
         return False
 
+def read_new_rows(file_path, rows_to_skip, max_chunk_rows=None):
+    
+    """ Yields the not yet processed rows of the CSV as DataFrames, i.e. skipping the first rows_to_skip
+        data rows. The whole remainder comes as one frame if it fits into conf.MEMORY_BUDGET_MB,
+        in chunks otherwise (and in chunks of at most max_chunk_rows rows when given). Memory efficient
+        mode reads the measurements as float32 (turbine_id is downcast to int16 by compact_frame once it
+        is known to have no missing values).
+    """
+    import pandas as pd
+
+    chunksize = get_csv_chunksize(file_path)
+    if max_chunk_rows is not None:
+        chunksize = min(chunksize or max_chunk_rows, max_chunk_rows)
+    read_options = {"chunksize": chunksize}
+    if rows_to_skip:
+        read_options["skiprows"] = range(1, rows_to_skip + 1)
+    if conf.MEMORY_EFFICIENT_MODE:
+        read_options["dtype"] = {column: dtype for column, dtype in get_dtypes().items() if column != "turbine_id"}
+
+    chunks = pd.read_csv(file_path, **read_options)
+    for new_data in ([chunks] if chunksize is None else chunks):
+        new_data['timestamp'] = pd.to_datetime(new_data['timestamp'])
+        yield compact_frame(new_data)
+
+def insert_raw_rows(cursor, new_data, file_name=None):
+    
+    """ Upsert the rows of the DataFrame into the raw table, returns the keys of changed records.
+        Turbines of the batch the registry doesn't know yet are registered with the file name.
+
+        Re-delivered rows may correct an already loaded record. For 'ON DUPLICATE KEY UPDATE'
+        MySQL reports 1 affected row for a new record, 2 when an existing record was changed
+        and 0 when it was left as is. Changed keys go to the change log so downstream steps
+        can re-clean and re-aggregate only them. The latest reading of every turbine of the batch
+        goes to the turbine state table.
+    """
+    import pandas as pd
+
+    changed_keys = []
+
+    insert_query = f'''
+    INSERT INTO {conf.RAW_DATA_TABLE} (timestamp, turbine_id, wind_speed, wind_direction, power_output)
+    VALUES (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE wind_speed=VALUES(wind_speed), wind_direction=VALUES(wind_direction), power_output=VALUES(power_output);
+    '''
+
+    for row in new_data.itertuples(index=False, name=None):       
+        if len(row) == 5 and pd.notna(row[0]) and pd.notna(row[1]):
+            # missing values (NaN) are stored as NULL
+            wind_speed = row[2] if pd.notna(row[2]) else None
+            wind_direction = row[3] if pd.notna(row[3]) else None
+            power_output = row[4] if pd.notna(row[4]) else None    
+        
+            cursor.execute(insert_query, (
+                row[0], row[1], wind_speed,wind_direction, power_output
+            ))
+            if cursor.rowcount == 2:
+                changed_keys.append((row[0], row[1]))
+            
+        else:
+            #print(f"Data loading to Raw Data table - Skipping invalid row: {row}")
+            logging.warning("Data loading to Raw Data table - Skipping invalid row: %s", row)    
+
+    register_turbines(cursor, new_data["turbine_id"].dropna().unique(), file_name)
+    update_ingested_state(cursor, new_data)
+    return changed_keys
+
+def load_new_rows(cursor, file_path, rows_to_skip):
+    
+    """ Upsert the new rows of the CSV into the raw table (uncommitted), chunk by chunk.
+        Returns (number of new rows, timestamp of the last new row, changed keys).
+    """
+    changed_keys = []
+    new_rows_count = 0
+    last_timestamp = None
+
+    for new_data in read_new_rows(file_path, rows_to_skip):
+        if new_data.empty:
+            continue
+
+        last_timestamp = new_data.iloc[-1]['timestamp']
+        new_rows_count += len(new_data)
+
+        #print(f"Processing new data {len(new_data)} new rows for {file_path}.\n")
+        logging.info("Processing new data %s new rows for %s", len(new_data), file_path)
+        add_counts(rows_read=len(new_data))
+        with timed_batch("ingest_csv batch", rows=len(new_data)):
+            changed_keys.extend(insert_raw_rows(cursor, new_data, os.path.basename(file_path)))
+
+    return new_rows_count, last_timestamp, changed_keys
+
 def ingest_csv(connection, file_path):
     
     # #print(f"ingest_csv function called.... \n")
     logging.info(f"ingest_csv function called....\n")
     
-    """Ingest CSV data into the raw table, skipping already loaded rows."""
+    """ Ingest CSV data into the raw table, skipping already loaded rows.
+        Returns the number of new rows loaded (0 when the CSV has no new data) or None on failure.
+    """
     try:
         # get the cursor
         cursor = connection.cursor()
@@ -112,72 +221,60 @@ def ingest_csv(connection, file_path):
         
         if last_csv_processed_info is None:
             #print(f"first run for {file_path}. Processing all records.\n")
-            #here reading the entire file and creating Panda's dataframe
-            new_data = pd.read_csv(file_path)
-            new_data['timestamp'] = pd.to_datetime(new_data['timestamp'])
-
-            # captyring last record timestamp and row numbet to update 'wind_turbine_ingestion_tracker' table.
-            last_record_timestamp = new_data.iloc[-1]['timestamp']
-            last_record_row_number = len(new_data)
-            #print(f"last_record_timestamp: {last_record_timestamp} \n")
-            #print(f"last_record_row_number: {last_record_row_number} \n")
+            #here reading the entire file
+            last_record_timestamp, last_record_row_number = None, 0
         else:
             # Use the tracking info to find the new data/rows in the CVS file
             last_record_timestamp, last_record_row_number = last_csv_processed_info
-            # Already processed records are ignored and only new data will be read by skipping earlier processed records
-            new_data = pd.read_csv(file_path, skiprows=range(1, last_record_row_number + 1))  
-            new_data['timestamp'] = pd.to_datetime(new_data['timestamp'])
-
-            if not new_data.empty:
-                last_record_timestamp = new_data.iloc[-1]['timestamp']
-                last_record_row_number = last_record_row_number + len(new_data)
-                #print(f"new last_record_timestamp: {last_record_timestamp} \n")
-                #print(f"new last_record_row_number: {last_record_row_number} \n")
+
+        """ Already processed records are ignored and only new data will be read by skipping earlier processed records.
+            A file larger than the memory budget is read and loaded chunk by chunk, all chunks are
+            committed together. Pipelined ingestion parses the next chunks while a chunk is written.
+        """
+        if conf.PIPELINED_INGESTION:
+            from pipelined_ingest import load_new_rows_pipelined
+            new_rows_count, last_timestamp, changed_keys = load_new_rows_pipelined(cursor, file_path, last_record_row_number)
+        else:
+            new_rows_count, last_timestamp, changed_keys = load_new_rows(cursor, file_path, last_record_row_number)
+
+        # captyring last record timestamp and row numbet to update 'wind_turbine_ingestion_tracker' table.
+        if new_rows_count:
+            last_record_timestamp = last_timestamp
+            last_record_row_number = last_record_row_number + new_rows_count
        
+        add_counts(bytes_parsed=os.path.getsize(file_path))
+
         # If no new data provided in the CSV
-        if new_data.empty:
+        if new_rows_count == 0:
             # Note - no new data found but still moving file to the archive folder
             #print(f"no new data found in the {file_path} csv but still file moved to the archive folder \n")
             logging.info(f"no new data found in the {file_path} csv but still file moved to the archive folder")
             # Move the file to archive folder
             move_csv_to_archive(file_path)
-            return False
+            return 0
         else:
-            #print(f"Processing new data {len(new_data)} new rows for {file_path}.\n")
-            logging.info(f"Processing new data {len(new_data)} new rows for {file_path}")
-                            
-            for row in new_data.itertuples(index=False, name=None):       
-                if len(row) == 5 and row[0] is not None and row[1] is not None:
-                    wind_speed = row[2] if row[2] else None
-                    wind_direction = row[3] if row[3] else None
-                    power_output = row[4] if row[4] else None    
-                
-                    insert_query = f'''
-                    INSERT INTO {conf.RAW_DATA_TABLE} (timestamp, turbine_id, wind_speed, wind_direction, power_output)
-                    VALUES (%s, %s, %s, %s, %s)
-                    ON DUPLICATE KEY UPDATE wind_speed=VALUES(wind_speed), wind_direction=VALUES(wind_direction), power_output=VALUES(power_output);
-                    '''
-                    cursor.execute(insert_query, (
-                        row[0], row[1], wind_speed,wind_direction, power_output
-                    ))
-                    
-                else:
-                    #print(f"Data loading to Raw Data table - Skipping invalid row: {row}")
-                    logging.warning(f"Data loading to Raw Data table - Skipping invalid row: {row}")    
-            
+            record_changed_keys(cursor, changed_keys)
+
+            """ The tracker row and the run ledger row are committed in the same transaction as the data,
+                so a crash can't leave loaded rows without their tracker row (the file would be re-read from
+                the start on the next run). If the process dies before the file is archived, the next run
+                finds no new rows in it and just archives it.
+            """
+            if not update_wind_turbine_ingestion_tracker(connection, file_name_only, last_record_timestamp, last_record_row_number, commit=False):
+                raise Error(f"ingestion tracker update failed for {file_name_only}")
+            record_commit(cursor, table_resource(conf.RAW_DATA_TABLE),
+                          f"{file_name_only}:{last_record_row_number}", new_rows_count)
+            record_commit(cursor, table_resource(conf.TURBINE_STATE_TABLE), f"{file_name_only}:{last_record_row_number}")
+
             connection.commit()
             cursor.close()
-            logging.info(f"Data load ({len(new_data)} records) for {file_path} is Successful")
+            logging.info(f"Data load ({new_rows_count} records) for {file_path} is Successful")
 
-            # Update wind turbine load tracker table for future reference.
-            if last_record_timestamp and last_record_row_number:
-                update_wind_turbine_ingestion_tracker(connection, file_name_only, last_record_timestamp, last_record_row_number)
-                # Move the file to archive folder
-                move_csv_to_archive(file_path)
-                
-                #print(f"\nCSV file: {file_name_only} processing ends \n")
+            # Move the file to archive folder
+            move_csv_to_archive(file_path)
+            #print(f"\nCSV file: {file_name_only} processing ends \n")
             
-            return True
+            return new_rows_count
         
     except Exception as e:
         #print(f"Error ingesting CSV {file_path}: {e}")
@@ -185,7 +282,7 @@ def ingest_csv(connection, file_path):
         connection.rollback()
         traceback.print_exc() 
         logging.error(f"Error ingesting CSV {file_path}: {e}")
-        return False
+        return None
         
 def ingest_all_csvs(connection):
     # #print(f"ingest_all_csvs function called.... \n")
@@ -196,15 +293,19 @@ def ingest_all_csvs(connection):
             Here, check the name of the CSV as in Prefix and also extension 'csv' all other files
             (if any) will be ignored.
             also later (once file is processed it will be moved to the Archive folder)
+
+            Returns the total number of new rows loaded (0 when there is nothing new) or None when
+            any of the CSVs failed.
         """
-        csv_files = [f for f in os.listdir(conf.RAW_DATA_FOLDER) if f.startswith(conf.SOURCE_DATA_CSV_PREFIX) and f.endswith('.csv')]
+        csv_files = get_csv_files()
         
         if not csv_files:
             #print(f"\nThere are no new CSV files found in the data/raw folder\n")
             logging.warning(f"There are no new CSV files found in the data/raw folder")
-            return False
+            return 0
         else:    
             success = True
+            rows_loaded = 0
             for file in csv_files:
                 #print(f"\nCSV file: {file} processing starts \n")
                 logging.info(f"CSV file: {file} processing starts")
@@ -212,12 +313,19 @@ def ingest_all_csvs(connection):
                 # calling ingest_csv function to ingest the data
                 result = ingest_csv(connection, os.path.join(conf.RAW_DATA_FOLDER, file))
                 
-                if not result:
+                if result is None:
                     logging.error(f"Failed to process CSV: {file}")
                     success = False
+                else:
+                    rows_loaded += result
                     
                 logging.info(f"CSV file: {file} processing ends")
-            return success
+
+            # the column store gets the committed rows only, rows of a rolled back CSV never reach it
+            if conf.COLUMN_STORE:
+                from column_store import sync_from_database
+                sync_from_database(connection)
+            return rows_loaded if success else None
     except Error as e:
         #print(f"error ingest_all_csvs: {e}")
         logging.error(f"error ingest_all_csvs: {e}")
@@ -238,26 +346,31 @@ def main():
         if connection is None:
             #print(f"MySQL DB connection failed.")     
             logging.info(f"DB Connection failed - check get_db_connection function in config.py")
-            return False
+            return StepResult(FAILED, "DB connection failed")
         else:
             # start data ingestion process
             logging.info(f"Step 2 - start ingesting CSVs")
-            if not ingest_all_csvs(connection):
+            rows_loaded = ingest_all_csvs(connection)
+            if rows_loaded is None:
                 logging.error(f"Failed to ingest one or all CSVs")
-                return False  
-            
-            return True
+                return StepResult(FAILED, "failed to ingest one or all CSVs")
+
+            # no CSVs / no new rows isn't a failure, the downstream steps just have nothing new to do
+            if rows_loaded == 0:
+                return StepResult(NO_DATA, "no new rows in the raw data folder")
+            return StepResult(SUCCESS, rows=rows_loaded)
     
     except Error as e:
         #print(f"error get_db_connection: {e} \n")
         logging.error(f"error get_db_connection: {e}")
-        return False
+        return StepResult(FAILED, str(e))
     finally:
         if connection:
             connection.close()  
             logging.info(f"DB connection closed.")  
 
 if __name__ == "__main__":
+    conf.initialize()
     result = main()
     logging.info(f"Data Ingestion - completed \n")
     
\ No newline at end of file
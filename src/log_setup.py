@@ -0,0 +1,138 @@
+""" Logging of the pipeline processes, set up by config.initialize().
+
+    Records go through a queue to a background writer thread (QueueHandler / QueueListener), so a
+    step never waits for the log file. Messages are formatted on the writer thread too: log hot path
+    messages lazily, logging.info("%s rows", rows) instead of an f-string, and don't mutate the
+    arguments after logging them.
+
+    Each line of the log file is a JSON record (conf.LOG_FORMAT = "json") with the time, level, logger,
+    thread, pipeline step and message, or the plain text format of the earlier log files ("text").
+
+    A call site logging more than conf.LOG_RATE_LIMIT records in conf.LOG_RATE_INTERVAL seconds (e.g. a
+    warning per invalid CSV row) is rate limited; the next record written from it carries the number
+    suppressed. Errors are never suppressed.
+
+    SQL text is only logged with log_sql when tracing is switched on (conf.LOG_SQL / WIND_TURBINE_LOG_SQL=1).
+"""
+
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+import config as conf
+from metrics import get_current_step
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+SQL_LOGGER = logging.getLogger("wind_turbine.sql")
+
+_listener = {"listener": None}
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per record. Fields passed as extra={"fields": {...}} are added to the object. """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, DATE_FORMAT),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "step": getattr(record, "step", None),
+            "message": record.getMessage().strip(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """ Lets through at most limit records per call site (file and line) in each interval of seconds,
+        counts the rest. Runs in the logging thread, so it also records the thread's pipeline step.
+    """
+
+    def __init__(self, limit, interval):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        record.step = get_current_step()
+        if record.levelno >= logging.ERROR:
+            return True
+
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            window_start, count, suppressed = self.windows.get(key, (now, 0, 0))
+            if now - window_start >= self.interval:
+                window_start, count = now, 0
+            if count >= self.limit:
+                self.windows[key] = (window_start, count, suppressed + 1)
+                return False
+            self.windows[key] = (window_start, count + 1, 0)
+        record.suppressed = suppressed
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    # QueueHandler.prepare formats the message in the logging thread, here the writer thread does it
+
+    def prepare(self, record):
+        if record.exc_info:
+            # the traceback can't wait, its frames change once the exception is handled
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def start_logging(log_file):
+    """ Log the root logger's records at INFO (and SQL traces when conf.LOG_SQL) to log_file through
+        a background writer thread. Started once per process, stopped at exit.
+    """
+    if _listener["listener"] is not None:
+        return _listener["listener"]
+
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(JsonFormatter() if conf.LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+
+    records = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(records)
+    queue_handler.addFilter(RateLimitFilter(conf.LOG_RATE_LIMIT, conf.LOG_RATE_INTERVAL))
+
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(logging.INFO)
+    SQL_LOGGER.setLevel(logging.DEBUG if conf.LOG_SQL else logging.WARNING)
+
+    listener = QueueListener(records, file_handler)
+    listener.start()
+    _listener["listener"] = listener
+    atexit.register(stop_logging)
+    return listener
+
+
+def stop_logging():
+    # write the queued records and stop the writer thread
+    listener = _listener["listener"]
+    if listener is not None:
+        listener.stop()
+        _listener["listener"] = None
+
+
+def log_sql(name, query, params=None):
+    # opt-in SQL tracing, the query is only collapsed to one line when tracing is on
+    if SQL_LOGGER.isEnabledFor(logging.DEBUG):
+        SQL_LOGGER.debug("%s: %s", name, " ".join(query.split()), extra={"fields": {"params": params}})
@@ -0,0 +1,135 @@
+""" Memory efficient mode for the pipeline DataFrames.
+
+    With conf.MEMORY_EFFICIENT_MODE the frames use float32 measurements, int16 turbine ids (int32 for
+    database fetches and ids that don't fit), datetime64 days and categorical periods (about half the
+    memory of float64 / int64 / object).
+    conf.MEMORY_BUDGET_MB caps the memory a step's input frame may take, larger inputs
+    (e.g. a big CSV) are processed in chunks instead of being loaded at once.
+"""
+
+import logging
+import os
+import threading
+import config as conf
+
+MEASUREMENT_COLUMNS = ["wind_speed", "wind_direction", "power_output"]
+
+# pandas needs roughly this many times the final frame size while parsing / converting
+PARSE_OVERHEAD = 3
+
+
+def get_dtypes():
+    # dtypes of the turbine_id and measurement columns for read_csv / db_fetch
+    import numpy as np
+
+    if conf.MEMORY_EFFICIENT_MODE:
+        # int32 - the column is a MySQL INT, int16 overflows for ids > 32767 (compact_frame downcasts the ids that fit)
+        dtypes = {"turbine_id": np.int32}
+        dtypes.update({column: np.float32 for column in MEASUREMENT_COLUMNS})
+    else:
+        dtypes = {"turbine_id": np.int64}
+        dtypes.update({column: np.float64 for column in MEASUREMENT_COLUMNS})
+    return dtypes
+
+
+def get_bytes_per_row():
+    # in memory size of one reading (timestamp + turbine_id + 3 measurements)
+    import numpy as np
+
+    return 8 + sum(np.dtype(dtype).itemsize for dtype in get_dtypes().values())
+
+
+def compact_frame(df):
+    """ Convert a DataFrame to the compact dtypes (in memory efficient mode only).
+        measurements -> float32, turbine_id -> int16, day -> datetime64, period -> category
+    """
+    if not conf.MEMORY_EFFICIENT_MODE or df.empty:
+        return df
+
+    import numpy as np
+    import pandas as pd
+
+    conversions = {}
+    for column in MEASUREMENT_COLUMNS:
+        if column in df:
+            conversions[column] = np.float32
+    if "turbine_id" in df and df["turbine_id"].notna().all() and df["turbine_id"].abs().max() <= np.iinfo(np.int16).max:
+        conversions["turbine_id"] = np.int16
+    if "period" in df:
+        conversions["period"] = "category"
+    df = df.astype(conversions, copy=False)
+
+    if "day" in df and df["day"].dtype == object:
+        df["day"] = pd.to_datetime(df["day"])
+    return df
+
+
+def get_rows_within_budget():
+    # number of readings a step may hold in memory at once
+    return max(int(conf.MEMORY_BUDGET_MB * 1024 * 1024 / (get_bytes_per_row() * PARSE_OVERHEAD)), 1)
+
+
+def get_csv_chunksize(file_path):
+    """ Returns the number of rows to read from the CSV at a time, or None when the whole file
+        fits into conf.MEMORY_BUDGET_MB. Row count is estimated from the file size and the
+        length of the first lines.
+    """
+    file_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as file:
+        sample = file.read(64 * 1024)
+    sample_lines = max(sample.count(b"\n"), 1)
+    estimated_rows = file_size * sample_lines / max(len(sample), 1)
+
+    rows_within_budget = get_rows_within_budget()
+    if estimated_rows <= rows_within_budget:
+        return None
+
+    logging.info(f"{file_path} (~{int(estimated_rows)} rows) exceeds the memory budget of {conf.MEMORY_BUDGET_MB} MB, "
+                 f"processing {rows_within_budget} rows at a time")
+    return rows_within_budget
+
+
+def get_rss_mb():
+    # current resident set size of the process in MB, None where /proc isn't available (not Linux)
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+class RssSampler:
+    """ Samples the process RSS every interval seconds in a background thread while a step runs and
+        keeps the highest value - the peak of the step, unlike ru_maxrss, the high-water mark of the whole
+        process since it started. Peaks shorter than the interval can be missed.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.start_mb = self.peak_mb = get_rss_mb()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="rss-sampler", daemon=True)
+
+    def sample(self):
+        rss_mb = get_rss_mb()
+        if rss_mb is not None and (self.peak_mb is None or rss_mb > self.peak_mb):
+            self.peak_mb = rss_mb
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        # no thread where the RSS can't be read
+        if self.start_mb is not None:
+            self.thread.start()
+        return self
+
+    def stop(self):
+        # returns the peak RSS in MB, None where the RSS can't be read
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.sample()
+        return self.peak_mb
@@ -0,0 +1,400 @@
+""" Run metrics - wall time, rows and bytes handled and peak RSS per pipeline step, plus timings
+    of every SQL statement and ingestion batch.
+
+    conf.get_db_connection returns an instrumented connection, its cursors time each execute /
+    executemany and count the rows fetched and written. Timings are attributed to the step running
+    in the current thread (see step_metrics), so parallel steps are measured separately. Statements run
+    inside a timed_batch (e.g. one execute per CSV row) are added up by the thread and recorded once
+    at the end of the batch.
+    At the end of a run write_run_metrics writes logs/metrics_<run>.json and a Prometheus
+    textfile-collector file (conf.METRICS_PROM_FILE), and logs the slowest statements and the steps
+    that got slower than in the previous run.
+"""
+
+import glob
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from datetime import datetime
+
+import config as conf
+
+# statements reported as the slowest queries of a run
+SLOWEST_QUERIES = 10
+
+# a step is reported as a regression when it takes this many times its previous wall time
+REGRESSION_FACTOR = 1.5
+
+_lock = threading.Lock()
+_current = threading.local()
+_steps = {}
+_timings = {}
+
+
+def reset():
+    # forget the collected metrics, e.g. before a new run in the same process
+    with _lock:
+        _steps.clear()
+        _timings.clear()
+
+
+def get_current_step():
+    return getattr(_current, "step", None) or "unattributed"
+
+
+def _get_step(step_name):
+    return _steps.setdefault(step_name, {
+        "status": None, "wall_time_seconds": 0.0, "rows_read": 0, "rows_written": 0,
+        "bytes_parsed": 0, "peak_rss_mb": None, "peak_rss_growth_mb": None,
+    })
+
+
+def add_counts(rows_read=0, rows_written=0, bytes_parsed=0):
+    # add to the counters of the step running in this thread
+    if not conf.METRICS_ENABLED:
+        return
+    with _lock:
+        step = _get_step(get_current_step())
+        step["rows_read"] += rows_read
+        step["rows_written"] += rows_written
+        step["bytes_parsed"] += bytes_parsed
+
+
+def set_step_status(step_name, status):
+    if not conf.METRICS_ENABLED:
+        return
+    with _lock:
+        _get_step(step_name)["status"] = status
+
+
+def record_timing(kind, name, seconds, rows=0, calls=1):
+    # kind is "query" or "batch", timings of the same statement / batch name are aggregated per step
+    if not conf.METRICS_ENABLED:
+        return
+    with _lock:
+        timing = _timings.setdefault((kind, get_current_step(), name), {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "rows": 0})
+        timing["count"] += calls
+        timing["total_seconds"] += seconds
+        timing["max_seconds"] = max(timing["max_seconds"], seconds)
+        timing["rows"] += rows
+
+
+def record_query(name, seconds, rows_read=0, rows_written=0, calls=1):
+    # timing and rows of a statement, added to the open batch of this thread if there is one (see timed_batch)
+    pending = getattr(_current, "pending_queries", None)
+    if pending is None:
+        record_timing("query", name, seconds, rows_read + rows_written, calls)
+        if rows_read or rows_written:
+            add_counts(rows_read=rows_read, rows_written=rows_written)
+        return
+
+    timing = pending.get(name)
+    if timing is None:
+        timing = pending[name] = {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "rows_read": 0, "rows_written": 0}
+    timing["count"] += calls
+    timing["total_seconds"] += seconds
+    if seconds > timing["max_seconds"]:
+        timing["max_seconds"] = seconds
+    timing["rows_read"] += rows_read
+    timing["rows_written"] += rows_written
+
+
+def _flush_queries(pending):
+    # add the statements added up by a batch to the run metrics, one lock for the whole batch
+    if not pending or not conf.METRICS_ENABLED:
+        return
+    step_name = get_current_step()
+    with _lock:
+        step = _get_step(step_name)
+        for name, values in pending.items():
+            timing = _timings.setdefault(("query", step_name, name), {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "rows": 0})
+            timing["count"] += values["count"]
+            timing["total_seconds"] += values["total_seconds"]
+            timing["max_seconds"] = max(timing["max_seconds"], values["max_seconds"])
+            timing["rows"] += values["rows_read"] + values["rows_written"]
+            step["rows_read"] += values["rows_read"]
+            step["rows_written"] += values["rows_written"]
+
+
+@contextmanager
+def timed_batch(name, rows=0):
+    # the statements of the batch are added up in this thread and recorded at its end (an inner batch
+    # adds to the outer one), not with a lock and a timing per execute
+    outer_batch = getattr(_current, "pending_queries", None) is not None
+    if not outer_batch:
+        _current.pending_queries = {}
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if not outer_batch:
+            pending, _current.pending_queries = _current.pending_queries, None
+            _flush_queries(pending)
+        record_timing("batch", name, seconds, rows)
+
+
+@contextmanager
+def attributed_to(step_name):
+    # attribute the statements / batches of this thread to step_name, e.g. in a helper thread of a step
+    previous_step = getattr(_current, "step", None)
+    _current.step = step_name
+    try:
+        yield
+    finally:
+        _current.step = previous_step
+
+
+@contextmanager
+def step_metrics(step_name):
+    """ Measure a pipeline step: wall time, the peak RSS sampled while it ran (peak_rss_mb) and how far
+        above the RSS at its start that peak went (peak_rss_growth_mb, the memory the step itself needed
+        when it runs alone - steps running in parallel share the process, so their memory is in both).
+        The statements / batches run by this thread meanwhile are attributed to the step. The caller
+        sets the status on the yielded dict.
+    """
+    from memory_mode import RssSampler
+
+    previous_step = getattr(_current, "step", None)
+    _current.step = step_name
+    with _lock:
+        step = _get_step(step_name)
+    sampler = RssSampler(conf.METRICS_RSS_SAMPLE_SECONDS).start() if conf.METRICS_ENABLED else None
+    start = time.perf_counter()
+    try:
+        yield step
+    finally:
+        peak_rss_mb = sampler.stop() if sampler is not None else None
+        with _lock:
+            step["wall_time_seconds"] += time.perf_counter() - start
+            if peak_rss_mb is not None:
+                # a step run more than once keeps its highest peak
+                step["peak_rss_mb"] = max(peak_rss_mb, step["peak_rss_mb"] or 0.0)
+                step["peak_rss_growth_mb"] = max(peak_rss_mb - sampler.start_mb, step["peak_rss_growth_mb"] or 0.0)
+        _current.step = previous_step
+
+
+@lru_cache(maxsize=1024)
+def get_statement_name(query):
+    # statement text with whitespace collapsed, values are passed as parameters so this identifies the statement
+    # (cached per query string, ingestion runs the same statement for every row)
+    statement = re.sub(r"\s+", " ", query).strip()
+    return statement if len(statement) <= 200 else statement[:197] + "..."
+
+
+@lru_cache(maxsize=1024)
+def is_write_statement(statement):
+    return not statement.upper().startswith(("SELECT", "SHOW", "WITH"))
+
+
+class InstrumentedCursor:
+    """ Cursor proxy timing execute / executemany and counting rows fetched and written. """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._statement = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._cursor.__exit__(*exc_info)
+
+    def _run(self, method, query, params):
+        self._statement = get_statement_name(query)
+        start = time.perf_counter()
+        try:
+            return method(query, params) if params is not None else method(query)
+        finally:
+            # rowcount of a SELECT is the rows fetched so far, those are counted by the fetch methods
+            rowcount = self._cursor.rowcount
+            rows_written = 0
+            if isinstance(rowcount, int) and rowcount > 0 and is_write_statement(self._statement):
+                rows_written = rowcount
+            record_query(self._statement, time.perf_counter() - start, rows_written=rows_written)
+
+    def execute(self, query, params=None):
+        return self._run(self._cursor.execute, query, params)
+
+    def executemany(self, query, seq_params):
+        return self._run(self._cursor.executemany, query, seq_params)
+
+    def _fetched(self, rows):
+        if rows and self._statement:
+            record_query(self._statement, 0.0, rows_read=len(rows), calls=0)
+        return rows
+
+    def fetchall(self):
+        return self._fetched(self._cursor.fetchall())
+
+    def fetchmany(self, *args, **kwargs):
+        return self._fetched(self._cursor.fetchmany(*args, **kwargs))
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._fetched([row])
+        return row
+
+
+class InstrumentedConnection:
+    """ Connection proxy handing out InstrumentedCursor's, everything else goes to the connection. """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __enter__(self):
+        self._connection.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._connection.__exit__(*exc_info)
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._connection.cursor(*args, **kwargs))
+
+
+def instrument_connection(connection):
+    if connection is None or not conf.METRICS_ENABLED:
+        return connection
+    return InstrumentedConnection(connection)
+
+
+def get_previous_metrics():
+    # metrics of the latest run written to the logs folder, None if there is none
+    metrics_files = sorted(glob.glob(os.path.join(conf.LOGS_DIR, "metrics_*.json")))
+    if not metrics_files:
+        return None
+    try:
+        with open(metrics_files[-1]) as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Previous run metrics {metrics_files[-1]} not readable: {e}")
+        return None
+
+
+def build_run_metrics(run_id):
+    with _lock:
+        timings = [
+            {"kind": kind, "step": step, "name": name, **values,
+             "avg_seconds": values["total_seconds"] / values["count"] if values["count"] else 0.0}
+            for (kind, step, name), values in _timings.items()
+        ]
+        steps = {name: dict(values) for name, values in _steps.items()}
+
+    for step in steps.values():
+        wall_time = step["wall_time_seconds"]
+        step["rows_per_second"] = (step["rows_read"] + step["rows_written"]) / wall_time if wall_time else 0.0
+
+    queries = sorted((timing for timing in timings if timing["kind"] == "query"), key=lambda timing: -timing["total_seconds"])
+    return {
+        "run_id": run_id,
+        "steps": steps,
+        "slowest_queries": queries[:SLOWEST_QUERIES],
+        "queries": queries,
+        "batches": [timing for timing in timings if timing["kind"] == "batch"],
+    }
+
+
+def get_regressions(run_metrics, previous_metrics):
+    # steps that took REGRESSION_FACTOR times longer than in the previous run
+    if not previous_metrics:
+        return []
+    regressions = []
+    for name, step in run_metrics["steps"].items():
+        previous = previous_metrics.get("steps", {}).get(name)
+        if previous and previous.get("wall_time_seconds") and step["wall_time_seconds"] > REGRESSION_FACTOR * previous["wall_time_seconds"]:
+            regressions.append({"step": name, "wall_time_seconds": step["wall_time_seconds"],
+                                "previous_wall_time_seconds": previous["wall_time_seconds"]})
+    return regressions
+
+
+def _prom_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def format_prometheus(run_metrics):
+    # Prometheus text exposition format, for the node exporter textfile collector
+    lines = []
+    step_metric_names = {
+        "wall_time_seconds": "wind_turbine_step_duration_seconds",
+        "rows_read": "wind_turbine_step_rows_read",
+        "rows_written": "wind_turbine_step_rows_written",
+        "bytes_parsed": "wind_turbine_step_bytes_parsed",
+        "peak_rss_mb": "wind_turbine_step_peak_rss_megabytes",
+        "peak_rss_growth_mb": "wind_turbine_step_peak_rss_growth_megabytes",
+    }
+    for key, metric_name in step_metric_names.items():
+        lines.append(f"# TYPE {metric_name} gauge")
+        for step_name, step in run_metrics["steps"].items():
+            if step[key] is not None:
+                lines.append(f'{metric_name}{{step="{_prom_label(step_name)}"}} {step[key]}')
+
+    lines.append("# TYPE wind_turbine_step_success gauge")
+    for step_name, step in run_metrics["steps"].items():
+        lines.append(f'wind_turbine_step_success{{step="{_prom_label(step_name)}",status="{step["status"]}"}} '
+                     f'{0 if step["status"] in ("failed", "blocked") else 1}')
+
+    lines.append("# TYPE wind_turbine_slowest_query_seconds gauge")
+    for rank, query in enumerate(run_metrics["slowest_queries"], start=1):
+        lines.append(f'wind_turbine_slowest_query_seconds{{rank="{rank}",step="{_prom_label(query["step"])}",'
+                     f'statement="{_prom_label(query["name"][:80])}"}} {query["total_seconds"]}')
+
+    lines.append("# TYPE wind_turbine_run_timestamp_seconds gauge")
+    lines.append(f"wind_turbine_run_timestamp_seconds {time.time()}")
+    return "\n".join(lines) + "\n"
+
+
+def write_run_metrics(run_id=None):
+    logging.info(f"write_run_metrics function called....\n")
+
+    """ Write the metrics of this run to logs/metrics_<run_id>.json and conf.METRICS_PROM_FILE.
+        Returns the run metrics dict, None when writing failed.
+    """
+    if not conf.METRICS_ENABLED:
+        return None
+
+    run_id = run_id or datetime.now().strftime("%Y%m%d_%H%M%S")
+    run_metrics = build_run_metrics(run_id)
+    run_metrics["regressions"] = get_regressions(run_metrics, get_previous_metrics())
+
+    for query in run_metrics["slowest_queries"][:3]:
+        logging.info(f"Slow query ({query['step']}): {query['total_seconds']:.3f}s over {query['count']} calls - {query['name']}")
+    for regression in run_metrics["regressions"]:
+        logging.warning(f"Regression: {regression['step']} took {regression['wall_time_seconds']:.2f}s, "
+                        f"previous run {regression['previous_wall_time_seconds']:.2f}s")
+
+    try:
+        os.makedirs(conf.LOGS_DIR, exist_ok=True)
+        metrics_file = os.path.join(conf.LOGS_DIR, f"metrics_{run_id}.json")
+        with open(metrics_file, "w") as file:
+            json.dump(run_metrics, file, indent=2, default=str)
+
+        # written to a temp file and renamed, so the collector never reads a half written file
+        prom_dir = os.path.dirname(conf.METRICS_PROM_FILE)
+        if prom_dir:
+            os.makedirs(prom_dir, exist_ok=True)
+        with open(conf.METRICS_PROM_FILE + ".tmp", "w") as file:
+            file.write(format_prometheus(run_metrics))
+        os.replace(conf.METRICS_PROM_FILE + ".tmp", conf.METRICS_PROM_FILE)
+
+        logging.info(f"Run metrics written to {metrics_file} and {conf.METRICS_PROM_FILE}")
+        return run_metrics
+    except OSError as e:
+        logging.error(f"Failed to write run metrics: {e}")
+        return None
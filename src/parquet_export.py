@@ -0,0 +1,255 @@
+""" Incremental Parquet export of the clean data and the daily summary (conf.PARQUET_EXPORT).
+
+    Runs after the cleaning and summary steps, so analysts and notebooks (pandas, pyarrow.dataset,
+    DuckDB, Spark) scan columnar files with partition pruning and predicate pushdown instead of
+    dumping the production tables:
+
+        <conf.PARQUET_EXPORT_FOLDER>/clean_data/day=2022-03-01/turbine_id=1/part-0.parquet
+        <conf.PARQUET_EXPORT_FOLDER>/summary_stats/day=2022-03-01/turbine_id=1/part-0.parquet
+        <conf.PARQUET_EXPORT_FOLDER>/_manifests/export_<time>.json
+
+    Only the (day, turbine_id) partitions changed since the previous export are written, found like the
+    daily summary's dirty days: clean records inserted or re-cleaned since the clean insertion_date
+    watermark, plus the keys of the change log (a corrected record may have been removed from the clean
+    table). Parquet files are immutable, so a changed partition (a day of one turbine) is rewritten as a
+    whole through a hidden temporary file and os.replace, readers never see a half written file.
+    A partition without clean records left is deleted.
+
+    Every export writes a manifest of the partitions it wrote and deleted, downstream jobs copy or
+    re-read just those. The watermark and change log offset move after the files and the manifest are
+    written: an export that died half way is redone by the next one, rewriting a partition is idempotent.
+
+    Needs the optional pyarrow package.
+"""
+
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+from mysql.connector import Error
+import config as conf
+from change_log import get_pending_change_range, mark_changes_consumed, purge_consumed_changes
+from dag import StepResult, SUCCESS, NO_DATA, FAILED
+from db_fetch import fetch_dataframe
+from run_ledger import record_commit
+from watermarks import get_watermark, set_watermark
+
+# last clean insertion_date included in the export
+EXPORT_WATERMARK = "parquet_export:clean_insertion_date"
+CHANGE_LOG_CONSUMER = "parquet_export"
+
+PARTITION_FILE = "part-0.parquet"
+# in the partition path, not in the files
+PARTITION_COLUMNS = ("day", "turbine_id")
+MANIFESTS_FOLDER = "_manifests"
+
+# dataset: (rows of the partitions of a [start, end) day range and some turbines, day column, dtypes)
+EXPORT_DATASETS = {
+    "clean_data": (f"""
+        SELECT timestamp, turbine_id, wind_speed, wind_direction, power_output, insertion_date
+        FROM {conf.CLEAN_DATA_TABLE}
+        WHERE timestamp >= %s AND timestamp < %s AND turbine_id IN ({{turbine_ids}})
+        ORDER BY turbine_id, timestamp
+    """, "timestamp", {"timestamp": "datetime64[us]", "turbine_id": "int32", "wind_speed": "float32",
+                       "wind_direction": "float32", "power_output": "float32", "insertion_date": "datetime64[us]"}),
+    "summary_stats": (f"""
+        SELECT day, turbine_id, min_power_output, max_power_output, avg_power_output
+        FROM {conf.SUMMARY_STATS_TABLE}
+        WHERE day >= %s AND day < %s AND turbine_id IN ({{turbine_ids}})
+        ORDER BY turbine_id, day
+    """, "day", {"day": "datetime64[us]", "turbine_id": "int32", "min_power_output": "float32",
+                 "max_power_output": "float32", "avg_power_output": "float32"}),
+}
+
+
+def get_partition_folder(dataset, day, turbine_id):
+    # hive style partition folder, relative to conf.PARQUET_EXPORT_FOLDER
+    return f"{dataset}/day={day.isoformat()}/turbine_id={turbine_id}"
+
+
+def get_dirty_partitions(connection):
+    logging.info(f"get_dirty_partitions function called....\n")
+
+    """ Find the (day, turbine_id) partitions whose clean data changed since the previous export.
+        Returns (partitions, clean_watermark, change_range), on the first export every partition of
+        the clean table is dirty.
+    """
+    prev_watermark = get_watermark(connection, EXPORT_WATERMARK)
+    change_range = get_pending_change_range(connection, CHANGE_LOG_CONSUMER)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT MAX(insertion_date) FROM {conf.CLEAN_DATA_TABLE}")
+        clean_watermark = cursor.fetchone()[0]
+
+        if prev_watermark is None:
+            logging.info(f"No export watermark found, exporting the full {conf.CLEAN_DATA_TABLE} table")
+            cursor.execute(f"SELECT DISTINCT DATE(timestamp), turbine_id FROM {conf.CLEAN_DATA_TABLE}")
+            return sorted(cursor.fetchall()), clean_watermark, change_range
+
+        # '>=' as for the daily summary, re-exporting a partition is idempotent
+        cursor.execute(f"""
+            SELECT DISTINCT DATE(timestamp), turbine_id FROM {conf.CLEAN_DATA_TABLE}
+            WHERE insertion_date >= %s
+        """, (prev_watermark,))
+        partitions = set(cursor.fetchall())
+
+        if change_range is not None:
+            cursor.execute(f"""
+                SELECT DISTINCT DATE(timestamp), turbine_id FROM {conf.CHANGE_LOG_TABLE}
+                WHERE id > %s AND id <= %s
+            """, change_range)
+            partitions.update(cursor.fetchall())
+
+    logging.info(f"{len(partitions)} partitions to export since watermark {prev_watermark}")
+    return sorted(partitions), clean_watermark, change_range
+
+
+def get_export_batches(partitions):
+    """ Group sorted (day, turbine_id) partitions into ([start, end) day range, turbine ids, partitions)
+        batches of consecutive days, at most conf.PARQUET_EXPORT_BATCH_DAYS days each, so a batch is
+        one index range scan and the memory held is a few days of the fleet.
+    """
+    batches = []
+    for day, turbine_id in partitions:
+        day_start = datetime.combine(day, datetime.min.time())
+        if batches and batches[-1][1] >= day_start and (day_start - batches[-1][0]).days < conf.PARQUET_EXPORT_BATCH_DAYS:
+            batches[-1][1] = day_start + timedelta(days=1)
+            batches[-1][2].add(turbine_id)
+            batches[-1][3].append((day, turbine_id))
+        else:
+            batches.append([day_start, day_start + timedelta(days=1), {turbine_id}, [(day, turbine_id)]])
+    return [(day_start, day_end, sorted(turbine_ids), batch) for day_start, day_end, turbine_ids, batch in batches]
+
+
+def write_partition(frame, path):
+    # through a hidden temporary file (readers skip names starting with "."), then swapped in
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    frame.to_parquet(temp_path, index=False, compression=conf.PARQUET_COMPRESSION)
+    os.replace(temp_path, path)
+
+
+def delete_partition(path):
+    if os.path.exists(path):
+        os.remove(path)
+        folder = os.path.dirname(path)
+        if not os.listdir(folder):
+            os.rmdir(folder)
+
+
+def export_batch(cursor, dataset, batch, changes):
+    # write / delete the dataset's partitions of one batch, changes collects them for the manifest
+    day_start, day_end, turbine_ids, partitions = batch
+    query, day_column, dtypes = EXPORT_DATASETS[dataset]
+    query = query.format(turbine_ids=", ".join(["%s"] * len(turbine_ids)))
+    frame = fetch_dataframe(cursor, query, (day_start, day_end, *turbine_ids), dtypes)
+
+    groups = {}
+    if not frame.empty:
+        days = frame[day_column].dt.date
+        values = frame.drop(columns=[column for column in PARTITION_COLUMNS if column in frame])
+        groups = {key: rows for key, rows in values.groupby([days, frame["turbine_id"]])}
+
+    for day, turbine_id in partitions:
+        folder = get_partition_folder(dataset, day, turbine_id)
+        path = os.path.join(conf.PARQUET_EXPORT_FOLDER, folder, PARTITION_FILE)
+        rows = groups.get((day, turbine_id))
+        if rows is None:
+            delete_partition(path)
+            changes[dataset]["deleted"].append(folder)
+        else:
+            write_partition(rows, path)
+            changes[dataset]["written"].append(folder)
+            changes[dataset]["rows"] += len(rows)
+
+
+def write_manifest(changes, clean_watermark, change_range):
+    # manifest of one export, named by time so they sort in export order
+    manifest = {
+        "exported_at": datetime.now().isoformat(timespec="seconds"),
+        "clean_insertion_date": None if clean_watermark is None else str(clean_watermark),
+        "change_log_id": None if change_range is None else change_range[1],
+        "datasets": changes,
+    }
+    folder = os.path.join(conf.PARQUET_EXPORT_FOLDER, MANIFESTS_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"export_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.json")
+    temp_path = os.path.join(folder, f".{os.path.basename(path)}.tmp")
+    with open(temp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(temp_path, path)
+    return path
+
+
+def export_parquet(connection):
+    logging.info(f"export_parquet function called....\n")
+
+    """ Export the partitions changed since the previous export, then move the watermark and the
+        change log offset. Returns the changes of the manifest ({} when nothing changed), None on failure.
+    """
+    try:
+        partitions, clean_watermark, change_range = get_dirty_partitions(connection)
+        if not partitions and change_range is None:
+            logging.info("No clean data changed since the previous export.")
+            return {}
+
+        changes = {dataset: {"written": [], "deleted": [], "rows": 0} for dataset in EXPORT_DATASETS}
+        with connection.cursor() as cursor:
+            for batch in get_export_batches(partitions):
+                for dataset in EXPORT_DATASETS:
+                    export_batch(cursor, dataset, batch, changes)
+
+            manifest_path = write_manifest(changes, clean_watermark, change_range)
+            rows_written = sum(dataset_changes["rows"] for dataset_changes in changes.values())
+
+            if clean_watermark is not None:
+                set_watermark(cursor, EXPORT_WATERMARK, clean_watermark)
+            if change_range is not None:
+                mark_changes_consumed(cursor, CHANGE_LOG_CONSUMER, change_range[1])
+            record_commit(cursor, f"files:{conf.PARQUET_EXPORT_FOLDER}", clean_watermark, rows_written)
+            connection.commit()
+
+        logging.info(f"{len(partitions)} partitions ({rows_written} rows) exported, manifest {manifest_path}")
+        return changes if purge_consumed_changes(connection) else None
+
+    except Error as e:
+        connection.rollback()
+        logging.error(f"export_parquet failed: {e}")
+        return None
+
+
+def main():
+    # pipeline step, see conf.PARQUET_EXPORT
+    connection = None
+    try:
+        logging.info(f"Wind Turbine - Parquet Export starts \n")
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            logging.error("Parquet export needs pyarrow, install it with 'pip install pyarrow'")
+            return StepResult(FAILED, "pyarrow is not installed")
+
+        connection = conf.get_db_connection()
+        if connection is None:
+            logging.error(f"DB Connection failed - check get_db_connection function in config.py")
+            return StepResult(FAILED, "DB connection failed")
+
+        changes = export_parquet(connection)
+        if changes is None:
+            return StepResult(FAILED, "Parquet export failed")
+        if not changes:
+            return StepResult(NO_DATA, "no changed partitions")
+        return StepResult(SUCCESS, rows=sum(dataset_changes["rows"] for dataset_changes in changes.values()))
+    except Exception as e:
+        logging.error(f"Parquet export - Unexpected error occurred: {e}\n")
+        return StepResult(FAILED, str(e))
+    finally:
+        if connection:
+            connection.close()
+            logging.info("DB Connection closed.")
+
+
+if __name__ == "__main__":
+    conf.initialize()
+    result = main()
@@ -0,0 +1,97 @@
+""" Pipelined ingestion (conf.PIPELINED_INGESTION) - overlaps CSV parsing with the raw table writes.
+
+    A parser stage reads and converts the CSV chunk by chunk (read_new_rows) into a bounded asyncio
+    queue, a writer stage upserts the chunks (insert_raw_rows) as they come. Both stages run their
+    blocking work on a thread of their own, so the next chunks are parsed while the DB round trips of a
+    chunk are running and a file takes about max(parse time, write time) instead of their sum.
+
+    The queue holds at most conf.PIPELINED_QUEUE_CHUNKS chunks: a parser ahead of the writer waits for
+    a free slot, memory stays at (queue size + 2) chunks of conf.PIPELINED_CHUNK_ROWS rows.
+
+    There is a single writer: all chunks of a file and its tracker row are committed in one
+    transaction on the step's connection (see ingest_csv), which one thread at a time can use.
+"""
+
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import config as conf
+import metrics
+from ingest_data import insert_raw_rows, read_new_rows
+
+# marks the end of the parsed chunks in the queue
+END_OF_FILE = None
+
+
+def run_in_step(step_name, func, *args):
+    # the statements / batches of the stage threads are attributed to the step running the ingestion
+    with metrics.attributed_to(step_name):
+        return func(*args)
+
+
+def next_chunk(chunks):
+    # next non empty chunk of the reader, END_OF_FILE when it is exhausted
+    for new_data in chunks:
+        if not new_data.empty:
+            return new_data
+    return END_OF_FILE
+
+
+async def parse_chunks(queue, parser, file_path, rows_to_skip, step_name):
+    # parser stage - a parse error is handed to the writer stage, which raises it
+    loop = asyncio.get_running_loop()
+    try:
+        chunks = read_new_rows(file_path, rows_to_skip, conf.PIPELINED_CHUNK_ROWS)
+        while True:
+            new_data = await loop.run_in_executor(parser, run_in_step, step_name, next_chunk, chunks)
+            # waits while the queue is full - the writer is behind
+            await queue.put(new_data)
+            if new_data is END_OF_FILE:
+                return
+    except Exception as e:
+        await queue.put(e)
+
+
+async def write_chunks(queue, writer, cursor, file_path, step_name):
+    # writer stage - returns (number of new rows, timestamp of the last new row, changed keys)
+    loop = asyncio.get_running_loop()
+    changed_keys = []
+    new_rows_count = 0
+    last_timestamp = None
+
+    while True:
+        new_data = await queue.get()
+        if new_data is END_OF_FILE:
+            return new_rows_count, last_timestamp, changed_keys
+        if isinstance(new_data, Exception):
+            raise new_data
+
+        last_timestamp = new_data.iloc[-1]['timestamp']
+        new_rows_count += len(new_data)
+        logging.info("Processing new data %s new rows for %s", len(new_data), file_path)
+        metrics.add_counts(rows_read=len(new_data))
+        with metrics.timed_batch("ingest_csv batch", rows=len(new_data)):
+            changed_keys.extend(await loop.run_in_executor(writer, run_in_step, step_name, insert_raw_rows, cursor, new_data,
+                                                           os.path.basename(file_path)))
+
+
+async def run_stages(cursor, file_path, rows_to_skip):
+    step_name = metrics.get_current_step()
+    queue = asyncio.Queue(maxsize=conf.PIPELINED_QUEUE_CHUNKS)
+    with ThreadPoolExecutor(1, thread_name_prefix="ingest-parser") as parser, \
+            ThreadPoolExecutor(1, thread_name_prefix="ingest-writer") as writer:
+        parsing = asyncio.ensure_future(parse_chunks(queue, parser, file_path, rows_to_skip, step_name))
+        try:
+            return await write_chunks(queue, writer, cursor, file_path, step_name)
+        finally:
+            # a failed write leaves the parser waiting on the full queue
+            parsing.cancel()
+
+
+def load_new_rows_pipelined(cursor, file_path, rows_to_skip):
+    """ Upsert the new rows of the CSV into the raw table (uncommitted) like ingest_data.load_new_rows,
+        parsing while writing. Returns (number of new rows, timestamp of the last new row, changed keys).
+    """
+    return asyncio.run(run_stages(cursor, file_path, rows_to_skip))
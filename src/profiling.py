@@ -0,0 +1,159 @@
+""" Opt-in profiling of pipeline steps.
+
+    Selected steps are wrapped in one of the profilers, output goes to logs/ named after the run and step:
+        cprofile    - logs/profile_<run>_<step>.pstats    (python -m pstats, snakeviz)
+        tracemalloc - logs/profile_<run>_<step>.tracemalloc (snapshot, tracemalloc.Snapshot.load)
+                      + .txt with the top allocating lines
+        sampling    - logs/profile_<run>_<step>.folded     (folded stacks for flamegraph.pl / speedscope)
+
+    Switched on with the pipeline's --profile / --profiler arguments or the WIND_TURBINE_PROFILE_STEPS /
+    WIND_TURBINE_PROFILER environment variables. Steps that aren't selected run their function as is,
+    so there is no overhead when profiling is off.
+"""
+
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import config as conf
+
+PROFILERS = ["cprofile", "tracemalloc", "sampling"]
+
+# lines listed in the tracemalloc text report
+TRACEMALLOC_TOP_LINES = 25
+
+# cProfile and tracemalloc are process wide, parallel steps are profiled one at a time
+_profiler_lock = threading.Lock()
+
+_settings = {"steps": set(), "profiler": None, "run_id": None}
+
+
+def get_step_slug(step_name):
+    # "Data Cleaning" -> "data_cleaning"
+    return re.sub(r"[^a-z0-9]+", "_", step_name.lower()).strip("_")
+
+
+def configure(steps=None, profiler=None):
+    """ Select the steps to profile (step names / slugs or "all") and the profiler,
+        defaults come from conf.PROFILE_STEPS and conf.PROFILER.
+    """
+    steps = conf.PROFILE_STEPS if steps is None else steps
+    profiler = profiler or conf.PROFILER
+    if steps and profiler not in PROFILERS:
+        raise ValueError(f"Unknown profiler {profiler}, use one of {PROFILERS}")
+
+    _settings["steps"] = {get_step_slug(step) for step in steps}
+    _settings["profiler"] = profiler
+    _settings["run_id"] = datetime.now().strftime("%Y%m%d_%H%M%S")
+    if steps:
+        logging.info(f"Profiling steps {sorted(_settings['steps'])} with {profiler}")
+
+
+def get_profile_path(step_name, extension):
+    os.makedirs(conf.LOGS_DIR, exist_ok=True)
+    return os.path.join(conf.LOGS_DIR, f"profile_{_settings['run_id']}_{get_step_slug(step_name)}.{extension}")
+
+
+def wrap_step(step_name, step_func):
+    # step_func wrapped in the configured profiler, or step_func itself when the step isn't selected
+    selected = _settings["steps"]
+    if not selected or ("all" not in selected and get_step_slug(step_name) not in selected):
+        return step_func
+
+    profile = {"cprofile": run_cprofile, "tracemalloc": run_tracemalloc, "sampling": run_sampling}[_settings["profiler"]]
+
+    def profiled_step():
+        return profile(step_name, step_func)
+    return profiled_step
+
+
+def run_exclusive(step_name, step_func, profile_func):
+    # process wide profilers can't profile two parallel steps, the second one runs unprofiled
+    if not _profiler_lock.acquire(blocking=False):
+        logging.warning(f"{step_name} not profiled - another step is being profiled")
+        return step_func()
+    try:
+        return profile_func()
+    finally:
+        _profiler_lock.release()
+
+
+def run_cprofile(step_name, step_func):
+    import cProfile
+
+    def profile_func():
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(step_func)
+        finally:
+            profile_path = get_profile_path(step_name, "pstats")
+            profiler.dump_stats(profile_path)
+            logging.info(f"cProfile stats of {step_name} written to {profile_path}")
+    return run_exclusive(step_name, step_func, profile_func)
+
+
+def run_tracemalloc(step_name, step_func):
+    import tracemalloc
+
+    def profile_func():
+        tracemalloc.start(25)
+        try:
+            return step_func()
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            snapshot_path = get_profile_path(step_name, "tracemalloc")
+            snapshot.dump(snapshot_path)
+            with open(get_profile_path(step_name, "txt"), "w") as report:
+                report.write(f"{step_name} - peak traced memory {peak / 1024 / 1024:.1f} MB\n\n")
+                for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP_LINES]:
+                    report.write(f"{stat}\n")
+            logging.info(f"tracemalloc snapshot of {step_name} written to {snapshot_path} (peak {peak / 1024 / 1024:.1f} MB)")
+    return run_exclusive(step_name, step_func, profile_func)
+
+
+def get_folded_stack(frame):
+    # "module.function (file:line);..." from the outermost frame to frame, the flamegraph.pl folded format
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def run_sampling(step_name, step_func):
+    """ Samples the step thread's stack every conf.PROFILE_SAMPLE_INTERVAL seconds from a background
+        thread. Only the step's thread is sampled, so parallel steps can be sampled at the same time.
+    """
+    target_thread_id = threading.get_ident()
+    samples = Counter()
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(conf.PROFILE_SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(target_thread_id)
+            if frame is not None:
+                samples[get_folded_stack(frame)] += 1
+
+    sampler = threading.Thread(target=sample, name=f"sampler-{get_step_slug(step_name)}", daemon=True)
+    start = time.perf_counter()
+    sampler.start()
+    try:
+        return step_func()
+    finally:
+        done.set()
+        sampler.join()
+        profile_path = get_profile_path(step_name, "folded")
+        with open(profile_path, "w") as folded:
+            for stack, count in samples.most_common():
+                folded.write(f"{stack} {count}\n")
+        logging.info(f"{sum(samples.values())} stack samples of {step_name} over {time.perf_counter() - start:.2f}s "
+                     f"written to {profile_path}")
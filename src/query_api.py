@@ -0,0 +1,314 @@
+""" Read API - the common questions about the pipeline's tables, with a command line interface.
+
+    get_time_series    - readings (clean data table) or hour / day / week / month rollups of a turbine
+    get_fleet_summary  - min / max / avg power output per turbine and day (summary table), week or month (rollups)
+    get_anomaly_counts - anomalies per turbine and day (anomalies summary table)
+    get_fleet_status   - latest reading, anomaly flag and last cleaned reading per turbine (turbine state table)
+
+    Every question is answered from the most aggregated table that has the answer. Results are cached
+    in memory (QueryCache): the cache key includes the run ledger version of the table read, i.e. the id
+    of the pipeline's latest commit to it, so a step committing new data (and moving its watermark)
+    invalidates the results read from that table and nothing else. The versions are checked at most
+    every conf.QUERY_CACHE_VERSION_CHECK_SECONDS with one query, a repeated dashboard query in between
+    is served from memory without touching the database.
+
+    Ranges are [start, end), the fleet totals are the rollups of turbine conf.FLEET_TURBINE_ID.
+        python src/query_api.py timeseries --turbine 1 --start 2022-03-01 --end 2022-03-08 --resolution hour
+        python src/query_api.py summary --start 2022-03-01 --end 2022-04-01 --level week --format json
+        python src/query_api.py anomalies --start 2022-03-01 --end 2022-04-01 --turbines 1 2
+        python src/query_api.py status
+"""
+
+import argparse
+import csv
+import json
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+
+from mysql.connector import Error
+import config as conf
+from run_ledger import get_resource_versions, table_resource
+
+ROLLUP_RESOLUTIONS = ("hour", "day", "week", "month")
+
+# tables the read API reads, their ledger versions are checked together
+SOURCE_TABLES = (conf.CLEAN_DATA_TABLE, conf.ROLLUPS_TABLE, conf.SUMMARY_STATS_TABLE, conf.SUMMARY_ANOMALIES_STATS_TABLE,
+                 conf.TURBINE_STATE_TABLE)
+
+
+@dataclass
+class QueryResult:
+    columns: list
+    rows: list
+    source: str      # table the result was read from
+    version: str     # run ledger version of the table when it was read, None if it has no ledger rows
+
+    def to_dicts(self):
+        return [dict(zip(self.columns, row)) for row in self.rows]
+
+
+class QueryCache:
+    """ Least recently used cache of QueryResults, entries expire after ttl_seconds (a safety net for
+        writes outside the pipeline, which don't add ledger rows). Thread safe.
+    """
+
+    def __init__(self, max_entries, ttl_seconds, version_check_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.version_check_seconds = version_check_seconds
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.versions_checked_at = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_versions(self, connection):
+        # {table resource: ledger version} of the source tables, read again every version_check_seconds
+        with self.lock:
+            if self.versions_checked_at is not None and time.monotonic() - self.versions_checked_at < self.version_check_seconds:
+                return self.versions
+        versions = get_resource_versions(connection, [table_resource(table_name) for table_name in SOURCE_TABLES])
+        with self.lock:
+            self.versions, self.versions_checked_at = versions, time.monotonic()
+        return versions
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.ttl_seconds:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result):
+        # results of an older version of a table are no longer asked for, they fall out as least recently used
+        with self.lock:
+            self.entries[key] = (result, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.versions_checked_at = None
+
+
+_cache = QueryCache(conf.QUERY_CACHE_MAX_ENTRIES, conf.QUERY_CACHE_TTL_SECONDS, conf.QUERY_CACHE_VERSION_CHECK_SECONDS)
+
+
+def get_cache():
+    return _cache
+
+
+def get_source_table(question, resolution="raw", level="day"):
+    # table a question ("timeseries", "summary", "anomalies" or "status") is answered from
+    if question == "status":
+        return conf.TURBINE_STATE_TABLE
+    if question == "timeseries":
+        return conf.CLEAN_DATA_TABLE if resolution == "raw" else conf.ROLLUPS_TABLE
+    if question == "summary":
+        return conf.SUMMARY_STATS_TABLE if level == "day" else conf.ROLLUPS_TABLE
+    return conf.SUMMARY_ANOMALIES_STATS_TABLE
+
+
+def run_query(connection, key, source_table, query, params, transform=None):
+    """ Result of the query from the cache, or from the database when the cache has no result of the
+        source table's current version. transform(columns, rows) -> (columns, rows) reshapes the rows
+        before they are cached.
+    """
+    version = _cache.get_versions(connection).get(table_resource(source_table))
+    cache_key = (key, source_table, version)
+    result = _cache.get(cache_key)
+    if result is not None:
+        return result
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        columns = [column[0] for column in cursor.description]
+        rows = cursor.fetchall()
+    if transform is not None:
+        columns, rows = transform(columns, rows)
+    result = QueryResult(columns, rows, source_table, version)
+    _cache.put(cache_key, result)
+    return result
+
+
+def get_turbine_filter(turbine_ids):
+    if not turbine_ids:
+        return "", ()
+    return f" AND turbine_id IN ({', '.join(['%s'] * len(turbine_ids))})", tuple(turbine_ids)
+
+
+def get_time_series(connection, turbine_id, start, end, resolution="raw"):
+    """ Readings of a turbine in [start, end) from the clean data table (resolution "raw"), or its
+        hour / day / week / month rollups. Returns a QueryResult, None on failure.
+    """
+    key = ("time_series", turbine_id, start, end, resolution)
+    try:
+        if resolution == "raw":
+            query = f"""
+                SELECT timestamp, wind_speed, wind_direction, power_output
+                FROM {conf.CLEAN_DATA_TABLE}
+                WHERE turbine_id = %s AND timestamp >= %s AND timestamp < %s
+                ORDER BY timestamp
+            """
+            return run_query(connection, key, conf.CLEAN_DATA_TABLE, query, (turbine_id, start, end))
+
+        if resolution not in ROLLUP_RESOLUTIONS:
+            raise ValueError(f"Unknown resolution {resolution}, expected raw or one of {ROLLUP_RESOLUTIONS}")
+        query = f"""
+            SELECT period_start, reading_count, min_power_output, max_power_output, avg_power_output, energy_mwh
+            FROM {conf.ROLLUPS_TABLE}
+            WHERE turbine_id = %s AND level = %s AND period_start >= %s AND period_start < %s
+            ORDER BY period_start
+        """
+        return run_query(connection, key, conf.ROLLUPS_TABLE, query, (turbine_id, resolution, start, end))
+    except Error as e:
+        logging.error(f"Error fetching the {resolution} time series of turbine {turbine_id}: {e}")
+        return None
+
+
+def get_fleet_summary(connection, start, end, level="day", turbine_ids=None):
+    """ Min / max / avg power output per turbine and day (summary table), week or month (rollups) in
+        [start, end), of all turbines or the given ones. Returns a QueryResult, None on failure.
+    """
+    key = ("fleet_summary", start, end, level, tuple(turbine_ids or ()))
+    turbine_sql, turbine_params = get_turbine_filter(turbine_ids)
+    try:
+        if level == "day":
+            query = f"""
+                SELECT day, turbine_id, min_power_output, max_power_output, avg_power_output
+                FROM {conf.SUMMARY_STATS_TABLE}
+                WHERE day >= %s AND day < %s{turbine_sql}
+                ORDER BY day, turbine_id
+            """
+            return run_query(connection, key, conf.SUMMARY_STATS_TABLE, query, (start, end) + turbine_params)
+
+        if level not in ("week", "month"):
+            raise ValueError(f"Unknown summary level {level}, expected day, week or month")
+        query = f"""
+            SELECT period_start, turbine_id, min_power_output, max_power_output, avg_power_output
+            FROM {conf.ROLLUPS_TABLE}
+            WHERE level = %s AND period_start >= %s AND period_start < %s AND turbine_id <> %s{turbine_sql}
+            ORDER BY period_start, turbine_id
+        """
+        return run_query(connection, key, conf.ROLLUPS_TABLE, query, (level, start, end, conf.FLEET_TURBINE_ID) + turbine_params)
+    except Error as e:
+        logging.error(f"Error fetching the {level} fleet summary: {e}")
+        return None
+
+
+def get_anomaly_counts(connection, start, end, turbine_ids=None):
+    """ Number of anomalies per day and turbine in [start, end), of all turbines or the given ones,
+        from the anomalies summary table (one Turbine_ID_<id> column per turbine). Returns a
+        QueryResult with (day, turbine_id, anomaly_count) rows, None on failure.
+    """
+    def to_turbine_rows(columns, rows):
+        # one column per turbine -> one row per day and turbine
+        turbine_columns = [(index, int(column.rsplit("_", 1)[1])) for index, column in enumerate(columns) if column.startswith("Turbine_ID_")]
+        turbine_columns = [(index, turbine_id) for index, turbine_id in turbine_columns if not turbine_ids or turbine_id in turbine_ids]
+        return ["day", "turbine_id", "anomaly_count"], [(row[0], turbine_id, row[index]) for row in rows for index, turbine_id in turbine_columns]
+
+    key = ("anomaly_counts", start, end, tuple(turbine_ids or ()))
+    query = f"""
+        SELECT * FROM {conf.SUMMARY_ANOMALIES_STATS_TABLE}
+        WHERE day >= %s AND day < %s
+        ORDER BY day
+    """
+    try:
+        return run_query(connection, key, conf.SUMMARY_ANOMALIES_STATS_TABLE, query, (start, end), to_turbine_rows)
+    except Error as e:
+        logging.error(f"Error fetching the anomaly counts: {e}")
+        return None
+
+
+def get_fleet_status(connection, turbine_ids=None):
+    """ What every turbine (or the given ones) is doing right now: its latest reading, when it was
+        last seen, whether the latest scored reading is an anomaly and the last cleaned reading time.
+        A primary key read of the turbine state table. Returns a QueryResult, None on failure.
+    """
+    key = ("fleet_status", tuple(turbine_ids or ()))
+    turbine_sql, turbine_params = get_turbine_filter(turbine_ids)
+    query = f"""
+        SELECT turbine_id, last_timestamp, wind_speed, wind_direction, power_output, last_seen_at,
+               is_anomalous, last_cleaned_timestamp
+        FROM {conf.TURBINE_STATE_TABLE}
+        WHERE 1 = 1{turbine_sql}
+        ORDER BY turbine_id
+    """
+    try:
+        return run_query(connection, key, conf.TURBINE_STATE_TABLE, query, turbine_params)
+    except Error as e:
+        logging.error(f"Error fetching the fleet status: {e}")
+        return None
+
+
+def write_result(result, output_format, output=sys.stdout):
+    if output_format == "json":
+        json.dump(result.to_dicts(), output, default=str, indent=2)
+        output.write("\n")
+        return
+    writer = csv.writer(output)
+    writer.writerow(result.columns)
+    writer.writerows(result.rows)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--format", choices=["csv", "json"], default="csv")
+    questions = parser.add_subparsers(dest="question", required=True)
+
+    time_series = questions.add_parser("timeseries", help="readings or rollups of a turbine")
+    time_series.add_argument("--turbine", type=int, required=True, help=f"turbine id, {conf.FLEET_TURBINE_ID} for the fleet totals")
+    time_series.add_argument("--resolution", choices=("raw",) + ROLLUP_RESOLUTIONS, default="raw")
+
+    summary = questions.add_parser("summary", help="power output summary per turbine")
+    summary.add_argument("--level", choices=["day", "week", "month"], default="day")
+
+    anomalies = questions.add_parser("anomalies", help="anomalies per turbine and day")
+    status = questions.add_parser("status", help="latest state of every turbine")
+
+    for question in (time_series, summary, anomalies):
+        question.add_argument("--start", type=datetime.fromisoformat, required=True, help="YYYY-MM-DD[ HH:MM:SS], inclusive")
+        question.add_argument("--end", type=datetime.fromisoformat, required=True, help="YYYY-MM-DD[ HH:MM:SS], exclusive")
+    for question in (summary, anomalies, status):
+        question.add_argument("--turbines", type=int, nargs="+", help="turbine ids (default: all)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    conf.initialize()
+    connection = conf.get_db_connection()
+    if connection is None:
+        logging.error(f"DB Connection failed - check get_db_connection function in config.py")
+        return False
+    try:
+        if args.question == "timeseries":
+            result = get_time_series(connection, args.turbine, args.start, args.end, args.resolution)
+        elif args.question == "summary":
+            result = get_fleet_summary(connection, args.start, args.end, args.level, args.turbines)
+        elif args.question == "status":
+            result = get_fleet_status(connection, args.turbines)
+        else:
+            result = get_anomaly_counts(connection, args.start, args.end, args.turbines)
+        if result is None:
+            return False
+        write_result(result, args.format)
+        return True
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
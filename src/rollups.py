@@ -0,0 +1,153 @@
+""" Hierarchical power output rollups: hour -> day -> week / month, per turbine and for the whole fleet.
+
+    Only the hourly level is calculated from the clean data table, every other level is calculated
+    from the level below it (see ROLLUP_LEVELS) and the fleet rows (turbine_id = conf.FLEET_TURBINE_ID)
+    from the per turbine hourly rows. Weeks don't fit into months hence both are built from days.
+
+    Besides min / max / avg each row keeps reading_count, power_sum, power_sum_sq and energy_mwh.
+    These add up across levels, so totals and variance of any period can be derived without going
+    back to the clean records (see get_variance).
+"""
+
+import logging
+from datetime import datetime, timedelta
+import config as conf
+
+# level: (source level, SQL expression for the start of the bucket from the source period_start)
+ROLLUP_LEVELS = {
+    "day": ("hour", "TIMESTAMP(DATE(period_start))"),
+    "week": ("day", "TIMESTAMP(DATE_SUB(DATE(period_start), INTERVAL WEEKDAY(period_start) DAY))"),
+    "month": ("day", "TIMESTAMP(DATE_SUB(DATE(period_start), INTERVAL DAYOFMONTH(period_start) - 1 DAY))"),
+}
+
+ROLLUP_COLUMNS = """level, period_start, turbine_id, reading_count, power_sum, power_sum_sq,
+                    min_power_output, max_power_output, avg_power_output, energy_mwh"""
+
+
+def get_variance(reading_count, power_sum, power_sum_sq):
+    # population variance of the power output from the stored sums
+    if not reading_count:
+        return None
+    mean = power_sum / reading_count
+    return max(power_sum_sq / reading_count - mean * mean, 0.0)
+
+
+def get_period_start(level, day):
+    day = datetime.combine(day, datetime.min.time()) if not isinstance(day, datetime) else day
+    if level == "week":
+        return day - timedelta(days=day.weekday())
+    if level == "month":
+        return day.replace(day=1)
+    return day
+
+
+def get_period_end(level, period_start):
+    if level == "week":
+        return period_start + timedelta(weeks=1)
+    if level == "month":
+        return (period_start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return period_start + timedelta(days=1)
+
+
+def get_period_ranges(level, day_ranges):
+    """ Widen [start, end) day ranges to whole periods of the given level and merge overlapping ones,
+        e.g. a single dirty day makes the week and the month it belongs to dirty.
+    """
+    ranges = []
+    for day_start, day_end in day_ranges:
+        period_start = get_period_start(level, day_start)
+        period_end = get_period_end(level, get_period_start(level, day_end - timedelta(days=1)))
+
+        if ranges and ranges[-1][1] >= period_start:
+            ranges[-1][1] = max(ranges[-1][1], period_end)
+        else:
+            ranges.append([period_start, period_end])
+    return [tuple(period_range) for period_range in ranges]
+
+
+def get_range_filter(column, period_range):
+    # SQL condition and params limiting the column to the [start, end) range, no filter for None
+    if period_range is None:
+        return "", ()
+    return f"AND {column} >= %s AND {column} < %s", tuple(period_range)
+
+
+def rollup_hours(cursor, period_range=None):
+    # hourly level per turbine from the clean records, then the fleet hourly level from it.
+    clean_filter, params = get_range_filter("timestamp", period_range)
+    insert_turbine_hours_query = f"""
+        INSERT INTO {conf.ROLLUPS_TABLE} ({ROLLUP_COLUMNS})
+        SELECT 'hour', TIMESTAMP(DATE(timestamp), SEC_TO_TIME(HOUR(timestamp) * 3600)) AS bucket_start, turbine_id,
+            COUNT(power_output), SUM(power_output), SUM(power_output * power_output),
+            MIN(power_output), MAX(power_output), AVG(power_output),
+            SUM(power_output) * {conf.READING_INTERVAL_HOURS}
+        FROM {conf.CLEAN_DATA_TABLE}
+        WHERE power_output IS NOT NULL {clean_filter}
+        GROUP BY bucket_start, turbine_id
+    """
+    cursor.execute(insert_turbine_hours_query, params)
+
+    rollup_filter, params = get_range_filter("period_start", period_range)
+    insert_fleet_hours_query = f"""
+        INSERT INTO {conf.ROLLUPS_TABLE} ({ROLLUP_COLUMNS})
+        SELECT 'hour', period_start, {conf.FLEET_TURBINE_ID},
+            SUM(reading_count), SUM(power_sum), SUM(power_sum_sq),
+            MIN(min_power_output), MAX(max_power_output), SUM(power_sum) / NULLIF(SUM(reading_count), 0),
+            SUM(energy_mwh)
+        FROM {conf.ROLLUPS_TABLE}
+        WHERE level = 'hour' AND turbine_id <> {conf.FLEET_TURBINE_ID} {rollup_filter}
+        GROUP BY period_start
+    """
+    cursor.execute(insert_fleet_hours_query, params)
+
+
+def rollup_level(cursor, level, period_range=None):
+    # one level from the level below it, fleet rows included as they share the same turbine_id grouping.
+    source_level, bucket_sql = ROLLUP_LEVELS[level]
+    rollup_filter, params = get_range_filter("period_start", period_range)
+
+    insert_query = f"""
+        INSERT INTO {conf.ROLLUPS_TABLE} ({ROLLUP_COLUMNS})
+        SELECT '{level}', {bucket_sql} AS bucket_start, turbine_id,
+            SUM(reading_count), SUM(power_sum), SUM(power_sum_sq),
+            MIN(min_power_output), MAX(max_power_output), SUM(power_sum) / NULLIF(SUM(reading_count), 0),
+            SUM(energy_mwh)
+        FROM {conf.ROLLUPS_TABLE}
+        WHERE level = '{source_level}' {rollup_filter}
+        GROUP BY bucket_start, turbine_id
+    """
+    cursor.execute(insert_query, params)
+
+
+def delete_periods(cursor, level, period_range=None):
+    rollup_filter, params = get_range_filter("period_start", period_range)
+    cursor.execute(f"DELETE FROM {conf.ROLLUPS_TABLE} WHERE level = %s {rollup_filter}", (level, *params))
+
+
+def update_rollups(cursor, day_ranges=None):
+    logging.info(f"update_rollups function called....\n")
+
+    """ Rebuild the rollup periods touching the given [start, end) day ranges, or every period when
+        day_ranges is None. Buckets of the dirty periods are deleted and re-inserted level by level,
+        so removed clean records don't leave stale buckets behind.
+        Note - no commit here, the caller commits the rollups with the daily summary.
+    """
+    if day_ranges is None:
+        for level in ["hour", *ROLLUP_LEVELS]:
+            delete_periods(cursor, level)
+        rollup_hours(cursor)
+        for level in ROLLUP_LEVELS:
+            rollup_level(cursor, level)
+        logging.info(f"{conf.ROLLUPS_TABLE} rebuilt for all periods")
+        return
+
+    for day_range in day_ranges:
+        delete_periods(cursor, "hour", day_range)
+        rollup_hours(cursor, day_range)
+
+    for level in ROLLUP_LEVELS:
+        for period_range in get_period_ranges(level, day_ranges):
+            delete_periods(cursor, level, period_range)
+            rollup_level(cursor, level, period_range)
+
+    logging.info(f"{conf.ROLLUPS_TABLE} updated for {len(day_ranges)} day ranges")
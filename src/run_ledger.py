@@ -0,0 +1,141 @@
+""" Run ledger - one row per committed unit of work: the step, the table it wrote, the watermark it
+    moved to and the run it belongs to.
+
+    Steps add their ledger row with record_commit in the same transaction as their data (and
+    watermarks), so the ledger never claims work that was rolled back and committed work is never
+    missing from it. The ledger id of a table's latest commit is the table's version for the pipeline
+    DAG: after a crash, the steps downstream of committed work see a new input version and run,
+    and the steps' watermarks make them resume exactly after the committed work.
+"""
+
+import logging
+import threading
+from datetime import datetime
+
+from mysql.connector import Error
+import config as conf
+from metrics import get_current_step
+
+# pipeline run the commits of this process belong to, see start_run
+_run = {"run_id": None}
+_lock = threading.Lock()
+
+
+def table_resource(table_name):
+    return f"table:{table_name}"
+
+
+def get_run_id():
+    # id of the current pipeline run, steps run on their own get a standalone run id
+    with _lock:
+        if _run["run_id"] is None:
+            _run["run_id"] = f"standalone_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        return _run["run_id"]
+
+
+def record_commit(cursor, resource, watermark=None, row_count=0, step=None):
+    logging.debug("record_commit function called....")
+
+    """ Add a ledger row for work written to resource (e.g. table_resource(conf.CLEAN_DATA_TABLE)),
+        step defaults to the pipeline step running in this thread.
+        Note - takes a cursor and does NOT commit, the caller commits it with the data it describes.
+    """
+    query = f"""
+        INSERT INTO {conf.RUN_LEDGER_TABLE} (run_id, step, resource, watermark, row_count)
+        VALUES (%s, %s, %s, %s, %s)
+    """
+    cursor.execute(query, (get_run_id(), step or get_current_step(), resource,
+                           None if watermark is None else str(watermark), row_count))
+
+
+def get_resource_version(connection, resource):
+    # id of the latest ledger row of the resource as a string, None if nothing was committed to it yet
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT MAX(id) FROM {conf.RUN_LEDGER_TABLE} WHERE resource = %s", (resource,))
+            result = cursor.fetchone()
+            return None if result is None or result[0] is None else str(result[0])
+    except Error as e:
+        logging.error(f"Error fetching the ledger version of {resource}: {e}")
+        return None
+
+
+def get_resource_versions(connection, resources):
+    # {resource: version} of several resources in one query, resources without commits are left out
+    placeholders = ", ".join(["%s"] * len(resources))
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT resource, MAX(id) FROM {conf.RUN_LEDGER_TABLE}
+            WHERE resource IN ({placeholders})
+            GROUP BY resource
+        """, tuple(resources))
+        return {resource: str(version) for resource, version in cursor.fetchall()}
+
+
+def get_unfinished_run(connection):
+    """ Returns (run_id, [(step, resource, watermark)]) of the latest pipeline run that started but
+        didn't finish, i.e. the work it committed before it died. None if the last run finished.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT run_id, SUM(watermark LIKE 'finished%%')
+            FROM {conf.RUN_LEDGER_TABLE}
+            WHERE resource = 'run'
+            GROUP BY run_id
+            ORDER BY MAX(id) DESC
+            LIMIT 1
+        """)
+        last_run = cursor.fetchone()
+        if last_run is None or last_run[1]:
+            return None
+
+        cursor.execute(f"""
+            SELECT step, resource, watermark FROM {conf.RUN_LEDGER_TABLE}
+            WHERE run_id = %s AND resource <> 'run'
+            ORDER BY id
+        """, (last_run[0],))
+        return last_run[0], cursor.fetchall()
+
+
+def start_run(connection):
+    logging.info(f"start_run function called....\n")
+
+    """ Start a new pipeline run in the ledger, logging what an interrupted previous run had committed.
+        There is nothing to replay: steps pick up from their committed watermarks.
+    """
+    with _lock:
+        _run["run_id"] = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    if connection is None:
+        # first run - the database is created by the setup step
+        logging.warning(f"Run ledger not available yet, run {_run['run_id']} not recorded")
+        return _run["run_id"]
+    try:
+        unfinished_run = get_unfinished_run(connection)
+        if unfinished_run is not None:
+            run_id, commits = unfinished_run
+            logging.warning(f"Run {run_id} did not finish, resuming after its {len(commits)} committed units of work: "
+                            f"{sorted({step for step, _, _ in commits})}")
+
+        with connection.cursor() as cursor:
+            record_commit(cursor, "run", "started", step="pipeline")
+        connection.commit()
+    except Error as e:
+        # first run - the ledger table is created by the setup step
+        logging.warning(f"Run ledger not available yet: {e}")
+    return _run["run_id"]
+
+
+def finish_run(connection, status):
+    logging.info(f"finish_run function called....\n")
+    if connection is None:
+        logging.error(f"Run {get_run_id()} not finished in the run ledger - no DB connection")
+        return False
+    try:
+        with connection.cursor() as cursor:
+            record_commit(cursor, "run", f"finished:{status}", step="pipeline")
+            logging.info(f"Run {get_run_id()} finished with status {status}")
+        connection.commit()
+        return True
+    except Error as e:
+        logging.error(f"Error finishing run {get_run_id()} in the run ledger: {e}")
+        return False
@@ -47,6 +47,24 @@ def create_my_sql_table(connection, table_name, query):
         logging.error(f"Failed to create {table_name} table: {e}")
         return False    
 
+# Function to add an index to an already existing table (CREATE TABLE IF NOT EXISTS won't change it).
+def create_index_if_missing(connection, table_name, index_name, columns):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT COUNT(*) FROM information_schema.statistics
+                WHERE table_schema = %s AND table_name = %s AND index_name = %s
+            """, (conf.DB_NAME, table_name, index_name))
+
+            if cursor.fetchone()[0] == 0:
+                cursor.execute(f"CREATE INDEX {index_name} ON {table_name} ({columns})")
+                connection.commit()
+                logging.info(f"Index {index_name} created on {table_name} ({columns})")
+            return True
+    except Error as e:
+        logging.error(f"Failed to create index {index_name} on {table_name}: {e}")
+        return False
+
 # Function main - this to be called from the data pipeline or Script can be run individually.
 def main():
     try:
@@ -111,7 +129,8 @@ def main():
                 wind_direction FLOAT,
                 power_output FLOAT,
                 insertion_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE KEY (timestamp, turbine_id)
+                UNIQUE KEY (timestamp, turbine_id),
+                KEY idx_insertion_date (insertion_date)
             );
             ''',
 
@@ -159,6 +178,134 @@ def main():
                 UNIQUE KEY (day, turbine_id)
             );
             ''',
+
+            conf.CHANGE_LOG_TABLE: f'''
+            CREATE TABLE IF NOT EXISTS {conf.CHANGE_LOG_TABLE} (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                timestamp DATETIME NOT NULL,
+                turbine_id INT NOT NULL,
+                insertion_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+                KEY (timestamp, turbine_id)
+            );
+            ''',
+
+            conf.ROLLUPS_TABLE: f'''
+            CREATE TABLE IF NOT EXISTS {conf.ROLLUPS_TABLE} (
+                level VARCHAR(8) NOT NULL,
+                period_start DATETIME NOT NULL,
+                turbine_id INT NOT NULL,
+                reading_count INT,
+                power_sum DOUBLE,
+                power_sum_sq DOUBLE,
+                min_power_output FLOAT,
+                max_power_output FLOAT,
+                avg_power_output FLOAT,
+                energy_mwh DOUBLE,
+                insertion_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (level, period_start, turbine_id),
+                KEY (turbine_id, level, period_start)
+            );
+            ''',
+
+            conf.WIND_ROSE_TABLE: f'''
+            CREATE TABLE IF NOT EXISTS {conf.WIND_ROSE_TABLE} (
+                day DATE NOT NULL,
+                turbine_id INT NOT NULL,
+                sector SMALLINT NOT NULL,
+                speed_bin SMALLINT NOT NULL,
+                reading_count INT,
+                power_sum DOUBLE,
+                PRIMARY KEY (day, turbine_id, sector, speed_bin)
+            );
+            ''',
+
+            conf.DAILY_DISTRIBUTION_STATS_TABLE: f'''
+            CREATE TABLE IF NOT EXISTS {conf.DAILY_DISTRIBUTION_STATS_TABLE} (
+                day DATE NOT NULL,
+                turbine_id INT NOT NULL,
+                readings_received INT,
+                readings_expected INT,
+                completeness FLOAT,
+                null_value_count INT,
+                null_rate FLOAT,
+                anomaly_count INT,
+                imputed_value_count INT,
+                power_output_count INT,
+                power_output_sum DOUBLE,
+                power_output_std FLOAT,
+                power_output_p5 FLOAT,
+                power_output_p50 FLOAT,
+                power_output_p95 FLOAT,
+                insertion_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (day, turbine_id)
+            );
+            ''',
+
+            conf.WATERMARKS_TABLE: f'''
+            CREATE TABLE IF NOT EXISTS {conf.WATERMARKS_TABLE} (
+                name VARCHAR(100) PRIMARY KEY,
+                watermark_value VARCHAR(64),
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            ''',
+
+            conf.RUN_LEDGER_TABLE: f'''
+            CREATE TABLE IF NOT EXISTS {conf.RUN_LEDGER_TABLE} (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                run_id VARCHAR(40) NOT NULL,
+                step VARCHAR(64) NOT NULL,
+                resource VARCHAR(128) NOT NULL,
+                watermark VARCHAR(255),
+                row_count INT DEFAULT 0,
+                committed_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                KEY (resource, id),
+                KEY (run_id)
+            );
+            ''',
+
+            conf.WORK_QUEUE_TABLE: f'''
+            CREATE TABLE IF NOT EXISTS {conf.WORK_QUEUE_TABLE} (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                task_type VARCHAR(32) NOT NULL,
+                task_key VARCHAR(255) NOT NULL,
+                status VARCHAR(16) NOT NULL DEFAULT 'pending',
+                lease_owner VARCHAR(128),
+                lease_token VARCHAR(32),
+                lease_expires_at DATETIME,
+                attempts INT DEFAULT 0,
+                last_error VARCHAR(1024),
+                enqueued_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                finished_at DATETIME,
+                UNIQUE KEY (task_type, task_key),
+                KEY (status, task_type, id),
+                KEY (lease_token)
+            );
+            ''',
+
+            conf.TURBINE_STATE_TABLE: f'''
+            CREATE TABLE IF NOT EXISTS {conf.TURBINE_STATE_TABLE} (
+                turbine_id INT PRIMARY KEY,
+                last_timestamp DATETIME,
+                wind_speed FLOAT,
+                wind_direction FLOAT,
+                power_output FLOAT,
+                last_seen_at DATETIME,
+                is_anomalous TINYINT(1) DEFAULT 0,
+                last_scored_timestamp DATETIME,
+                last_cleaned_timestamp DATETIME,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            );
+            ''',
+
+            conf.TURBINES_TABLE: f'''
+            CREATE TABLE IF NOT EXISTS {conf.TURBINES_TABLE} (
+                turbine_id INT PRIMARY KEY,
+                group_file VARCHAR(255),
+                rated_capacity_mw FLOAT,
+                location VARCHAR(255),
+                registered_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            );
+            ''',
         }
 
         # Create Tables 
@@ -169,6 +316,28 @@ def main():
                 logging.error(f"Failed to create table {table_name}")
                 return False 
         
+        # indexes added after the first release, for databases created before them
+        indexes = [
+            # dirty days of the incremental summary are found by insertion_date
+            (conf.CLEAN_DATA_TABLE, "idx_insertion_date", "insertion_date"),
+        ]
+
+        for table_name, index_name, columns in indexes:
+            if not create_index_if_missing(connection, table_name, index_name, columns):
+                return False
+
+        # turbine state of a database loaded before the state table existed
+        from clean_data import CLEAN_RAW_ID_WATERMARK
+        from turbine_state import backfill_turbine_state
+        from watermarks import get_watermark
+        if not backfill_turbine_state(connection, int(get_watermark(connection, CLEAN_RAW_ID_WATERMARK) or 0)):
+            return False
+
+        # turbine registry of a database loaded before the registry existed, from the state table
+        from turbine_registry import backfill_turbine_registry
+        if not backfill_turbine_registry(connection):
+            return False
+
         return True
     except Exception as e:  
         logging.error(f"Database Setup - Unexpected error occurred: {e}\n")
@@ -185,6 +354,7 @@ def main():
  
 
 if __name__ == "__main__":
+    conf.initialize()
     #calling main()
     result = main()
     logging.info(f"Database Setup - completed \n")
\ No newline at end of file
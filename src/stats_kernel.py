@@ -0,0 +1,76 @@
+""" Vectorized statistics kernel for the mean / median / mode stats used to impute missing values.
+
+    Works on contiguous float64 arrays: NaNs are dropped once per column and mean, median and mode are
+    computed from the same array. The mode is a bincount over the values quantized to the column's
+    resolution (conf.STATS_MODE_RESOLUTION, e.g. 0.1 m/s, 1 degree), so scipy isn't needed for it.
+    Wind direction is circular (359 and 1 degree are 2 degrees apart), its mean is the circular mean.
+"""
+
+import numpy as np
+import config as conf
+
+STATS_COLUMNS = ["wind_speed", "wind_direction", "power_output"]
+
+# above this many bins (e.g. extreme outliers) the mode is counted with np.unique instead of a bincount
+MAX_MODE_BINS = 10_000_000
+
+
+def quantized_mode(values, resolution):
+    # most frequent value after rounding to the resolution, ties go to the smallest value.
+    quantized = np.rint(values / resolution).astype(np.int64)
+    offset = quantized.min()
+    span = quantized.max() - offset + 1
+
+    if span <= MAX_MODE_BINS:
+        counts = np.bincount(quantized - offset, minlength=span)
+        return float((np.argmax(counts) + offset) * resolution)
+
+    unique_values, counts = np.unique(quantized, return_counts=True)
+    return float(unique_values[np.argmax(counts)] * resolution)
+
+
+def circular_mean(degrees):
+    # mean direction of angles in degrees, in the range [0, 360)
+    radians = np.deg2rad(degrees)
+    mean = np.rad2deg(np.arctan2(np.sin(radians).mean(), np.cos(radians).mean()))
+    return float(np.mod(mean, 360.0))
+
+
+def column_stats(values, resolution, circular=False):
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+
+    if len(values) == 0:
+        return {"mean": None, "median": None, "mode": None}
+
+    return {
+        "mean": circular_mean(values) if circular else float(values.mean()),
+        "median": float(np.median(values)),
+        "mode": quantized_mode(values, resolution),
+    }
+
+
+def frame_stats(columns):
+    # stats of every column in STATS_COLUMNS, columns is a dict / DataFrame of column name -> values
+    return {
+        column: column_stats(columns[column], conf.STATS_MODE_RESOLUTION[column], circular=(column == "wind_direction"))
+        for column in STATS_COLUMNS
+    }
+
+
+def grouped_frame_stats(turbine_ids, columns):
+    """ Stats per turbine: the rows are sorted by turbine once and every group is a contiguous slice.
+        Returns {turbine_id: {column: {"mean", "median", "mode"}}}
+    """
+    turbine_ids = np.asarray(turbine_ids)
+    order = np.argsort(turbine_ids, kind="stable")
+    sorted_ids = turbine_ids[order]
+    sorted_columns = {column: np.asarray(columns[column], dtype=np.float64)[order] for column in STATS_COLUMNS}
+
+    group_ids, group_starts = np.unique(sorted_ids, return_index=True)
+    group_ends = np.append(group_starts[1:], len(sorted_ids))
+
+    return {
+        int(turbine_id): frame_stats({column: values[start:end] for column, values in sorted_columns.items()})
+        for turbine_id, start, end in zip(group_ids, group_starts, group_ends)
+    }
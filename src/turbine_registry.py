@@ -0,0 +1,121 @@
+""" Turbine registry - the turbines dimension table and a process-wide cache of it.
+
+    Ingestion registers the turbine ids it hasn't seen before, in bulk per batch (register_turbines),
+    with the source CSV they were first found in. Rated capacity and location are left for the
+    operators to fill in. Steps that need the fleet (e.g. the anomalies summary's pivot columns) read
+    it from the registry instead of a SELECT DISTINCT turbine_id over a fact table.
+
+    The cache holds the whole table (one row per turbine) and is keyed by the table's run ledger
+    version (the last ledger id of the table, one index lookup), which is read on every call: the
+    table is only read again when the version moved, so a registration committed by any process is
+    seen by the next reader. The version is read through the caller's cursor - on the ingesting
+    connection that includes its own uncommitted registration, which is then cached. A rollback takes
+    that ledger row back (its id is never used again), the version no longer matches and the next
+    call reloads the table, so a retried batch registers its turbines again.
+"""
+
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+from mysql.connector import Error
+import config as conf
+from run_ledger import record_commit, table_resource
+
+
+@dataclass
+class Turbine:
+    turbine_id: int
+    group_file: Optional[str] = None
+    rated_capacity_mw: Optional[float] = None
+    location: Optional[str] = None
+
+
+class TurbineRegistry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turbines = None
+        self.version = None
+
+    def get_version(self, cursor):
+        cursor.execute(f"SELECT MAX(id) FROM {conf.RUN_LEDGER_TABLE} WHERE resource = %s",
+                       (table_resource(conf.TURBINES_TABLE),))
+        result = cursor.fetchone()
+        return None if result is None else result[0]
+
+    def get_turbines(self, cursor):
+        # turbine_id -> Turbine, from memory while the table's version is unchanged
+        with self.lock:
+            version = self.get_version(cursor)
+            if self.turbines is None or version != self.version:
+                cursor.execute(f"""
+                    SELECT turbine_id, group_file, rated_capacity_mw, location
+                    FROM {conf.TURBINES_TABLE}
+                    ORDER BY turbine_id
+                """)
+                self.turbines = {row[0]: Turbine(*row) for row in cursor.fetchall()}
+                self.version = version
+                logging.debug("Turbine registry loaded: %s turbines", len(self.turbines))
+            return self.turbines
+
+    def clear(self):
+        with self.lock:
+            self.turbines = None
+            self.version = None
+
+
+_registry = TurbineRegistry()
+
+
+def get_registry():
+    return _registry
+
+
+def get_turbine_ids(connection):
+    # registered turbine ids in order
+    with connection.cursor() as cursor:
+        return sorted(_registry.get_turbines(cursor))
+
+
+def register_turbines(cursor, turbine_ids, group_file=None):
+    """ Add the turbine ids the registry doesn't know yet, returns the ids added.
+        Note - takes a cursor and does NOT commit, the ids are committed with the batch they came from.
+    """
+    new_ids = sorted({int(turbine_id) for turbine_id in turbine_ids} - set(_registry.get_turbines(cursor)))
+    if not new_ids:
+        return []
+
+    # INSERT IGNORE - another process may have registered them since the cache was loaded
+    cursor.executemany(f"""
+        INSERT IGNORE INTO {conf.TURBINES_TABLE} (turbine_id, group_file)
+        VALUES (%s, %s)
+    """, [(turbine_id, group_file) for turbine_id in new_ids])
+    record_commit(cursor, table_resource(conf.TURBINES_TABLE), group_file, len(new_ids))
+    logging.info("%s new turbines registered from %s: %s", len(new_ids), group_file, new_ids)
+    return new_ids
+
+
+def backfill_turbine_registry(connection):
+    logging.info(f"backfill_turbine_registry function called....\n")
+
+    # fill an empty registry from the turbine state table (one row per turbine, see turbine_state.py)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {conf.TURBINES_TABLE}")
+            if cursor.fetchone()[0] > 0:
+                return True
+
+            cursor.execute(f"""
+                INSERT IGNORE INTO {conf.TURBINES_TABLE} (turbine_id)
+                SELECT turbine_id FROM {conf.TURBINE_STATE_TABLE}
+            """)
+            if cursor.rowcount > 0:
+                record_commit(cursor, table_resource(conf.TURBINES_TABLE), row_count=cursor.rowcount)
+        connection.commit()
+        return True
+    except Error as e:
+        connection.rollback()
+        logging.error(f"Error filling {conf.TURBINES_TABLE}: {e}")
+        return False
@@ -0,0 +1,164 @@
+""" Latest state per turbine - one row per turbine, upserted in bulk with every ingestion and cleaning batch.
+
+    last_timestamp, wind_speed, wind_direction, power_output - the turbine's latest reading
+    last_seen_at           - when readings of the turbine were last ingested
+    is_anomalous           - the latest scored reading is an anomaly (as of last_scored_timestamp)
+    last_cleaned_timestamp - latest reading the cleaning step has processed
+
+    "What is each turbine doing right now" and the latest reading time of the fleet are primary key /
+    O(turbines) reads of this table instead of MAX(timestamp) scans and joins over the raw or clean table.
+    The upserts only move a turbine's state forward (GREATEST / IF on the timestamps), so late or
+    re-processed batches, in any order, leave the newest state in place. They take a cursor and don't
+    commit: the state is committed with the batch it describes.
+"""
+
+import logging
+
+from mysql.connector import Error
+import config as conf
+
+# assignments run left to right, the readings / flags are compared with the timestamps before they are moved
+INGESTED_STATE_QUERY = f"""
+    INSERT INTO {conf.TURBINE_STATE_TABLE} (turbine_id, last_timestamp, wind_speed, wind_direction, power_output, last_seen_at)
+    VALUES (%s, %s, %s, %s, %s, NOW())
+    ON DUPLICATE KEY UPDATE
+        wind_speed = IF(last_timestamp IS NULL OR VALUES(last_timestamp) >= last_timestamp, VALUES(wind_speed), wind_speed),
+        wind_direction = IF(last_timestamp IS NULL OR VALUES(last_timestamp) >= last_timestamp, VALUES(wind_direction), wind_direction),
+        power_output = IF(last_timestamp IS NULL OR VALUES(last_timestamp) >= last_timestamp, VALUES(power_output), power_output),
+        last_timestamp = GREATEST(COALESCE(last_timestamp, VALUES(last_timestamp)), VALUES(last_timestamp)),
+        last_seen_at = NOW()
+"""
+
+SCORED_STATE_UPDATE = """
+        is_anomalous = IF(last_scored_timestamp IS NULL OR VALUES(last_scored_timestamp) >= last_scored_timestamp,
+                          VALUES(is_anomalous), is_anomalous),
+        last_scored_timestamp = GREATEST(COALESCE(last_scored_timestamp, VALUES(last_scored_timestamp)), VALUES(last_scored_timestamp))
+"""
+
+CLEANED_STATE_UPDATE = """
+        last_cleaned_timestamp = GREATEST(COALESCE(last_cleaned_timestamp, VALUES(last_cleaned_timestamp)), VALUES(last_cleaned_timestamp))
+"""
+
+
+def get_latest_rows(frame):
+    # latest reading of every turbine of a DataFrame of readings, rows without a key are skipped
+    valid = frame.dropna(subset=["timestamp", "turbine_id"])
+    return valid.sort_values("timestamp", kind="stable").drop_duplicates(subset=["turbine_id"], keep="last")
+
+
+def to_value(value):
+    # NaN -> NULL, numpy scalars -> Python values for the connector
+    if value != value:
+        return None
+    return value.item() if hasattr(value, "item") else value
+
+
+def update_ingested_state(cursor, frame):
+    # latest reading of every turbine of an ingested batch (DataFrame), one executemany
+    latest = get_latest_rows(frame)
+    records = [(int(turbine_id), timestamp.to_pydatetime(), to_value(wind_speed), to_value(wind_direction), to_value(power_output))
+               for timestamp, turbine_id, wind_speed, wind_direction, power_output
+               in latest[["timestamp", "turbine_id", "wind_speed", "wind_direction", "power_output"]].itertuples(index=False)]
+    if records:
+        cursor.executemany(INGESTED_STATE_QUERY, records)
+    return len(records)
+
+
+def update_scored_state(cursor, raw_id_range, bounds, shard=None):
+    """ Anomaly flag of the turbines of a scored raw id range (see clean_data.detect_and_store_anomalies):
+        whether each turbine's latest reading in the range is outside the anomaly bounds.
+    """
+    from clean_data import get_shard_filter
+
+    shard_sql, shard_params = get_shard_filter("", shard)
+    cursor.execute(f"""
+        INSERT INTO {conf.TURBINE_STATE_TABLE} (turbine_id, is_anomalous, last_scored_timestamp)
+        SELECT r.turbine_id, COALESCE(r.power_output < %s OR r.power_output > %s, 0), r.timestamp
+        FROM (
+            SELECT turbine_id, MAX(timestamp) AS latest_timestamp
+            FROM {conf.RAW_DATA_TABLE}
+            WHERE id > %s AND id <= %s{shard_sql}
+            GROUP BY turbine_id
+        ) batch
+        JOIN {conf.RAW_DATA_TABLE} r ON r.timestamp = batch.latest_timestamp AND r.turbine_id = batch.turbine_id
+        ON DUPLICATE KEY UPDATE {SCORED_STATE_UPDATE}
+    """, (bounds[0], bounds[1], raw_id_range[0], raw_id_range[1]) + shard_params)
+
+
+def update_cleaned_state(cursor, raw_id_range, shard=None):
+    # last cleaned reading of the turbines of a cleaned raw id range (see clean_data.update_clean_table)
+    from clean_data import get_shard_filter
+
+    shard_sql, shard_params = get_shard_filter("", shard)
+    cursor.execute(f"""
+        INSERT INTO {conf.TURBINE_STATE_TABLE} (turbine_id, last_cleaned_timestamp)
+        SELECT turbine_id, MAX(timestamp)
+        FROM {conf.RAW_DATA_TABLE}
+        WHERE id > %s AND id <= %s{shard_sql}
+        GROUP BY turbine_id
+        ON DUPLICATE KEY UPDATE {CLEANED_STATE_UPDATE}
+    """, tuple(raw_id_range) + shard_params)
+
+
+def update_cleaned_state_from_memory(cursor, records, anomalies):
+    # anomaly flag and last cleaned reading of records scored / cleaned in memory (in_memory_pipeline.py)
+    latest = get_latest_rows(records.assign(is_anomalous=anomalies))
+    state = [(int(turbine_id), int(bool(is_anomalous)), timestamp.to_pydatetime(), timestamp.to_pydatetime())
+             for timestamp, turbine_id, is_anomalous in latest[["timestamp", "turbine_id", "is_anomalous"]].itertuples(index=False)]
+    if state:
+        cursor.executemany(f"""
+            INSERT INTO {conf.TURBINE_STATE_TABLE} (turbine_id, is_anomalous, last_scored_timestamp, last_cleaned_timestamp)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE {SCORED_STATE_UPDATE}, {CLEANED_STATE_UPDATE}
+        """, state)
+    return len(state)
+
+
+def get_latest_timestamp(connection):
+    # latest reading time of the fleet, None when the state table has no turbines yet
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT MAX(last_timestamp) FROM {conf.TURBINE_STATE_TABLE}")
+            result = cursor.fetchone()
+            return None if result is None else result[0]
+    except Error as e:
+        logging.error(f"Error fetching the latest reading time from {conf.TURBINE_STATE_TABLE}: {e}")
+        return None
+
+
+def backfill_turbine_state(connection, last_cleaned_raw_id):
+    logging.info(f"backfill_turbine_state function called....\n")
+
+    """ Fill an empty state table from the raw table, e.g. on a database set up before the table
+        existed (one scan of the raw table, later batches keep it up to date).
+        last_cleaned_raw_id - the clean raw id watermark, the raw rows up to it are cleaned.
+    """
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {conf.TURBINE_STATE_TABLE}")
+            if cursor.fetchone()[0] > 0:
+                return True
+
+            cursor.execute(f"""
+                INSERT INTO {conf.TURBINE_STATE_TABLE}
+                    (turbine_id, last_timestamp, wind_speed, wind_direction, power_output, last_seen_at, is_anomalous, last_scored_timestamp)
+                SELECT r.turbine_id, r.timestamp, r.wind_speed, r.wind_direction, r.power_output, r.insertion_date,
+                       a.turbine_id IS NOT NULL, IF(r.id <= %s, r.timestamp, NULL)
+                FROM (
+                    SELECT turbine_id, MAX(timestamp) AS latest_timestamp FROM {conf.RAW_DATA_TABLE} GROUP BY turbine_id
+                ) latest
+                JOIN {conf.RAW_DATA_TABLE} r ON r.timestamp = latest.latest_timestamp AND r.turbine_id = latest.turbine_id
+                LEFT JOIN {conf.ANOMALIES_TABLE} a ON a.timestamp = r.timestamp AND a.turbine_id = r.turbine_id
+            """, (last_cleaned_raw_id,))
+            cursor.execute(f"""
+                INSERT INTO {conf.TURBINE_STATE_TABLE} (turbine_id, last_cleaned_timestamp)
+                SELECT turbine_id, MAX(timestamp) FROM {conf.RAW_DATA_TABLE} WHERE id <= %s GROUP BY turbine_id
+                ON DUPLICATE KEY UPDATE {CLEANED_STATE_UPDATE}
+            """, (last_cleaned_raw_id,))
+        connection.commit()
+        logging.info(f"{conf.TURBINE_STATE_TABLE} filled from {conf.RAW_DATA_TABLE}")
+        return True
+    except Error as e:
+        connection.rollback()
+        logging.error(f"Error filling {conf.TURBINE_STATE_TABLE}: {e}")
+        return False
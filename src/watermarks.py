@@ -0,0 +1,35 @@
+import logging
+import config as conf
+
+
+def get_watermark(connection, name):
+    logging.debug("get_watermark function called....")
+
+    """ Watermarks are small named markers (e.g. last consumed change log id or last processed
+        insertion date) which let a step pick up exactly where its previous run stopped.
+        Returns the stored value as a string, or None if the watermark was never set.
+        Note - a DB error is raised, not returned as None: callers would read it as "never set" and
+        start over (full rebuild, re-cleaning the whole raw table), they roll back instead.
+    """
+    with connection.cursor() as cursor:
+        query = f"SELECT watermark_value FROM {conf.WATERMARKS_TABLE} WHERE name = %s"
+        cursor.execute(query, (name,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+
+def set_watermark(cursor, name, value):
+    logging.debug("set_watermark function called....")
+
+    """ Insert or move a watermark.
+        Note - takes a cursor and does NOT commit, the caller commits it together with the data
+        the watermark describes so both are either saved or rolled back.
+    """
+    query = f"""
+        INSERT INTO {conf.WATERMARKS_TABLE} (name, watermark_value)
+        VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE
+            watermark_value = VALUES(watermark_value),
+            updated_at = CURRENT_TIMESTAMP
+    """
+    cursor.execute(query, (name, str(value)))
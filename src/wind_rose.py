@@ -0,0 +1,124 @@
+""" Wind rose / speed-direction histogram per turbine per day.
+
+    Each (day, turbine_id, sector, speed_bin) row keeps the number of clean readings and the sum of
+    their power output, so wind roses, power by sector and speed distributions are answered from a
+    few thousand histogram rows instead of scanning the clean data table.
+"""
+
+import logging
+from datetime import datetime, timedelta
+import numpy as np
+import config as conf
+from db_fetch import fetch_arrays
+from memory_mode import get_dtypes
+
+# days fetched from the clean data table at once when the whole histogram is rebuilt
+REBUILD_CHUNK_DAYS = 31
+
+
+def bin_readings(wind_speed, wind_direction):
+    # vectorized direction sector and wind speed bin of every reading
+    sector_width = 360.0 / conf.WIND_ROSE_SECTORS
+    sectors = np.floor((np.mod(wind_direction, 360.0) + sector_width / 2) / sector_width).astype(np.int64)
+    sectors = np.mod(sectors, conf.WIND_ROSE_SECTORS)
+
+    speed_bins = np.floor(wind_speed / conf.WIND_SPEED_BIN_WIDTH).astype(np.int64)
+    speed_bins = np.clip(speed_bins, 0, conf.WIND_SPEED_BINS - 1)
+    return sectors, speed_bins
+
+
+def build_histogram(day_offsets, turbine_ids, wind_speed, wind_direction, power_output):
+    """ 2D binning of a batch of readings in one pass.
+        Returns (keys, counts, power_sums) where every keys row is [day_offset, turbine_id, sector, speed_bin].
+    """
+    valid = ~(np.isnan(wind_speed) | np.isnan(wind_direction) | np.isnan(power_output))
+    sectors, speed_bins = bin_readings(wind_speed[valid], wind_direction[valid])
+
+    keys = np.column_stack((day_offsets[valid], turbine_ids[valid], sectors, speed_bins))
+    if len(keys) == 0:
+        return keys, np.empty(0, dtype=np.int64), np.empty(0)
+
+    unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    counts = np.bincount(inverse, minlength=len(unique_keys))
+    power_sums = np.bincount(inverse, weights=power_output[valid], minlength=len(unique_keys))
+    return unique_keys, counts, power_sums
+
+
+def update_wind_rose_range(cursor, range_start, range_end):
+    # rebuild the histogram rows of the [range_start, range_end) days from the clean records.
+    query = f"""
+        SELECT DATEDIFF(timestamp, %s) AS day_offset, turbine_id, wind_speed, wind_direction, power_output
+        FROM {conf.CLEAN_DATA_TABLE}
+        WHERE timestamp >= %s AND timestamp < %s
+    """
+    data = fetch_arrays(cursor, query, (range_start, range_start, range_end), dtypes={"day_offset": np.int64, **get_dtypes()})
+
+    cursor.execute(
+        f"DELETE FROM {conf.WIND_ROSE_TABLE} WHERE day >= %s AND day < %s",
+        (range_start.date(), range_end.date())
+    )
+    if len(data["day_offset"]) == 0:
+        return 0
+
+    keys, counts, power_sums = build_histogram(
+        data["day_offset"], data["turbine_id"], data["wind_speed"], data["wind_direction"], data["power_output"]
+    )
+
+    insert_query = f"""
+        INSERT INTO {conf.WIND_ROSE_TABLE} (day, turbine_id, sector, speed_bin, reading_count, power_sum)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """
+    range_day = range_start.date()
+    histogram_records = [
+        (range_day + timedelta(days=int(key[0])), int(key[1]), int(key[2]), int(key[3]), int(count), float(power_sum))
+        for key, count, power_sum in zip(keys, counts, power_sums)
+    ]
+    cursor.executemany(insert_query, histogram_records)
+    return len(histogram_records)
+
+
+def update_wind_rose(cursor, day_ranges=None):
+    logging.info(f"update_wind_rose function called....\n")
+
+    """ Rebuild the histogram of the given [start, end) day ranges, or of all days when day_ranges is None
+        (processed REBUILD_CHUNK_DAYS at a time to keep memory bounded).
+        Note - no commit here, the caller commits the histogram with the daily summary.
+    """
+    if day_ranges is None:
+        cursor.execute(f"SELECT MIN(timestamp), MAX(timestamp) FROM {conf.CLEAN_DATA_TABLE}")
+        first_timestamp, last_timestamp = cursor.fetchone()
+        cursor.execute(f"DELETE FROM {conf.WIND_ROSE_TABLE}")
+        if first_timestamp is None:
+            return
+
+        day_ranges = []
+        chunk_start = datetime.combine(first_timestamp.date(), datetime.min.time())
+        while chunk_start <= last_timestamp:
+            day_ranges.append((chunk_start, chunk_start + timedelta(days=REBUILD_CHUNK_DAYS)))
+            chunk_start += timedelta(days=REBUILD_CHUNK_DAYS)
+
+    histogram_rows = 0
+    for range_start, range_end in day_ranges:
+        histogram_rows += update_wind_rose_range(cursor, range_start, range_end)
+
+    logging.info(f"{conf.WIND_ROSE_TABLE} updated, {histogram_rows} histogram rows written")
+
+
+def get_wind_rose(connection, turbine_id, start_day, end_day):
+    logging.info(f"get_wind_rose function called....\n")
+
+    """ Wind rose of a turbine (or the fleet for turbine_id None) between start_day and end_day (inclusive).
+        Returns rows of (sector, speed_bin, reading_count, avg_power_output).
+    """
+    query = f"""
+        SELECT sector, speed_bin, SUM(reading_count), SUM(power_sum) / SUM(reading_count)
+        FROM {conf.WIND_ROSE_TABLE}
+        WHERE day >= %s AND day <= %s {"" if turbine_id is None else "AND turbine_id = %s"}
+        GROUP BY sector, speed_bin
+        ORDER BY sector, speed_bin
+    """
+    params = (start_day, end_day) if turbine_id is None else (start_day, end_day, turbine_id)
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        return cursor.fetchall()
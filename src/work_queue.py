@@ -0,0 +1,217 @@
+""" Work queue table shared by the pipeline workers (worker.py) on one or more hosts.
+
+    A task is a unit of work (task_type, task_key), e.g. ("ingest_file", "data_group_1.csv"). A worker
+    claims a pending task under a lease: status 'leased', its lease token and an expiry time of
+    conf.WORK_QUEUE_LEASE_SECONDS, renewed while the task runs. Lease times come from the database
+    clock (NOW()) so the hosts' clocks don't matter.
+
+    A worker that dies leaves its task leased; once the lease expired reclaim_expired_leases puts the
+    task back to pending (or failed after conf.WORK_QUEUE_MAX_ATTEMPTS attempts). A worker only
+    completes a task while it holds the lease, i.e. with the lease token of its claim, and aborts a
+    task whose lease it lost (worker.keep_lease). Only one coordinator runs at a time, it holds the
+    COORDINATOR_LOCK named lock (GET_LOCK) for the whole run.
+"""
+
+import logging
+import uuid
+from dataclasses import dataclass
+
+from mysql.connector import Error
+import config as conf
+
+# MySQL named lock held by the running coordinator
+COORDINATOR_LOCK = "wind_turbine_coordinator"
+
+# task statuses
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+@dataclass
+class Task:
+    id: int
+    task_type: str
+    task_key: str
+    lease_token: str
+    attempts: int
+
+
+def enqueue_tasks(connection, task_type, task_keys):
+    logging.info(f"enqueue_tasks function called....\n")
+
+    """ Add tasks to the queue. Re-enqueuing a finished (done / failed) task makes it pending again
+        e.g. a re-delivered CSV, a task that is pending or leased is left as it is.
+        Returns True, False on failure.
+    """
+    if not task_keys:
+        return True
+    # status is assigned last, the assignments before it still see the old status
+    query = f"""
+        INSERT INTO {conf.WORK_QUEUE_TABLE} (task_type, task_key)
+        VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE
+            attempts = IF(status IN ('{DONE}', '{FAILED}'), 0, attempts),
+            last_error = IF(status IN ('{DONE}', '{FAILED}'), NULL, last_error),
+            status = IF(status IN ('{DONE}', '{FAILED}'), '{PENDING}', status),
+            enqueued_at = CURRENT_TIMESTAMP
+    """
+    try:
+        with connection.cursor() as cursor:
+            cursor.executemany(query, [(task_type, task_key) for task_key in task_keys])
+        connection.commit()
+        logging.info(f"{len(task_keys)} {task_type} tasks enqueued")
+        return True
+    except Error as e:
+        connection.rollback()
+        logging.error(f"Error enqueuing {task_type} tasks: {e}")
+        return False
+
+
+def claim_task(connection, worker_id, task_types):
+    """ Lease the oldest pending task of the given types to worker_id.
+        The single UPDATE ... LIMIT 1 is atomic, two workers can't claim the same task.
+        Returns the Task, None if there is nothing to claim.
+    """
+    lease_token = uuid.uuid4().hex
+    placeholders = ", ".join(["%s"] * len(task_types))
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {conf.WORK_QUEUE_TABLE}
+                SET status = '{LEASED}', lease_owner = %s, lease_token = %s,
+                    lease_expires_at = NOW() + INTERVAL %s SECOND, attempts = attempts + 1
+                WHERE status = '{PENDING}' AND task_type IN ({placeholders})
+                ORDER BY id
+                LIMIT 1
+            """, (worker_id, lease_token, conf.WORK_QUEUE_LEASE_SECONDS, *task_types))
+            connection.commit()
+            if cursor.rowcount == 0:
+                return None
+
+            cursor.execute(f"""
+                SELECT id, task_type, task_key, attempts FROM {conf.WORK_QUEUE_TABLE} WHERE lease_token = %s
+            """, (lease_token,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        task = Task(row[0], row[1], row[2], lease_token, row[3])
+        logging.info(f"{worker_id} claimed {task.task_type} {task.task_key} (attempt {task.attempts})")
+        return task
+    except Error as e:
+        # e.g. a deadlock with another worker's claim, the next poll tries again
+        connection.rollback()
+        logging.warning(f"Error claiming a task: {e}")
+        return None
+
+
+def renew_lease(connection, task):
+    # extend the lease of a running task, False if the lease was lost (expired and reclaimed), None on a DB error
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {conf.WORK_QUEUE_TABLE}
+                SET lease_expires_at = NOW() + INTERVAL %s SECOND
+                WHERE id = %s AND lease_token = %s
+            """, (conf.WORK_QUEUE_LEASE_SECONDS, task.id, task.lease_token))
+            renewed = cursor.rowcount == 1
+        connection.commit()
+        return renewed
+    except Error as e:
+        logging.error(f"Error renewing the lease of task {task.id}: {e}")
+        return None
+
+
+def complete_task(connection, task, error=None):
+    logging.debug("complete_task function called....")
+
+    """ Mark a leased task done, or when error is given pending again for another attempt (failed
+        after conf.WORK_QUEUE_MAX_ATTEMPTS). Returns False if the worker no longer held the lease.
+    """
+    if error is None:
+        status_sql = f"'{DONE}'"
+    else:
+        status_sql = f"IF(attempts >= {int(conf.WORK_QUEUE_MAX_ATTEMPTS)}, '{FAILED}', '{PENDING}')"
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {conf.WORK_QUEUE_TABLE}
+                SET status = {status_sql}, lease_token = NULL, lease_expires_at = NULL,
+                    last_error = %s, finished_at = NOW()
+                WHERE id = %s AND lease_token = %s
+            """, (None if error is None else str(error)[:1024], task.id, task.lease_token))
+            completed = cursor.rowcount == 1
+        connection.commit()
+        if not completed:
+            logging.warning(f"Lease of {task.task_type} {task.task_key} was lost before it completed")
+        return completed
+    except Error as e:
+        connection.rollback()
+        logging.error(f"Error completing task {task.id}: {e}")
+        return False
+
+
+def reclaim_expired_leases(connection):
+    """ Put the tasks of workers that died (lease expired) back to pending, or failed when they used
+        up their attempts. Returns the number of tasks reclaimed.
+    """
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {conf.WORK_QUEUE_TABLE}
+                SET status = IF(attempts >= %s, '{FAILED}', '{PENDING}'),
+                    last_error = CONCAT('lease of ', lease_owner, ' expired'),
+                    lease_token = NULL, lease_expires_at = NULL
+                WHERE status = '{LEASED}' AND lease_expires_at < NOW()
+            """, (conf.WORK_QUEUE_MAX_ATTEMPTS,))
+            reclaimed = cursor.rowcount
+        connection.commit()
+        if reclaimed:
+            logging.warning(f"{reclaimed} expired leases reclaimed")
+        return reclaimed
+    except Error as e:
+        connection.rollback()
+        logging.error(f"Error reclaiming expired leases: {e}")
+        return 0
+
+
+def acquire_coordinator_lock(connection):
+    # COORDINATOR_LOCK for this connection's session (released when it closes), False if another coordinator holds it
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT GET_LOCK(%s, 0)", (COORDINATOR_LOCK,))
+        return cursor.fetchone()[0] == 1
+
+
+def release_coordinator_lock(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT RELEASE_LOCK(%s)", (COORDINATOR_LOCK,))
+        cursor.fetchone()
+
+
+def get_task_counts(connection, task_type, task_keys):
+    # {status: number of tasks} of the given tasks
+    placeholders = ", ".join(["%s"] * len(task_keys))
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT status, COUNT(*) FROM {conf.WORK_QUEUE_TABLE}
+            WHERE task_type = %s AND task_key IN ({placeholders})
+            GROUP BY status
+        """, (task_type, *task_keys))
+        return {status: count for status, count in cursor.fetchall()}
+
+
+def purge_finished_tasks(connection):
+    # done / failed tasks are kept conf.WORK_QUEUE_RETENTION_DAYS days for troubleshooting
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                DELETE FROM {conf.WORK_QUEUE_TABLE}
+                WHERE status IN ('{DONE}', '{FAILED}') AND finished_at < NOW() - INTERVAL %s DAY
+            """, (conf.WORK_QUEUE_RETENTION_DAYS,))
+        connection.commit()
+        return True
+    except Error as e:
+        connection.rollback()
+        logging.error(f"Error purging finished tasks: {e}")
+        return False
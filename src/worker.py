@@ -0,0 +1,321 @@
+""" Pipeline worker - processes tasks of the work queue (work_queue.py), any number of workers on one or
+    more hosts against the same database (and a raw data folder shared by the hosts).
+
+    Tasks:
+        ingest_file      - ingest one CSV of the raw data folder (key: file name)
+        anomalies_shard  - score the new raw rows of one turbine id shard (key: get_shard_key)
+        clean_shard      - clean the new raw rows of one turbine id shard
+
+    One worker is started as the coordinator. It enqueues the tasks phase by phase and works on them
+    like the other workers; between the phases it runs what can't be split: the mean / median / mode
+    stats (imputation needs them after all anomalies are stored, before any row is cleaned), moving
+    the clean raw id watermark once every shard is cleaned, the late corrections and the summaries.
+
+    Two local processes:
+        python src/worker.py --coordinator --shards 4
+        python src/worker.py --idle-exit 60
+"""
+
+import argparse
+import logging
+import os
+import socket
+import threading
+import time
+
+from mysql.connector import Error
+import config as conf
+import dag
+import metrics
+import run_ledger
+from clean_data import (get_new_raw_id_range, get_anomaly_bounds, detect_and_store_anomalies, process_statistics,
+                        update_clean_table, apply_late_corrections, CLEAN_RAW_ID_WATERMARK, NOT_SCORED)
+from ingest_data import get_csv_files, ingest_csv
+from run_ledger import record_commit, table_resource
+from watermarks import set_watermark
+from work_queue import (acquire_coordinator_lock, claim_task, complete_task, enqueue_tasks, get_task_counts,
+                        purge_finished_tasks, reclaim_expired_leases, release_coordinator_lock, renew_lease,
+                        PENDING, LEASED, FAILED)
+
+INGEST_FILE = "ingest_file"
+ANOMALIES_SHARD = "anomalies_shard"
+CLEAN_SHARD = "clean_shard"
+
+# pipeline step a task's work is attributed to in the run metrics and the run ledger
+TASK_STEPS = {INGEST_FILE: "Data Ingestion", ANOMALIES_SHARD: "Data Cleaning", CLEAN_SHARD: "Data Cleaning"}
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def get_shard_key(raw_id_range, shard, bounds=None):
+    """ "raw_id:100-250:shard:1/4", the raw id range is part of the key so every batch gets new tasks.
+        With bounds the anomaly bounds computed by the coordinator are carried along, e.g.
+        "raw_id:100-250:shard:1/4:bounds:-0.52/3.87", so all shards score with the same bounds.
+    """
+    task_key = f"raw_id:{raw_id_range[0]}-{raw_id_range[1]}:shard:{shard[0]}/{shard[1]}"
+    return task_key if bounds is None else f"{task_key}:bounds:{float(bounds[0])!r}/{float(bounds[1])!r}"
+
+
+def parse_shard_key(task_key):
+    # "raw_id:100-250:shard:1/4" -> ((100, 250), (1, 4))
+    _, id_range, _, shard = task_key.split(":")[:4]
+    first_id, last_id = id_range.split("-")
+    shard_index, shard_count = shard.split("/")
+    return (int(first_id), int(last_id)), (int(shard_index), int(shard_count))
+
+
+def parse_shard_bounds(task_key):
+    # anomaly bounds of a shard key, None for a key without them
+    parts = task_key.split(":")
+    if len(parts) < 6 or parts[4] != "bounds":
+        return None
+    lower_bound, upper_bound = parts[5].split("/")
+    return float(lower_bound), float(upper_bound)
+
+
+def run_ingest_file(connection, task_key):
+    file_path = os.path.join(conf.RAW_DATA_FOLDER, task_key)
+    if not os.path.exists(file_path):
+        # archived by an earlier attempt that lost its lease after the file was committed
+        logging.info(f"{file_path} already archived")
+        return True
+    return ingest_csv(connection, file_path) is not None
+
+
+def run_anomalies_shard(connection, task_key):
+    raw_id_range, shard = parse_shard_key(task_key)
+    # an unscored shard fails the phase, so the range isn't cleaned and the watermark isn't moved
+    return detect_and_store_anomalies(connection, raw_id_range, shard, parse_shard_bounds(task_key)) not in (False, NOT_SCORED)
+
+
+def run_clean_shard(connection, task_key):
+    raw_id_range, shard = parse_shard_key(task_key)
+    return update_clean_table(connection, raw_id_range, shard)
+
+
+TASK_HANDLERS = {INGEST_FILE: run_ingest_file, ANOMALIES_SHARD: run_anomalies_shard, CLEAN_SHARD: run_clean_shard}
+
+
+def keep_lease(task, done, lost, task_connection_id=None):
+    """ Renew the task's lease every third of the lease time until done is set, with a connection of its own.
+        When the lease was lost (expired and reclaimed - another worker may run the task now) lost is set
+        and the statement running on the task's connection is killed, so the task fails instead of
+        committing next to the new owner.
+    """
+    connection = conf.get_db_connection()
+    try:
+        while not done.wait(conf.WORK_QUEUE_LEASE_SECONDS / 3):
+            renewed = renew_lease(connection, task) if connection is not None else None
+            if renewed is None:
+                # DB error, the lease may still be held - tried again at the next renewal
+                logging.warning(f"Could not renew the lease of {task.task_type} {task.task_key}")
+            elif not renewed:
+                logging.error(f"Lease of {task.task_type} {task.task_key} was lost, aborting the task")
+                lost.set()
+                if task_connection_id is not None:
+                    try:
+                        with connection.cursor() as cursor:
+                            cursor.execute(f"KILL QUERY {int(task_connection_id)}")
+                    except Error as e:
+                        logging.warning(f"Could not abort the statement of {task.task_type} {task.task_key}: {e}")
+                return
+    finally:
+        if connection:
+            connection.close()
+
+
+def run_task(connection, task):
+    logging.info(f"run_task function called....\n")
+
+    """ Run a claimed task while renewing its lease, then complete it (done, or back to pending on
+        failure). A task whose lease was lost is not completed, the worker that reclaimed it owns it now.
+        Returns True if the task succeeded.
+    """
+    done = threading.Event()
+    lost = threading.Event()
+    heartbeat = threading.Thread(target=keep_lease, args=(task, done, lost, getattr(connection, "connection_id", None)),
+                                 name=f"lease-{task.id}", daemon=True)
+    heartbeat.start()
+    error = None
+    try:
+        with metrics.step_metrics(TASK_STEPS[task.task_type]):
+            if not TASK_HANDLERS[task.task_type](connection, task.task_key):
+                error = f"{task.task_type} {task.task_key} failed"
+    except Exception as e:
+        connection.rollback()
+        error = f"{task.task_type} {task.task_key} failed: {e}"
+    finally:
+        done.set()
+        heartbeat.join()
+
+    if lost.is_set():
+        logging.error(f"{task.task_type} {task.task_key} stopped, its lease was lost")
+        return False
+    if error:
+        logging.error(error)
+    complete_task(connection, task, error)
+    return error is None
+
+
+def work(connection, worker_id, task_types):
+    # claim and run one task, False if there was nothing to claim
+    reclaim_expired_leases(connection)
+    task = claim_task(connection, worker_id, task_types)
+    if task is None:
+        return False
+    run_task(connection, task)
+    return True
+
+
+def run_phase(connection, worker_id, task_type, task_keys):
+    logging.info(f"run_phase function called....\n")
+
+    """ Enqueue the tasks of a phase and work on them (with the other workers) until none is pending
+        or leased. Returns True if every task of the phase is done.
+    """
+    if not task_keys:
+        return True
+    if not enqueue_tasks(connection, task_type, task_keys):
+        return False
+
+    while True:
+        if not work(connection, worker_id, [task_type]):
+            counts = get_task_counts(connection, task_type, task_keys)
+            if not counts.get(PENDING) and not counts.get(LEASED):
+                break
+            # the remaining tasks are running on other workers
+            time.sleep(conf.WORK_QUEUE_POLL_SECONDS)
+
+    if counts.get(FAILED):
+        logging.error(f"{counts[FAILED]} of {len(task_keys)} {task_type} tasks failed")
+        return False
+    logging.info(f"{len(task_keys)} {task_type} tasks done")
+    return True
+
+
+def finish_clean_range(connection, raw_id_range):
+    # every shard of the range is cleaned - move the clean raw id watermark as update_clean_table does
+    with connection.cursor() as cursor:
+        set_watermark(cursor, CLEAN_RAW_ID_WATERMARK, raw_id_range[1])
+        record_commit(cursor, table_resource(conf.CLEAN_DATA_TABLE), f"raw_id:{raw_id_range[1]}", step="Data Cleaning")
+    connection.commit()
+
+
+def run_coordinator(connection, worker_id, shards):
+    logging.info(f"run_coordinator function called....\n")
+
+    """ Run the pipeline through the work queue: ingestion per file, cleaning per turbine id shard,
+        then the late corrections, the summaries and the Parquet export (when enabled). Returns True on success.
+    """
+    from calculate_summary_stats import daily_summary_main, anomalies_summary_main
+    from parquet_export import main as export_parquet
+
+    purge_finished_tasks(connection)
+
+    csv_files = get_csv_files()
+    if not run_phase(connection, worker_id, INGEST_FILE, csv_files):
+        return False
+    if conf.COLUMN_STORE:
+        # the files of every worker, from the raw table (each worker only read its own CSVs)
+        from column_store import sync_from_database
+        sync_from_database(connection)
+
+    raw_id_range = get_new_raw_id_range(connection)
+    bounds = None
+    if raw_id_range is not None:
+        # anomaly bounds computed once for every shard (one scan of the clean table, the same bounds for all)
+        with connection.cursor() as cursor:
+            bounds = get_anomaly_bounds(cursor)
+        if bounds is None:
+            logging.warning(f"No anomaly bounds, raw rows {raw_id_range} left unscored and uncleaned")
+    if bounds is not None:
+        shard_keys = [get_shard_key(raw_id_range, (shard_index, shards), bounds) for shard_index in range(shards)]
+        if not run_phase(connection, worker_id, ANOMALIES_SHARD, shard_keys):
+            return False
+        with metrics.step_metrics("Data Cleaning"):
+            if process_statistics(connection, raw_id_range) is False:
+                logging.error("Failed to process statistic, aborting...")
+                return False
+        if not run_phase(connection, worker_id, CLEAN_SHARD, shard_keys):
+            return False
+        finish_clean_range(connection, raw_id_range)
+
+    with metrics.step_metrics("Data Cleaning"):
+        if not apply_late_corrections(connection):
+            return False
+
+    for result in (daily_summary_main(), anomalies_summary_main()):
+        if result.failed:
+            return False
+    if conf.PARQUET_EXPORT:
+        with metrics.step_metrics("Parquet Export"):
+            if export_parquet().failed:
+                return False
+    return True
+
+
+def run_worker(connection, worker_id, idle_exit=None):
+    # work on tasks of any type, until the queue was empty for idle_exit seconds (forever when None)
+    idle_since = time.monotonic()
+    while idle_exit is None or time.monotonic() - idle_since < idle_exit:
+        if work(connection, worker_id, list(TASK_HANDLERS)):
+            idle_since = time.monotonic()
+        else:
+            time.sleep(conf.WORK_QUEUE_POLL_SECONDS)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--coordinator", action="store_true", help="enqueue the pipeline's tasks and run the unsplit work")
+    parser.add_argument("--shards", type=int, default=conf.WORK_QUEUE_SHARDS, help="turbine id shards for cleaning")
+    parser.add_argument("--idle-exit", type=float, help="worker exits after the queue was empty this many seconds")
+    parser.add_argument("--worker-id", default=get_worker_id())
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    conf.initialize()
+    connection = None
+    try:
+        logging.info(f"Wind Turbine - worker {args.worker_id} starts \n")
+        if args.coordinator:
+            from setup_database import main as setup_database
+            if not setup_database():
+                return False
+
+        connection = conf.get_db_connection()
+        if connection is None:
+            logging.error(f"DB Connection failed - check get_db_connection function in config.py")
+            return False
+
+        if not args.coordinator:
+            run_worker(connection, args.worker_id, args.idle_exit)
+            return True
+
+        # one coordinator at a time, a second one would enqueue and clean the same raw id range
+        if not acquire_coordinator_lock(connection):
+            logging.error(f"Another coordinator is running, worker {args.worker_id} exits")
+            return False
+        try:
+            run_ledger.start_run(connection)
+            success = run_coordinator(connection, args.worker_id, args.shards)
+            run_ledger.finish_run(connection, dag.SUCCESS if success else dag.FAILED)
+            return success
+        finally:
+            release_coordinator_lock(connection)
+
+    except Exception as e:
+        logging.error(f"Worker {args.worker_id} - Unexpected error occurred: {e}\n")
+        return False
+    finally:
+        if connection:
+            connection.close()
+            logging.info("DB Connection closed.")
+
+
+if __name__ == "__main__":
+    result = main()
+    logging.info(f"Worker - completed \n")
@@ -13,10 +13,43 @@ from mysql.connector import Error
 # Get the parent directory (for src)
 ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
 
 import config  
 import ingest_data
 import clean_data  
+import calculate_summary_stats
+import rollups
+import wind_rose
+import numpy as np
+import db_fetch
+import stats_kernel
+import memory_mode
+import dag
+import metrics
+import profiling
+import pstats
+import generate_fleet_data
+import in_memory_pipeline
+import work_queue
+import worker
+import log_setup
+import pipelined_ingest
+import query_api
+import http_service
+import http.client
+import turbine_state
+import parquet_export
+import column_store
+import turbine_registry
+import hot_window
+import daily_distribution
+import watermarks
+import logging
+import json
+import subprocess
+import threading
+import time
 
 # Mock DB table names
 MOCK_RAW_DATA_TABLE = 'mock_wind_turbine_raw_data'
@@ -219,6 +252,981 @@ def test_update_clean_table_failure(mock_db_connection):
     mock_connection.commit.assert_not_called()  
     assert not result, "update_clean_table should return False on failure"
 
+def test_update_clean_table_with_raw_id_range(mock_db_connection):
+    """Test the raw id watermark and run ledger row are committed together with the clean rows"""
+
+    mock_connection, mock_cursor = mock_db_connection
+
+    result = clean_data.update_clean_table(mock_connection, (10, 25))
+
+    assert result
+    queries = [c.args[0] for c in mock_cursor.execute.call_args_list]
+    assert "r.id > %s AND r.id <= %s" in queries[0]
+    assert mock_cursor.execute.call_args_list[0].args[1] == (10, 25)
+    assert any(config.WATERMARKS_TABLE in query for query in queries[1:])
+    assert any(config.RUN_LEDGER_TABLE in query for query in queries[1:])
+    mock_connection.commit.assert_called_once()
+
+@patch("clean_data.mark_changes_consumed")
+@patch("clean_data.get_pending_change_range", return_value=(3, 5))
+@patch("clean_data.update_clean_table")
+@patch("clean_data.process_statistics")
+@patch("clean_data.get_anomaly_bounds", return_value=None)
+@patch("clean_data.get_new_raw_id_range", return_value=(10, 25))
+def test_cleaning_without_anomaly_bounds_keeps_rows_unscored(mock_range, mock_bounds, mock_stats, mock_update,
+                                                             mock_change_range, mock_consumed, mock_db_connection):
+    """Test raw rows and corrections that couldn't be scored are not cleaned, the watermark and offset don't move"""
+    mock_connection, mock_cursor = mock_db_connection
+
+    with patch("config.get_db_connection", return_value=mock_connection):
+        assert clean_data.detect_and_store_anomalies(mock_connection, (10, 25)) == clean_data.NOT_SCORED
+        assert clean_data.apply_late_corrections(mock_connection) == clean_data.NOT_SCORED
+        assert clean_data.main()
+
+    mock_stats.assert_not_called()
+    mock_update.assert_not_called()
+    mock_cursor.execute.assert_not_called()
+    mock_consumed.assert_not_called()
+    mock_connection.commit.assert_not_called()
+
+@patch("ingest_data.move_csv_to_archive")
+def test_ingest_csv_commits_tracker_with_data(mock_move, mock_db_connection, save_mock_data_to_csv):
+    """Test the tracker and run ledger rows are written in the transaction of the loaded rows"""
+
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.return_value = None
+    mock_cursor.rowcount = 1
+
+    result = ingest_data.ingest_csv(mock_connection, save_mock_data_to_csv)
+
+    assert result == 2
+    queries = [c.args[0] for c in mock_cursor.execute.call_args_list]
+    assert any(config.INGESTION_TRACKER_TABLE in query and "INSERT" in query for query in queries)
+    assert any(config.RUN_LEDGER_TABLE in query for query in queries)
+    mock_connection.commit.assert_called_once()
+    mock_move.assert_called_once()
+
+@patch("ingest_data.move_csv_to_archive")
+def test_ingest_csv_records_corrected_rows(mock_move, mock_db_connection, save_mock_data_to_csv):
+    """Test rows updated by ON DUPLICATE KEY UPDATE (rowcount 2) are added to the change log"""
+
+    mock_connection, mock_cursor = mock_db_connection
+    # first run for the file, every row is an update of an existing record
+    mock_cursor.fetchone.return_value = None
+    mock_cursor.rowcount = 2
+
+    result = ingest_data.ingest_csv(mock_connection, save_mock_data_to_csv)
+
+    assert result
+    change_log_calls = [c for c in mock_cursor.executemany.call_args_list if config.CHANGE_LOG_TABLE in c.args[0]]
+    assert len(change_log_calls) == 1
+    assert [key[1] for key in change_log_calls[0].args[1]] == [1, 2]
+    mock_connection.commit.assert_called()
+
+def test_memory_efficient_fetch_keeps_large_turbine_ids(mock_db_connection, monkeypatch):
+    """Test turbine ids above the int16 range survive a typed fetch in memory efficient mode"""
+    mock_connection, mock_cursor = mock_db_connection
+    monkeypatch.setattr(config, "MEMORY_EFFICIENT_MODE", True)
+    mock_cursor.description = [("turbine_id",), ("power_output",)]
+    mock_cursor.fetchmany.side_effect = [[(40000, 1.5), (7, None)], []]
+
+    batches = list(db_fetch.fetch_batches(mock_cursor, "SELECT turbine_id, power_output FROM t", dtypes=memory_mode.get_dtypes()))
+    assert batches[0]["turbine_id"].tolist() == [40000, 7]
+    assert batches[0]["power_output"].dtype == np.float32
+
+def test_get_watermark_raises_db_errors(mock_db_connection):
+    """Test a failed watermark read isn't mistaken for a watermark that was never set"""
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.return_value = None
+    assert watermarks.get_watermark(mock_connection, "clean_data:raw_id") is None
+
+    mock_cursor.execute.side_effect = Error("Lost connection to MySQL server")
+    with pytest.raises(Error):
+        watermarks.get_watermark(mock_connection, "clean_data:raw_id")
+    with pytest.raises(Error):
+        clean_data.get_new_raw_id_range(mock_connection)
+
+def test_apply_late_corrections_without_pending_changes(mock_db_connection):
+    """Test apply_late_corrections is a no-op when the change log has nothing new"""
+
+    mock_connection, mock_cursor = mock_db_connection
+    with patch("clean_data.get_pending_change_range", return_value=None):
+        result = clean_data.apply_late_corrections(mock_connection)
+
+    assert result
+    mock_cursor.execute.assert_not_called()
+    mock_connection.commit.assert_not_called()
+
+def test_get_day_ranges_merges_consecutive_days():
+    """Test consecutive days are collapsed into a single range"""
+    days = [datetime(2022, 3, 2).date(), datetime(2022, 3, 1).date(), datetime(2022, 3, 5).date()]
+
+    ranges = calculate_summary_stats.get_day_ranges(days)
+
+    assert ranges == [
+        (datetime(2022, 3, 1), datetime(2022, 3, 3)),
+        (datetime(2022, 3, 5), datetime(2022, 3, 6)),
+    ]
+
+def test_calculate_summary_stats_only_dirty_days(mock_db_connection):
+    """Test only the given days are aggregated, one INSERT ... SELECT per range of consecutive days"""
+
+    mock_connection, mock_cursor = mock_db_connection
+    days = [datetime(2022, 3, 1).date(), datetime(2022, 3, 2).date(), datetime(2022, 3, 9).date()]
+
+    result = calculate_summary_stats.calculate_summary_stats(mock_connection, days, commit=False)
+
+    assert result
+    assert mock_cursor.execute.call_count == 2
+    query, params = mock_cursor.execute.call_args_list[0].args
+    assert "GROUP BY" in query and "WHERE timestamp >= %s AND timestamp < %s" in query
+    assert params == (datetime(2022, 3, 1), datetime(2022, 3, 3))
+    mock_connection.commit.assert_not_called()
+
+@patch("calculate_summary_stats.get_pending_change_range", return_value=None)
+@patch("calculate_summary_stats.get_watermark", return_value=None)
+def test_get_dirty_days_without_watermark(mock_watermark, mock_change_range, mock_db_connection):
+    """Test the first summary run aggregates the full clean table"""
+
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.return_value = (datetime(2022, 3, 31, 23, 0, 0),)
+
+    days, clean_watermark, change_range = calculate_summary_stats.get_dirty_days(mock_connection)
+
+    assert days is None
+    assert clean_watermark == datetime(2022, 3, 31, 23, 0, 0)
+    assert change_range is None
+
+def test_get_period_ranges_widens_days_to_weeks_and_months():
+    """Test dirty days make their whole week / month dirty and overlapping periods are merged"""
+    day_ranges = [(datetime(2022, 3, 2), datetime(2022, 3, 3)), (datetime(2022, 3, 4), datetime(2022, 3, 8))]
+
+    assert rollups.get_period_ranges("week", day_ranges) == [(datetime(2022, 2, 28), datetime(2022, 3, 14))]
+    assert rollups.get_period_ranges("month", day_ranges) == [(datetime(2022, 3, 1), datetime(2022, 4, 1))]
+
+def test_update_rollups_builds_levels_in_order(mock_db_connection):
+    """Test hourly level is built from clean data and each other level from the level below"""
+
+    mock_connection, mock_cursor = mock_db_connection
+
+    rollups.update_rollups(mock_cursor, [(datetime(2022, 3, 1), datetime(2022, 3, 2))])
+
+    inserts = [c.args[0] for c in mock_cursor.execute.call_args_list if "INSERT INTO" in c.args[0]]
+    assert config.CLEAN_DATA_TABLE in inserts[0]
+    assert [query.split("SELECT '")[1][:5] for query in inserts] == ["hour'", "hour'", "day',", "week'", "month"]
+    mock_connection.commit.assert_not_called()
+
+def test_get_variance_from_sums():
+    """Test variance derived from count, sum and sum of squares"""
+    assert rollups.get_variance(4, 10.0, 30.0) == pytest.approx(1.25)
+    assert rollups.get_variance(0, 0.0, 0.0) is None
+
+def test_bin_readings_sectors_and_speed_bins():
+    """Test sector 0 is centred on North and speeds above the last bin are clipped"""
+    sectors, speed_bins = wind_rose.bin_readings(np.array([0.4, 5.5, 99.0]), np.array([355.0, 12.0, 180.0]))
+
+    assert sectors.tolist() == [0, 1, 8]
+    assert speed_bins.tolist() == [0, 5, config.WIND_SPEED_BINS - 1]
+
+def test_build_histogram_counts_and_power_sums():
+    """Test readings of the same day, turbine, sector and speed bin are counted together"""
+    keys, counts, power_sums = wind_rose.build_histogram(
+        np.array([0, 0, 0, 1]), np.array([1, 1, 2, 1]),
+        np.array([10.2, 10.7, 10.2, np.nan]), np.array([90.0, 91.0, 90.0, 90.0]),
+        np.array([2.0, 3.0, 1.0, 5.0])
+    )
+
+    assert keys.tolist() == [[0, 1, 4, 10], [0, 2, 4, 10]]
+    assert counts.tolist() == [2, 1]
+    assert power_sums.tolist() == [5.0, 1.0]
+
+def test_fetch_arrays_streams_batches_into_typed_arrays(mock_db_connection):
+    """Test rows are fetched with fetchmany and converted into typed arrays, NULL becomes NaN"""
+
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.description = [("turbine_id",), ("power_output",)]
+    mock_cursor.fetchmany.side_effect = [[(1, 2.5), (2, None)], [(3, 1.0)], []]
+
+    arrays = db_fetch.fetch_arrays(mock_cursor, "SELECT turbine_id, power_output FROM t", dtypes={
+        "turbine_id": np.int16, "power_output": np.float32
+    }, batch_size=2)
+
+    assert arrays["turbine_id"].dtype == np.int16
+    assert arrays["turbine_id"].tolist() == [1, 2, 3]
+    assert arrays["power_output"].dtype == np.float32
+    assert np.isnan(arrays["power_output"][1])
+    mock_cursor.fetchmany.assert_called_with(2)
+
+def test_get_filtered_data_uses_typed_fetch(mock_db_connection):
+    """Test get_filtered_data returns float columns without a dictionary cursor"""
+
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.description = [("wind_speed",), ("wind_direction",), ("power_output",)]
+    mock_cursor.fetchmany.side_effect = [[(10.5, 100.0, 2.5), (11.0, 200.0, 3.0)], []]
+
+    df = clean_data.get_filtered_data(mock_connection, None)
+
+    mock_connection.cursor.assert_called_once_with()
+    assert list(df.columns) == ["wind_speed", "wind_direction", "power_output"]
+    assert df["power_output"].dtype == np.float64
+    assert len(df) == 2
+
+def test_calculate_statistics_mean_median_mode():
+    """Test mean, median, mode and circular mean of wind_direction"""
+    df = pd.DataFrame({
+        'wind_speed': [10.0, 10.0, 12.0, np.nan],
+        'wind_direction': [350.0, 10.0, 10.0, 20.0],
+        'power_output': [2.1, 2.1, 2.4, 3.0],
+    })
+
+    stats_dict = clean_data.calculate_statistics(df)
+
+    assert stats_dict["wind_speed"] == {"mean": pytest.approx(32 / 3), "median": 10.0, "mode": 10.0}
+    # arithmetic mean would be 97.5, the circular mean stays near North
+    assert stats_dict["wind_direction"]["mean"] == pytest.approx(7.5, abs=0.1)
+    assert stats_dict["wind_direction"]["mode"] == 10.0
+    assert stats_dict["power_output"]["mode"] == pytest.approx(2.1)
+
+def test_grouped_frame_stats_per_turbine():
+    """Test stats grouped per turbine"""
+    df = pd.DataFrame({
+        'turbine_id': [2, 1, 2, 1],
+        'wind_speed': [5.0, 10.0, 7.0, 10.0],
+        'wind_direction': [90.0, 180.0, 90.0, 180.0],
+        'power_output': [1.0, 2.0, 3.0, 2.0],
+    })
+
+    stats_dict = stats_kernel.grouped_frame_stats(df["turbine_id"].to_numpy(), df)
+
+    assert sorted(stats_dict) == [1, 2]
+    assert stats_dict[1]["wind_speed"]["mode"] == 10.0
+    assert stats_dict[2]["power_output"]["median"] == 2.0
+    assert stats_dict[2]["wind_direction"]["mean"] == pytest.approx(90.0)
+
+def test_quantized_mode_ties_go_to_smallest_value():
+    """Test the bincount mode behaves like scipy.stats.mode on ties"""
+    assert stats_kernel.quantized_mode(np.array([3.0, 1.0, 3.0, 1.0, 2.0]), 1.0) == 1.0
+
+def test_compact_frame_in_memory_efficient_mode(monkeypatch):
+    """Test compact dtypes: float32 measurements, int16 turbine ids, datetime64 days, categorical periods"""
+    monkeypatch.setattr(config, "MEMORY_EFFICIENT_MODE", True)
+    df = pd.DataFrame({
+        'day': [datetime(2022, 3, 1).date(), datetime(2022, 3, 2).date()],
+        'turbine_id': [1, 2],
+        'power_output': [2.5, 3.0],
+        'period': ["last_1_day", "last_1_day"],
+    })
+
+    df = memory_mode.compact_frame(df)
+
+    assert df["turbine_id"].dtype == np.int16
+    assert df["power_output"].dtype == np.float32
+    assert df["period"].dtype == "category"
+    assert pd.api.types.is_datetime64_any_dtype(df["day"])
+
+def test_read_new_rows_in_chunks_over_memory_budget(monkeypatch, save_mock_data_to_csv):
+    """Test a CSV larger than the memory budget is read in chunks"""
+    monkeypatch.setattr(memory_mode, "get_rows_within_budget", lambda: 1)
+
+    chunks = list(ingest_data.read_new_rows(save_mock_data_to_csv, 0))
+
+    assert [len(chunk) for chunk in chunks] == [1, 1]
+    assert pd.api.types.is_datetime64_any_dtype(chunks[0]["timestamp"])
+
+class MockDagState:
+    """In-memory replacement of the watermarks backed DAG state"""
+    def __init__(self):
+        self.values = {}
+    def get_version(self, resource):
+        return self.values.get(f"version:{resource}")
+    def bump_versions(self, resources, version):
+        self.values.update({f"version:{resource}": version for resource in resources})
+    def get_inputs_hash(self, step_name):
+        return self.values.get(f"dag_inputs:{step_name}")
+    def set_inputs_hash(self, step_name, inputs_hash):
+        self.values[f"dag_inputs:{step_name}"] = inputs_hash
+    def close(self):
+        pass
+
+def run_mock_step(step):
+    return step.func()
+
+def test_run_dag_skips_steps_with_unchanged_inputs():
+    """Test a second run with nothing new only runs the step without inputs"""
+    calls = []
+    def make_step(name, status, **kwargs):
+        return dag.Step(name, lambda: calls.append(name) or dag.StepResult(status), **kwargs)
+
+    steps = [
+        make_step("ingest", dag.SUCCESS, outputs=["table:raw"]),
+        make_step("clean", dag.SUCCESS, inputs=["table:raw"], outputs=["table:clean"]),
+    ]
+    state = MockDagState()
+    dag.run_dag(steps, run_mock_step, state=state)
+    assert calls == ["ingest", "clean"]
+
+    # ingest finds nothing new: raw table version unchanged, so clean is skipped
+    steps[0] = make_step("ingest", dag.NO_DATA, outputs=["table:raw"])
+    calls.clear()
+    results = dag.run_dag(steps, run_mock_step, state=state)
+    assert calls == ["ingest"]
+    assert results["clean"].status == dag.SKIPPED
+
+def test_run_dag_runs_branches_in_parallel_and_blocks_after_failure():
+    """Test independent steps run concurrently and dependents of a failed step don't run"""
+    barrier = threading.Barrier(2, timeout=5)
+    def branch():
+        barrier.wait()
+        return True
+
+    steps = [
+        dag.Step("clean", lambda: True, outputs=["table:clean", "table:anomalies"]),
+        dag.Step("daily summary", branch, inputs=["table:clean"]),
+        dag.Step("anomalies summary", branch, inputs=["table:anomalies"]),
+        dag.Step("broken", lambda: False, outputs=["table:broken"]),
+        dag.Step("after broken", lambda: True, inputs=["table:broken"]),
+    ]
+    results = dag.run_dag(steps, run_mock_step, state=MockDagState())
+
+    assert results["daily summary"].status == dag.SUCCESS
+    assert results["anomalies summary"].status == dag.SUCCESS
+    assert results["broken"].status == dag.FAILED
+    assert results["after broken"].status == dag.BLOCKED
+
+@patch("ingest_data.os.listdir", return_value=[])
+@patch("config.get_db_connection")
+def test_ingest_main_without_new_files_is_no_data(mock_get_connection, mock_listdir):
+    """Test an empty raw data folder is reported as no_data instead of a failure"""
+    result = ingest_data.main()
+
+    assert result.status == dag.NO_DATA
+    assert not result.failed
+
+def test_instrumented_cursor_records_step_metrics(mock_db_connection):
+    """Test statements run inside a step are timed and their rows counted for that step"""
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.rowcount = 3
+    mock_cursor.fetchall.return_value = [(1,), (2,)]
+    metrics.reset()
+
+    connection = metrics.instrument_connection(mock_connection)
+    with metrics.step_metrics("Data Cleaning") as step:
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO   t VALUES (%s)", (1,))
+            cursor.execute("SELECT id FROM t")
+            cursor.fetchall()
+
+    run_metrics = metrics.build_run_metrics("test")
+    assert step["rows_written"] == 3
+    assert step["rows_read"] == 2
+    names = {query["name"]: query for query in run_metrics["queries"]}
+    assert names["INSERT INTO t VALUES (%s)"]["count"] == 1
+    assert names["SELECT id FROM t"]["rows"] == 2
+    mock_cursor.execute.assert_any_call("INSERT INTO   t VALUES (%s)", (1,))
+
+def test_timed_batch_adds_up_per_row_statements(mock_db_connection):
+    """Test per row executes inside a batch are recorded once, at the end of the batch"""
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.rowcount = 1
+    metrics.reset()
+    metrics.get_statement_name.cache_clear()
+
+    connection = metrics.instrument_connection(mock_connection)
+    with metrics.step_metrics("Data Ingestion") as step:
+        with connection.cursor() as cursor, metrics.timed_batch("ingest_csv batch", rows=3):
+            for value in range(3):
+                cursor.execute("INSERT INTO t VALUES (%s)", (value,))
+            assert metrics.build_run_metrics("test")["queries"] == [] and step["rows_written"] == 0
+
+    run_metrics = metrics.build_run_metrics("test")
+    assert [(query["name"], query["count"], query["rows"]) for query in run_metrics["queries"]] == [("INSERT INTO t VALUES (%s)", 3, 3)]
+    assert step["rows_written"] == 3
+    assert run_metrics["batches"][0]["count"] == 1
+    assert metrics.get_statement_name.cache_info().misses == 1
+
+@pytest.mark.skipif(memory_mode.get_rss_mb() is None, reason="RSS is read from /proc (Linux)")
+def test_step_metrics_samples_the_peak_rss_of_the_step():
+    """Test the peak RSS is sampled while the step runs, not the process high-water mark"""
+    metrics.reset()
+    with metrics.step_metrics("Data Cleaning") as step:
+        block = b"\x01" * (64 * 1024 * 1024)
+        time.sleep(3 * config.METRICS_RSS_SAMPLE_SECONDS)
+    assert step["peak_rss_growth_mb"] >= 60 and step["peak_rss_mb"] >= step["peak_rss_growth_mb"]
+    del block
+
+    # a later step without the allocation doesn't inherit the earlier peak
+    with metrics.step_metrics("Summary Statistics") as step:
+        pass
+    assert step["peak_rss_growth_mb"] < 60
+    assert 'wind_turbine_step_peak_rss_megabytes{step="Summary Statistics"}' in metrics.format_prometheus(metrics.build_run_metrics("test"))
+
+def test_write_run_metrics_json_and_prometheus(tmp_path, monkeypatch):
+    """Test the run metrics files and the regression check against the previous run"""
+    monkeypatch.setattr(config, "LOGS_DIR", str(tmp_path))
+    monkeypatch.setattr(config, "METRICS_PROM_FILE", str(tmp_path / "pipeline.prom"))
+    with open(tmp_path / "metrics_20240101_000000.json", "w") as file:
+        json.dump({"steps": {"Data Ingestion": {"wall_time_seconds": 1e-9}}}, file)
+    metrics.reset()
+    with metrics.step_metrics("Data Ingestion"):
+        metrics.add_counts(rows_read=10, bytes_parsed=100)
+    metrics.set_step_status("Data Ingestion", "success")
+
+    run_metrics = metrics.write_run_metrics("20240102_000000")
+
+    assert run_metrics["regressions"][0]["step"] == "Data Ingestion"
+    assert json.load(open(tmp_path / "metrics_20240102_000000.json"))["steps"]["Data Ingestion"]["bytes_parsed"] == 100
+    prom = (tmp_path / "pipeline.prom").read_text()
+    assert 'wind_turbine_step_rows_read{step="Data Ingestion"} 10' in prom
+    assert 'wind_turbine_step_success{step="Data Ingestion",status="success"} 1' in prom
+    assert "peak_rss_mb" in json.load(open(tmp_path / "metrics_20240102_000000.json"))["steps"]["Data Ingestion"]
+    assert "process_peak_rss" not in prom
+
+def test_wrap_step_without_profiling_returns_step_function():
+    """Test steps that aren't selected run unwrapped (no profiling overhead)"""
+    def step():
+        return True
+    profiling.configure([], "cprofile")
+    assert profiling.wrap_step("Data Cleaning", step) is step
+
+    profiling.configure(["data_ingestion"], "cprofile")
+    assert profiling.wrap_step("Data Cleaning", step) is step
+    assert profiling.wrap_step("Data Ingestion", step) is not step
+    profiling.configure([], "cprofile")
+
+@pytest.mark.parametrize("profiler, extension", [("cprofile", "pstats"), ("sampling", "folded"), ("tracemalloc", "txt")])
+def test_profiled_step_writes_profile(tmp_path, monkeypatch, profiler, extension):
+    """Test a profiled step returns its result and writes the profiler output to the logs folder"""
+    monkeypatch.setattr(config, "LOGS_DIR", str(tmp_path))
+    monkeypatch.setattr(config, "PROFILE_SAMPLE_INTERVAL", 0.001)
+    def busy_step():
+        end = time.perf_counter() + 0.05
+        while time.perf_counter() < end:
+            sum(range(1000))
+        return True
+
+    profiling.configure(["all"], profiler)
+    result = profiling.wrap_step("Data Cleaning", busy_step)()
+    profiling.configure([], "cprofile")
+
+    assert result is True
+    profile_files = list(tmp_path.glob(f"profile_*_data_cleaning.{extension}"))
+    assert len(profile_files) == 1
+    if profiler == "cprofile":
+        assert pstats.Stats(str(profile_files[0])).total_calls > 0
+    elif profiler == "sampling":
+        assert "busy_step" in profile_files[0].read_text()
+
+def test_generate_fleet_data(tmp_path):
+    """Test the generated CSVs have the sample format, 5 turbines per file and injected NULLs / outliers"""
+    args = generate_fleet_data.build_parser().parse_args([
+        "--turbines", "7", "--days", "2", "--interval-minutes", "60", "--output-dir", str(tmp_path),
+        "--null-rate", "0.05", "--outlier-rate", "0.05",
+    ])
+    files = generate_fleet_data.generate_fleet(args)
+
+    assert [os.path.basename(f) for f in files] == ["data_group_1.csv", "data_group_2.csv"]
+    first = pd.read_csv(files[0])
+    assert list(first.columns) == ["timestamp", "turbine_id", "wind_speed", "wind_direction", "power_output"]
+    assert sorted(first["turbine_id"].unique()) == [1, 2, 3, 4, 5]
+    assert sorted(pd.read_csv(files[1])["turbine_id"].unique()) == [6, 7]
+    assert first["power_output"].isna().any()
+    assert (first["power_output"].abs() > generate_fleet_data.RATED_POWER).any()
+    assert pd.to_datetime(first["timestamp"]).max() == datetime(2022, 3, 2, 23)
+
+def test_in_memory_validate_batch_and_records():
+    """Test invalid / repeated rows are dropped and records are plain Python values with NULLs"""
+    batch = pd.DataFrame({
+        'timestamp': pd.to_datetime(['2022-03-01 00:00', '2022-03-01 00:00', None, '2022-03-01 01:00']),
+        'turbine_id': [1, 1, 2, 1],
+        'wind_speed': [10.0, 11.0, 9.0, np.nan],
+        'wind_direction': [180.0, 181.0, 90.0, 200.0],
+        'power_output': [np.float32(2.5), np.float32(2.6), 1.0, 3.0],
+    })
+
+    records = in_memory_pipeline.get_records(in_memory_pipeline.validate_batch(batch))
+
+    assert records == [
+        (datetime(2022, 3, 1, 0), 1, 11.0, 181.0, pytest.approx(2.6)),
+        (datetime(2022, 3, 1, 1), 1, None, 200.0, 3.0),
+    ]
+    assert type(records[0][0]) is datetime and type(records[0][4]) is float
+
+@patch("in_memory_pipeline.process_statistics", return_value=True)
+def test_in_memory_clean_new_records(mock_process_statistics, mock_db_connection):
+    """Test new records are scored and imputed from memory and written with bulk inserts"""
+    mock_connection, mock_cursor = mock_db_connection
+    # latest stats of conf.PERIOD_FOR_STATS: wind_speed median, wind_direction median, power_output mean
+    mock_cursor.fetchone.return_value = (8.0, 225.0, 2.0)
+    new_records = pd.DataFrame({
+        'timestamp': pd.to_datetime(['2022-03-01 00:00', '2022-03-01 01:00', '2022-03-01 02:00']),
+        'turbine_id': [1, 1, 1],
+        'wind_speed': [10.0, np.nan, 12.0],
+        'wind_direction': [180.0, 190.0, 200.0],
+        'power_output': [2.5, np.nan, 40.0],
+    })
+
+    assert in_memory_pipeline.clean_new_records(mock_connection, new_records, (0.0, 5.0))
+
+    anomalies_call, clean_call, state_call = mock_cursor.executemany.call_args_list
+    assert anomalies_call.args[1] == [(datetime(2022, 3, 1, 2), 1, 12.0, 200.0, 40.0)]
+    assert "INSERT IGNORE" in clean_call.args[0]
+    assert clean_call.args[1] == [
+        (datetime(2022, 3, 1, 0), 1, 10.0, 180.0, 2.5),
+        (datetime(2022, 3, 1, 1), 1, 8.0, 190.0, 2.0),
+    ]
+    # the turbine's latest reading is an anomaly
+    assert config.TURBINE_STATE_TABLE in state_call.args[0]
+    assert state_call.args[1] == [(1, 1, datetime(2022, 3, 1, 2), datetime(2022, 3, 1, 2))]
+    mock_process_statistics.assert_called_once()
+
+def test_worker_shard_key_round_trip():
+    """Test a cleaning shard task key carries the raw id range and the turbine id shard"""
+    task_key = worker.get_shard_key((100, 250), (1, 4))
+
+    assert worker.parse_shard_key(task_key) == ((100, 250), (1, 4))
+    assert clean_data.get_shard_filter("r.", (1, 4)) == (" AND r.turbine_id MOD %s = %s", (4, 1))
+
+@patch("clean_data.update_scored_state")
+@patch("clean_data.get_anomaly_bounds")
+def test_worker_anomalies_shards_use_the_coordinator_bounds(mock_bounds, mock_scored_state, mock_db_connection):
+    """Test the anomaly bounds travel in the shard key, a shard doesn't recompute them or count the anomalies table"""
+    mock_connection, mock_cursor = mock_db_connection
+    task_key = worker.get_shard_key((100, 250), (1, 4), (-0.1, 2.625))
+
+    assert worker.parse_shard_key(task_key) == ((100, 250), (1, 4))
+    assert worker.parse_shard_bounds(task_key) == (-0.1, 2.625)
+    assert worker.parse_shard_bounds(worker.get_shard_key((100, 250), (1, 4))) is None
+    assert worker.run_anomalies_shard(mock_connection, task_key)
+
+    mock_bounds.assert_not_called()
+    query, params = mock_cursor.execute.call_args_list[0].args
+    assert "COUNT(*)" not in query and params == (100, 250, -0.1, 2.625, 4, 1)
+
+@patch("worker.keep_lease")
+def test_worker_run_task_returns_failed_task_to_queue(mock_keep_lease, mock_db_connection):
+    """Test a failing task is completed with its error and only while the worker holds the lease"""
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.rowcount = 1
+    task = work_queue.Task(7, worker.INGEST_FILE, "data_group_1.csv", "token", 1)
+
+    with patch.dict(worker.TASK_HANDLERS, {worker.INGEST_FILE: lambda connection, task_key: False}):
+        assert not worker.run_task(mock_connection, task)
+
+    query, params = mock_cursor.execute.call_args.args
+    assert "lease_token = %s" in query and "IF(attempts >=" in query
+    assert params == ("ingest_file data_group_1.csv failed", 7, "token")
+
+def test_worker_aborts_a_task_whose_lease_was_lost(mock_db_connection, monkeypatch):
+    """Test a lost lease kills the task's statement and the task isn't completed by the old owner"""
+    mock_connection, mock_cursor = mock_db_connection
+    mock_connection.connection_id = 42
+    heartbeat_connection = MagicMock()
+    heartbeat_cursor = heartbeat_connection.cursor.return_value.__enter__.return_value
+    monkeypatch.setattr(config, "WORK_QUEUE_LEASE_SECONDS", 0.03)
+    task = work_queue.Task(7, worker.CLEAN_SHARD, "raw_id:0-10:shard:0/4", "token", 1)
+
+    def slow_shard(connection, task_key):
+        time.sleep(0.2)
+        return True
+
+    with patch("config.get_db_connection", return_value=heartbeat_connection), \
+         patch("worker.renew_lease", side_effect=[None, False]), \
+         patch("worker.complete_task") as mock_complete, \
+         patch.dict(worker.TASK_HANDLERS, {worker.CLEAN_SHARD: slow_shard}):
+        assert not worker.run_task(mock_connection, task)
+
+    heartbeat_cursor.execute.assert_called_once_with("KILL QUERY 42")
+    mock_complete.assert_not_called()
+
+@patch("worker.run_coordinator")
+def test_second_coordinator_exits_without_running(mock_run_coordinator, mock_db_connection):
+    """Test the coordinator takes the named lock before the phases, a second one exits"""
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.return_value = (0,)
+
+    with patch("config.initialize"), patch("setup_database.main", return_value=True), \
+         patch("config.get_db_connection", return_value=mock_connection):
+        assert worker.main(["--coordinator"]) is False
+
+    mock_run_coordinator.assert_not_called()
+    assert mock_cursor.execute.call_args.args == ("SELECT GET_LOCK(%s, 0)", (work_queue.COORDINATOR_LOCK,))
+
+def test_entry_point_imports_have_no_side_effects(tmp_path):
+    """Test importing the pipeline modules creates no folders / log files and doesn't load pandas"""
+    code = "import sys, worker, calculate_summary_stats; print('pandas' in sys.modules)"
+    completed = subprocess.run([sys.executable, "-c", code], cwd=tmp_path, capture_output=True, text=True,
+                               env=dict(os.environ, PYTHONPATH=os.path.join(ROOT_DIR, "src")))
+
+    assert completed.returncode == 0, completed.stderr
+    assert completed.stdout.strip() == "False"
+    assert os.listdir(tmp_path) == []
+
+def test_log_rate_limit_and_json_records():
+    """Test a noisy call site is rate limited, the next record written reports the suppressed count"""
+    rate_limit = log_setup.RateLimitFilter(limit=2, interval=60)
+    records = [logging.LogRecord("root", logging.WARNING, "ingest_data.py", 162, "Skipping invalid row: %s", (row,), None)
+               for row in range(5)]
+
+    assert [rate_limit.filter(record) for record in records] == [True, True, False, False, False]
+    assert rate_limit.filter(logging.LogRecord("root", logging.ERROR, "ingest_data.py", 162, "error", (), None))
+
+    rate_limit.windows[("ingest_data.py", 162)] = (time.monotonic() - 61, 2, 3)
+    record = logging.LogRecord("root", logging.WARNING, "ingest_data.py", 162, "Skipping invalid row: %s", (6,), None)
+    assert rate_limit.filter(record)
+    entry = json.loads(log_setup.JsonFormatter().format(record))
+    assert entry["message"] == "Skipping invalid row: 6"
+    assert entry["suppressed"] == 3 and entry["level"] == "WARNING"
+
+def test_log_sql_only_when_tracing_is_on():
+    """Test the SQL text is only logged when SQL tracing is switched on"""
+    with patch.object(log_setup.SQL_LOGGER, "debug") as mock_debug:
+        log_setup.SQL_LOGGER.setLevel(logging.WARNING)
+        log_setup.log_sql("update_clean_table query", "SELECT 1\n  FROM dual", (1, 2))
+        mock_debug.assert_not_called()
+
+        log_setup.SQL_LOGGER.setLevel(logging.DEBUG)
+        log_setup.log_sql("update_clean_table query", "SELECT 1\n  FROM dual", (1, 2))
+        assert mock_debug.call_args.args == ("%s: %s", "update_clean_table query", "SELECT 1 FROM dual")
+    log_setup.SQL_LOGGER.setLevel(logging.NOTSET)
+
+def test_pipelined_ingestion_writes_chunks_in_order(tmp_path):
+    """Test pipelined ingestion writes the parsed chunks in file order and returns what load_new_rows does"""
+    file_path = tmp_path / "data_group_1.csv"
+    rows = [f"2022-03-01 0{hour}:00:00,1,10.0,180.0,{hour}.5" for hour in range(5)]
+    file_path.write_text("timestamp,turbine_id,wind_speed,wind_direction,power_output\n" + "\n".join(rows) + "\n")
+    written = []
+
+    def insert_raw_rows(cursor, new_data, file_name):
+        assert file_name == "data_group_1.csv"
+        written.append(list(new_data["power_output"]))
+        return [(new_data.iloc[0]["timestamp"], 1)]
+
+    with patch.object(config, "PIPELINED_CHUNK_ROWS", 2), patch.object(config, "PIPELINED_QUEUE_CHUNKS", 1), \
+            patch("pipelined_ingest.insert_raw_rows", side_effect=insert_raw_rows):
+        new_rows, last_timestamp, changed_keys = pipelined_ingest.load_new_rows_pipelined(MagicMock(), str(file_path), 1)
+
+    assert written == [[1.5, 2.5], [3.5, 4.5]]
+    assert new_rows == 4 and last_timestamp == pd.Timestamp("2022-03-01 04:00:00")
+    assert [key[0] for key in changed_keys] == [pd.Timestamp("2022-03-01 01:00:00"), pd.Timestamp("2022-03-01 03:00:00")]
+
+    with patch("pipelined_ingest.insert_raw_rows", side_effect=Error("lost connection")):
+        with pytest.raises(Error):
+            pipelined_ingest.load_new_rows_pipelined(MagicMock(), str(file_path), 0)
+
+@patch("query_api.get_resource_versions")
+def test_query_api_cache_is_invalidated_by_a_new_table_version(mock_versions, mock_db_connection):
+    """Test a repeated query is served from the cache until the pipeline commits to the table it reads"""
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.description = [("day",), ("turbine_id",), ("min_power_output",), ("max_power_output",), ("avg_power_output",)]
+    mock_cursor.fetchall.return_value = [(datetime(2022, 3, 1).date(), 1, 1.0, 3.0, 2.0)]
+    mock_versions.return_value = {f"table:{config.SUMMARY_STATS_TABLE}": "10"}
+    query_api.get_cache().clear()
+
+    with patch.object(query_api.get_cache(), "version_check_seconds", 0):
+        first = query_api.get_fleet_summary(mock_connection, "2022-03-01", "2022-03-02")
+        second = query_api.get_fleet_summary(mock_connection, "2022-03-01", "2022-03-02")
+        assert second is first and mock_cursor.execute.call_count == 1
+        assert first.source == config.SUMMARY_STATS_TABLE and first.version == "10"
+
+        mock_versions.return_value = {f"table:{config.SUMMARY_STATS_TABLE}": "11"}
+        third = query_api.get_fleet_summary(mock_connection, "2022-03-01", "2022-03-02")
+        assert third is not first and third.version == "11" and mock_cursor.execute.call_count == 2
+    query_api.get_cache().clear()
+
+@patch("query_api.get_resource_versions", return_value={})
+def test_query_api_anomaly_counts_per_turbine(mock_versions, mock_db_connection):
+    """Test the per turbine columns of the anomalies summary table are returned as rows"""
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.description = [("day",), ("Turbine_ID_1",), ("Turbine_ID_2",)]
+    mock_cursor.fetchall.return_value = [("2022-03-01", 4, 0), ("2022-03-02", 1, 2)]
+    query_api.get_cache().clear()
+
+    result = query_api.get_anomaly_counts(mock_connection, "2022-03-01", "2022-03-03", turbine_ids=[2])
+
+    assert result.columns == ["day", "turbine_id", "anomaly_count"]
+    assert result.rows == [("2022-03-01", 2, 0), ("2022-03-02", 2, 2)]
+    query_api.get_cache().clear()
+
+@patch("query_api.get_resource_versions", return_value={f"table:{config.SUMMARY_STATS_TABLE}": "10"})
+def test_http_service_etag_and_chunked_json(mock_versions, mock_db_connection):
+    """Test the HTTP service streams the summary as chunked JSON and answers 304 while the table version is unchanged"""
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.description = [("day",), ("turbine_id",), ("avg_power_output",)]
+    mock_cursor.fetchall.return_value = [(datetime(2022, 3, 1).date(), turbine_id, 2.0) for turbine_id in range(1, 6)]
+    query_api.get_cache().clear()
+
+    server = http_service.PipelineHTTPServer(("127.0.0.1", 0), connection_factory=lambda: mock_connection, pool_size=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with patch.object(config, "HTTP_CHUNK_ROWS", 2):
+            client = http.client.HTTPConnection("127.0.0.1", server.server_port)
+            client.request("GET", "/summary?start=2022-03-01&end=2022-03-02")
+            response = client.getresponse()
+            body = json.loads(response.read())
+            etag = response.getheader("ETag")
+            assert response.status == 200 and response.getheader("Transfer-Encoding") == "chunked"
+            assert [row["turbine_id"] for row in body] == [1, 2, 3, 4, 5] and body[0]["day"] == "2022-03-01"
+
+            client.request("GET", "/summary?start=2022-03-01&end=2022-03-02", headers={"If-None-Match": etag})
+            response = client.getresponse()
+            response.read()
+            assert response.status == 304 and mock_cursor.execute.call_count == 1
+
+            client.request("GET", "/summary?start=2022-03-01")
+            response = client.getresponse()
+            assert response.status == 400 and "end" in json.loads(response.read())["error"]
+            client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        query_api.get_cache().clear()
+
+def test_turbine_state_keeps_latest_reading_per_turbine(mock_db_connection):
+    """Test one bulk upsert with the latest reading of every turbine of an ingested batch"""
+    mock_connection, mock_cursor = mock_db_connection
+    batch = pd.DataFrame({
+        'timestamp': pd.to_datetime(['2022-03-01 01:00', '2022-03-01 00:00', '2022-03-01 00:00', None]),
+        'turbine_id': [1, 1, 2, 3],
+        'wind_speed': [10.0, 9.0, np.nan, 5.0],
+        'wind_direction': [180.0, 170.0, 200.0, 90.0],
+        'power_output': [2.5, 2.0, 3.0, 1.0],
+    })
+
+    assert turbine_state.update_ingested_state(mock_cursor, batch) == 2
+
+    query, records = mock_cursor.executemany.call_args.args
+    assert config.TURBINE_STATE_TABLE in query and "GREATEST" in query
+    assert sorted(records) == [(1, datetime(2022, 3, 1, 1), 10.0, 180.0, 2.5), (2, datetime(2022, 3, 1, 0), None, 200.0, 3.0)]
+    assert all(type(value) in (int, float, datetime, type(None)) for record in records for value in record)
+
+@patch("parquet_export.write_partition")
+def test_parquet_export_rewrites_changed_partitions_only(mock_write_partition, mock_db_connection, tmp_path, monkeypatch):
+    """Test the changed (day, turbine) partitions are written and emptied ones deleted"""
+    monkeypatch.setattr(config, "PARQUET_EXPORT_FOLDER", str(tmp_path))
+    mock_connection, mock_cursor = mock_db_connection
+    day_1, day_2 = datetime(2022, 3, 1).date(), datetime(2022, 3, 2).date()
+    stale = tmp_path / "clean_data" / "day=2022-03-02" / "turbine_id=2" / "part-0.parquet"
+    stale.parent.mkdir(parents=True)
+    stale.write_bytes(b"old")
+
+    batches = parquet_export.get_export_batches([(day_1, 1), (day_2, 2), (datetime(2022, 3, 9).date(), 1)])
+    assert [(batch[0], batch[1], batch[2]) for batch in batches] == [
+        (datetime(2022, 3, 1), datetime(2022, 3, 3), [1, 2]), (datetime(2022, 3, 9), datetime(2022, 3, 10), [1])]
+
+    mock_cursor.description = [(name,) for name in ("timestamp", "turbine_id", "wind_speed", "wind_direction", "power_output", "insertion_date")]
+    mock_cursor.fetchmany.side_effect = [[(datetime(2022, 3, 1, 0), 1, 10.0, 180.0, 2.5, datetime(2022, 3, 3)),
+                                          (datetime(2022, 3, 1, 1), 1, 11.0, 190.0, 2.7, datetime(2022, 3, 3))], []]
+    changes = {"clean_data": {"written": [], "deleted": [], "rows": 0}}
+    parquet_export.export_batch(mock_cursor, "clean_data", batches[0], changes)
+
+    assert changes == {"clean_data": {"written": ["clean_data/day=2022-03-01/turbine_id=1"],
+                                      "deleted": ["clean_data/day=2022-03-02/turbine_id=2"], "rows": 2}}
+    frame, path = mock_write_partition.call_args.args
+    assert path == os.path.join(str(tmp_path), "clean_data/day=2022-03-01/turbine_id=1", "part-0.parquet")
+    assert list(frame.columns) == ["timestamp", "wind_speed", "wind_direction", "power_output", "insertion_date"]
+    assert not stale.exists() and not stale.parent.exists()
+    assert mock_cursor.execute.call_args.args[1] == (datetime(2022, 3, 1), datetime(2022, 3, 3), 1, 2)
+
+def test_column_store_appends_and_reads_time_ranges(tmp_path, monkeypatch):
+    """Test appends, in place corrections, an out of order reading and range reads of the column store"""
+    monkeypatch.setattr(config, "COLUMN_STORE_INDEX_STRIDE", 3)
+    store = column_store.ColumnStore(str(tmp_path))
+    timestamps = pd.date_range("2022-03-01", periods=10, freq="30min")
+    readings = pd.DataFrame({'timestamp': timestamps, 'turbine_id': 1, 'wind_speed': 10.0,
+                             'wind_direction': 180.0, 'power_output': np.arange(10.0)})
+
+    assert store.append(readings.iloc[:4]) == 4 and store.append(readings.iloc[4:]) == 6
+    assert len(store.get_index(1)) == 4
+    window = store.read_range(1, datetime(2022, 3, 1, 1), datetime(2022, 3, 1, 3))
+    assert isinstance(window["power_output"], np.memmap)
+    assert window["power_output"].tolist() == [2.0, 3.0, 4.0, 5.0]
+
+    correction = pd.DataFrame({'timestamp': [timestamps[2], pd.Timestamp("2022-03-01 00:15")], 'turbine_id': [1, 1],
+                               'wind_speed': [1.0, 1.0], 'wind_direction': [1.0, 1.0], 'power_output': [99.0, np.nan]})
+    store.append(correction.iloc[:1])
+    assert store.get_row_count(1) == 10 and store.read_range(1)["power_output"][2] == 99.0
+    store.append(correction.iloc[1:])
+    assert store.get_row_count(1) == 11 and len(store.get_index(1)) == 4
+    assert str(store.read_range(1)["timestamp"][1]) == "2022-03-01T00:15:00.000000"
+    early = store.read_range(1, end=datetime(2022, 3, 1, 1))["power_output"]
+    assert len(early) == 3 and np.isnan(early[1]) and early[2] == 1.0
+
+@patch("watermarks.get_watermark")
+def test_column_store_syncs_committed_rows_after_ingestion(mock_get_watermark, mock_db_connection, tmp_path, monkeypatch):
+    """Test the store gets the raw rows after the clean watermark and the unconsumed corrections, not the batches"""
+    mock_connection, mock_cursor = mock_db_connection
+    monkeypatch.setattr(config, "COLUMN_STORE_FOLDER", str(tmp_path))
+    mock_get_watermark.side_effect = lambda connection, name: {"clean_data:raw_id": 10, "change_log:clean_data": 3}.get(name)
+    mock_cursor.description = [("timestamp",), ("turbine_id",), ("wind_speed",), ("wind_direction",), ("power_output",)]
+    mock_cursor.fetchmany.side_effect = [
+        [(datetime(2022, 3, 1, 1), 1, 10.0, 180.0, 2.0), (datetime(2022, 3, 1, 2), 1, None, 180.0, 3.0)], [],
+        [(datetime(2022, 3, 1, 0), 1, 9.0, 90.0, 1.0)], [],
+    ]
+
+    assert column_store.sync_from_database(mock_connection) == 3
+    new_rows, corrections = [call.args for call in mock_cursor.execute.call_args_list]
+    assert new_rows[1] == (10,) and corrections[1] == (3, 10)
+    assert config.CHANGE_LOG_TABLE in corrections[0]
+    stored = column_store.get_store().read_range(1)
+    assert stored["power_output"].tolist() == [1.0, 2.0, 3.0] and np.isnan(stored["wind_speed"][2])
+
+    # no append while the batches are written, the rows of a rolled back batch never reach the store
+    monkeypatch.setattr(config, "COLUMN_STORE", True)
+    with patch("column_store.ColumnStore.append") as mock_append:
+        ingest_data.insert_raw_rows(mock_cursor, pd.DataFrame({'timestamp': [datetime(2022, 3, 1, 3)], 'turbine_id': [1],
+                                                               'wind_speed': [1.0], 'wind_direction': [1.0], 'power_output': [1.0]}))
+    mock_append.assert_not_called()
+
+def test_turbine_registry_registers_new_turbines_once_committed(mock_db_connection):
+    """Test new turbines are inserted in bulk and the cache reloads only when the registry's version moves"""
+    mock_connection, mock_cursor = mock_db_connection
+    registry = turbine_registry.get_registry()
+    registry.clear()
+    mock_cursor.fetchone.return_value = (None,)
+    mock_cursor.fetchall.return_value = [(1, "data_group_1.csv", None, None)]
+
+    assert turbine_registry.register_turbines(mock_cursor, np.array([2, 1, 2]), "data_group_1.csv") == [2]
+    query, records = mock_cursor.executemany.call_args.args
+    assert config.TURBINES_TABLE in query and records == [(2, "data_group_1.csv")]
+
+    # same ledger version, the registry table isn't read again
+    mock_cursor.fetchall.return_value = [(1, None, None, None), (2, None, None, None)]
+    assert turbine_registry.get_turbine_ids(mock_connection) == [1]
+    mock_cursor.fetchone.return_value = (7,)
+    assert turbine_registry.get_turbine_ids(mock_connection) == [1, 2]
+    registry.clear()
+
+def test_anomalies_summary_sees_turbines_registered_just_before(mock_db_connection):
+    """Test a summary run right after a registration gets the new turbine and a rolled back one is dropped"""
+    mock_connection, mock_cursor = mock_db_connection
+    registry = turbine_registry.get_registry()
+    registry.clear()
+    mock_cursor.fetchone.return_value = (7,)
+    mock_cursor.fetchall.return_value = [(1, "data_group_1.csv", None, None)]
+
+    # registered and read back in the ingesting transaction (version 8), then rolled back (version 7 again)
+    assert turbine_registry.register_turbines(mock_cursor, [1, 2], "data_group_2.csv") == [2]
+    mock_cursor.fetchone.return_value = (8,)
+    mock_cursor.fetchall.return_value = [(1, "data_group_1.csv", None, None), (2, "data_group_2.csv", None, None)]
+    assert turbine_registry.get_turbine_ids(mock_connection) == [1, 2]
+    mock_cursor.fetchone.return_value = (7,)
+    mock_cursor.fetchall.return_value = [(1, "data_group_1.csv", None, None)]
+    assert turbine_registry.register_turbines(mock_cursor, [1, 2], "data_group_2.csv") == [2]
+
+    # the retried registration was committed, the ledger version moved
+    mock_cursor.fetchone.return_value = (9,)
+    mock_cursor.fetchall.side_effect = [[(1,)], [(1, "data_group_1.csv", None, None), (2, "data_group_2.csv", None, None)]]
+    assert calculate_summary_stats.get_anomalies_summary_stats(mock_connection) is True
+
+    queries = [call.args[0] for call in mock_cursor.execute.call_args_list]
+    create_query = next(query for query in queries if "CREATE TABLE" in query)
+    assert "`Turbine_ID_1`" in create_query and "`Turbine_ID_2`" in create_query
+    assert "(day, Turbine_ID_1, Turbine_ID_2)" in queries[-2]
+    registry.clear()
+
+def test_process_statistics_reads_recent_periods_from_hot_window(mock_db_connection, monkeypatch):
+    """Test the recent periods are computed from the hot window and only the full data set from the database"""
+    mock_connection, mock_cursor = mock_db_connection
+    monkeypatch.setattr(config, "HOT_WINDOW_CACHE", True)
+    max_timestamp = datetime(2022, 3, 29)
+    window = pd.DataFrame({'id': [1, 2, 3], 'timestamp': pd.to_datetime(["2022-03-02 00:00", "2022-03-25 00:00", "2022-03-28 12:00"]),
+                           'turbine_id': 1, 'wind_speed': 10.0, 'wind_direction': 180.0, 'power_output': [1.0, 2.0, 3.0]})
+
+    with patch("clean_data.get_max_timestamp_prev_run", return_value=max_timestamp), \
+         patch("clean_data.get_window", return_value=window) as mock_get_window, \
+         patch("clean_data.get_filtered_data", return_value=window[memory_mode.MEASUREMENT_COLUMNS]) as mock_filtered, \
+         patch("clean_data.store_statistics") as mock_store:
+        assert clean_data.process_statistics(mock_connection, (0, 3)) is True
+
+    mock_get_window.assert_called_once_with(mock_connection, max_timestamp, 3)
+    mock_filtered.assert_called_once_with(mock_connection, None)
+    stored = {call.args[1]: call.args[2]["power_output"]["mean"] for call in mock_store.call_args_list}
+    assert stored == {"full_dataset": 2.0, "last_4_weeks": 2.0, "last_2_weeks": 2.5, "last_1_week": 2.5, "last_1_day": 3.0}
+
+    # a correction applied after the cached window was written, the window is rebuilt
+    meta = {"raw_id": 3, "change_offset": 5, "window_start": "2022-03-01T00:00:00", "rows": 3}
+    assert hot_window.is_valid(meta, 3, 5, 4, max_timestamp - pd.Timedelta(weeks=4))
+    assert not hot_window.is_valid(meta, 3, 6, 4, max_timestamp - pd.Timedelta(weeks=4))
+    assert not hot_window.is_valid(meta, 2, 5, 4, max_timestamp - pd.Timedelta(weeks=4))
+
+@patch("clean_data.get_window")
+@patch("clean_data.get_watermark", return_value=42)
+@patch("clean_data.get_max_timestamp_prev_run", return_value=datetime(2022, 3, 29))
+@patch("clean_data.mark_changes_consumed")
+@patch("clean_data.get_anomaly_bounds", return_value=(0.0, 100.0))
+@patch("clean_data.get_pending_change_range", return_value=(3, 5))
+def test_hot_window_follows_the_change_log_offset(mock_change_range, mock_bounds, mock_consumed, mock_max_timestamp,
+                                                 mock_watermark, mock_get_window, mock_db_connection, monkeypatch):
+    """Test pending corrections bypass the hot window and it is refreshed once the late corrections are committed"""
+    mock_connection, mock_cursor = mock_db_connection
+    monkeypatch.setattr(config, "HOT_WINDOW_CACHE", True)
+    mock_get_window.side_effect = lambda connection, max_timestamp, scored_raw_id: mock_connection.commit.assert_called_once()
+
+    assert clean_data.apply_late_corrections(mock_connection) is True
+    mock_get_window.assert_called_once_with(mock_connection, datetime(2022, 3, 29), 42)
+
+    # consumed entries purged (MAX(id) below the offset) isn't a pending correction, entries after it are
+    mock_cursor.fetchone.return_value = (None,)
+    assert not hot_window.has_pending_changes(mock_cursor, 5)
+    mock_cursor.fetchone.return_value = (6,)
+    assert hot_window.has_pending_changes(mock_cursor, 5)
+
+@patch("calculate_summary_stats.update_rollups", side_effect=ValueError("bad frame"))
+@patch("calculate_summary_stats.calculate_summary_stats", return_value=True)
+@patch("calculate_summary_stats.get_dirty_days", return_value=([datetime(2022, 3, 1).date()], datetime(2022, 3, 2), None))
+def test_update_summary_stats_rolls_back_on_any_error(mock_dirty_days, mock_calculate, mock_rollups, mock_db_connection):
+    """Test a non MySQL error while aggregating rolls the summary transaction back instead of escaping"""
+    mock_connection, mock_cursor = mock_db_connection
+
+    assert calculate_summary_stats.update_summary_stats(mock_connection) is False
+    mock_connection.rollback.assert_called_once()
+    mock_connection.commit.assert_not_called()
+
+def test_daily_distribution_stats_in_one_grouped_pass(mock_db_connection):
+    """Test the distribution, completeness, anomaly and imputed value counts per (day, turbine)"""
+    mock_connection, mock_cursor = mock_db_connection
+    readings = pd.DataFrame({'day_offset': [0, 0, 0, 0, 1], 'turbine_id': [1, 1, 1, 1, 1],
+                             'wind_speed': [10.0, np.nan, 12.0, 9.0, 8.0], 'wind_direction': [180.0, 90.0, np.nan, 45.0, 0.0],
+                             'power_output': [1.0, 3.0, 50.0, np.nan, 2.0], 'is_anomaly': [0, 0, 1, 0, 0]})
+
+    stats = daily_distribution.calculate_distribution_stats(readings).set_index("day_offset")
+    assert stats.loc[0, "readings_received"] == 4 and stats.loc[0, "readings_expected"] == 24
+    assert stats.loc[0, "completeness"] == pytest.approx(4 / 24)
+    assert (stats.loc[0, "null_value_count"], stats.loc[0, "anomaly_count"], stats.loc[0, "imputed_value_count"]) == (3, 1, 2)
+    assert stats.loc[0, "null_rate"] == pytest.approx(3 / 12)
+    assert (stats.loc[0, "power_output_count"], stats.loc[0, "power_output_sum"]) == (2, 4.0)
+    assert stats.loc[0, "power_output_std"] == pytest.approx(1.0)
+    assert stats.loc[0, "power_output_p50"] == pytest.approx(2.0)
+    assert stats.loc[1, "power_output_std"] == 0.0
+
+    with patch("daily_distribution.fetch_dataframe", return_value=readings):
+        assert daily_distribution.update_distribution_range(mock_cursor, datetime(2022, 3, 1), datetime(2022, 3, 3)) == 2
+    query, records = mock_cursor.executemany.call_args.args
+    assert config.DAILY_DISTRIBUTION_STATS_TABLE in query
+    assert records[1][:4] == (datetime(2022, 3, 2).date(), 1, 1, 24) and len(records[1]) == 2 + len(daily_distribution.DISTRIBUTION_COLUMNS)
+
+@patch("in_memory_pipeline.update_ingested_state")
+@patch("in_memory_pipeline.register_turbines")
+@patch("in_memory_pipeline.record_changed_keys")
+def test_in_memory_raw_batch_logs_only_changed_redeliveries(mock_record_changed_keys, mock_register, mock_state, mock_db_connection):
+    """Test an unchanged re-delivered row is neither a correction nor a new record, a changed one is a correction"""
+    mock_connection, mock_cursor = mock_db_connection
+    batch = pd.DataFrame({'timestamp': pd.to_datetime(["2022-03-01 00:00", "2022-03-01 01:00", "2022-03-01 02:00"]),
+                          'turbine_id': [1, 1, 1], 'wind_speed': [10.0, 11.0, 12.0],
+                          'wind_direction': [180.0, 180.0, 180.0], 'power_output': [1.0, 2.0, 3.0]})
+    # the stage table join: 00:00 re-delivered unchanged, 01:00 re-delivered with other values, 02:00 is new
+    mock_cursor.fetchall.return_value = [(datetime(2022, 3, 1, 0), 1, 0), (datetime(2022, 3, 1, 1), 1, 1)]
+
+    new_records = in_memory_pipeline.write_raw_batch(mock_cursor, batch, "data_group_1.csv")
+
+    assert new_records["timestamp"].tolist() == [pd.Timestamp("2022-03-01 02:00")]
+    mock_record_changed_keys.assert_called_once_with(mock_cursor, [(datetime(2022, 3, 1, 1), 1)])
+    staged = [call.args[1] for call in mock_cursor.executemany.call_args_list]
+    assert len(staged[0]) == 3
+    assert any(in_memory_pipeline.RAW_STAGE_TABLE in call.args[0] and "ON DUPLICATE KEY UPDATE" in call.args[0]
+               for call in mock_cursor.execute.call_args_list)
+
 if __name__ == "__main__":
     pytest.main()
     
\ No newline at end of file